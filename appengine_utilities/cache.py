@@ -28,26 +28,127 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 # main python imports
 import datetime
+import hashlib
+import math
 import pickle
 import random
-import __main__
+import time
 
 # google appengine import
 from google.appengine.ext import db
 from google.appengine.api import memcache
 
+# appengine_utilities import
+from event import AEU_Events as _events
+from lru import LRUCache
+
 # settings
 try:
     import settings
 except:
     import settings_default as settings
     
+# memcache holds (expires, value) pairs, with the value pickled as it is in
+# the datastore and its expiry as a timestamp
+MEMCACHE_PREFIX = 'cache-t-'
+# get_or_compute keeps (expires, compute seconds, value) envelopes, which
+# outlive the value by the grace window, and holds recompute leases
+ENVELOPE_PREFIX = 'cache-e-'
+LEASE_PREFIX = 'cache-l-'
+# how often, and how long apart, a request with nothing to serve checks
+# for the value another request is computing
+LEASE_WAITS = 5
+LEASE_WAIT_SECONDS = 0.1
+# memcache treats expiry times over 30 days as timestamps
+MAX_MEMCACHE_SECONDS = 30 * 24 * 60 * 60
+
+# cache keys longer than this many UTF-8 bytes are hashed to make their
+# entity's key name, which the datastore limits to 500 bytes
+MAX_KEY_NAME_LENGTH = 400
+
+_STAT_NAMES = ('local_hits', 'memcache_hits', 'datastore_hits', 'misses')
+
+
 class _AppEngineUtilities_Cache(db.Model):
+    """
+    Model for cache entries. Entries are stored under a key name made from
+    their cache key (see key_name_for), so they can be read with a get
+    rather than a query.
+    """
     cachekey = db.StringProperty()
     createTime = db.DateTimeProperty(auto_now_add=True)
     timeout = db.DateTimeProperty()
     value = db.BlobProperty()
 
+    @staticmethod
+    def key_name_for(key):
+        """
+        Returns the entity key name for a cache key. Key names can't start
+        with a digit, so they're prefixed, and long cache keys are hashed.
+        """
+        key = unicode(key)
+        encoded = key.encode('utf-8')
+        if len(encoded) > MAX_KEY_NAME_LENGTH:
+            return u'h:%s' % (hashlib.sha1(encoded).hexdigest())
+        return u'k:%s' % (key)
+
+    @classmethod
+    def key_for(cls, key):
+        """
+        Returns the datastore key of the entity for a cache key.
+        """
+        return db.Key.from_path(cls.kind(), cls.key_name_for(key))
+
+    @classmethod
+    def for_key(cls, key):
+        """
+        Returns a new entity for a cache key.
+        """
+        return cls(key_name = cls.key_name_for(key), cachekey = key)
+
+
+# the in-instance tier, shared by every Cache on this instance
+_local_cache = LRUCache(settings.cache["LOCAL_CACHE_SIZE"],
+    max_bytes = settings.cache["LOCAL_CACHE_BYTES"] or None)
+_stats = dict.fromkeys(_STAT_NAMES, 0)
+
+
+def _memcache_key(key):
+    """
+    Returns the memcache key for a cache key.
+    """
+    return '%s%s' % (MEMCACHE_PREFIX, key)
+
+
+def _memcache_value(data, seconds):
+    """
+    Returns what memcache holds for a pickled value expiring in seconds.
+    """
+    return (time.time() + seconds, data)
+
+
+def _envelope_key(key):
+    """
+    Returns the memcache key of the get_or_compute envelope for a cache key.
+    """
+    return '%s%s' % (ENVELOPE_PREFIX, key)
+
+
+def _lease_key(key):
+    """
+    Returns the memcache key of the recompute lease for a cache key.
+    """
+    return '%s%s' % (LEASE_PREFIX, key)
+
+
+def _seconds_until(timeout):
+    """
+    Returns the whole number of seconds until a datetime, for memcache.
+    """
+    delta = timeout - datetime.datetime.now()
+    seconds = delta.days * 24 * 60 * 60 + delta.seconds
+    return max(1, min(seconds, MAX_MEMCACHE_SECONDS))
+
 
 class Cache(object):
     """
@@ -62,11 +163,27 @@ class Cache(object):
     to store data in both memcache, and the datastore. However, should a
     datastore write fail, it will not try again. This is for performance
     reasons.
+
+    Optionally (see LOCAL_CACHE_SIZE and LOCAL_CACHE_BYTES), values are
+    also kept in a bounded in-instance LRU in front of memcache, so hot
+    values are read without any RPC. Reads fill every tier they missed, and writes go to every
+    tier. Deletes can only reach this instance's LRU, so other instances
+    may serve a value for up to LOCAL_CACHE_TTL seconds after it changes.
+    get_stats() reports hits per tier.
+
+    get_or_compute() caches values that are expensive to build, making sure
+    only one request at a time rebuilds an expired value while the others
+    serve the old one.
     """
 
     def __init__(self, clean_check_percent = settings.cache["CLEAN_CHECK_PERCENT"],
       max_hits_to_clean = settings.cache["MAX_HITS_TO_CLEAN"],
-        default_timeout = settings.cache["DEFAULT_TIMEOUT"]):
+        default_timeout = settings.cache["DEFAULT_TIMEOUT"],
+        clean_in_request = settings.cache["CLEAN_IN_REQUEST"],
+        local_ttl = settings.cache["LOCAL_CACHE_TTL"],
+        stale_grace = settings.cache["STALE_GRACE_SECONDS"],
+        lease_seconds = settings.cache["COMPUTE_LEASE_SECONDS"],
+        early_refresh_beta = settings.cache["EARLY_REFRESH_BETA"]):
         """
         Initializer
 
@@ -75,16 +192,29 @@ class Cache(object):
                 run the cache cleanup
             max_hits_to_clean: maximum number of stale hits to clean
             default_timeout: default length a cache item is good for
+            clean_in_request: if False, initialization never runs the cache
+                cleanup; use sweep_expired from a scheduled task instead.
+            local_ttl: longest time in seconds a value is kept in the
+                in-instance tier
+            stale_grace: seconds get_or_compute may serve an expired value
+                while another request recomputes it
+            lease_seconds: seconds a get_or_compute recompute holds its lease
+            early_refresh_beta: how eagerly get_or_compute refreshes a value
+                before it expires; 0 turns early refresh off
         """
         self.clean_check_percent = clean_check_percent
         self.max_hits_to_clean = max_hits_to_clean
         self.default_timeout = default_timeout
+        self.local_ttl = local_ttl
+        self.stale_grace = stale_grace
+        self.lease_seconds = lease_seconds
+        self.early_refresh_beta = early_refresh_beta
 
-        if random.randint(1, 100) < self.clean_check_percent:
+        if clean_in_request and \
+            random.randint(1, 100) < self.clean_check_percent:
             self._clean_cache()
 
-        if 'AEU_Events' in __main__.__dict__:
-            __main__.AEU_Events.fire_event('cacheInitialized')
+        _events.fire_event('cacheInitialized')
 
     def _clean_cache(self):
         """
@@ -106,6 +236,65 @@ class Cache(object):
 
         return True
 
+    @classmethod
+    def sweep_expired(cls, cursor = None, batch_size = 500):
+        """
+        Deletes one batch of expired cache entries from the datastore.
+        Meant to be run from a scheduled task rather than during requests.
+
+        Args:
+            cursor: The cursor returned by the previous call.
+            batch_size: The number of entries to delete, at most 500.
+
+        Returns a cursor to pass to the next call, or None when done.
+        """
+        query = _AppEngineUtilities_Cache.all(keys_only=True)
+        query.filter('timeout < ', datetime.datetime.now())
+        if cursor:
+            query.with_cursor(cursor)
+        results = query.fetch(batch_size)
+        db.delete(results)
+        if len(results) < batch_size:
+            return None
+        return query.cursor()
+
+    @classmethod
+    def migrate_to_key_names(cls, cursor = None, batch_size = 100):
+        """
+        Moves one batch of cache entries stored before entries were
+        addressed by key name to their key named entities. Expired entries
+        are just deleted, as are entries already rewritten since.
+
+        Args:
+            cursor: The cursor returned by the previous call.
+            batch_size: The number of entries to check.
+
+        Returns a cursor to pass to the next call, or None when done.
+        """
+        query = _AppEngineUtilities_Cache.all()
+        if cursor:
+            query.with_cursor(cursor)
+        results = query.fetch(batch_size)
+        old = [result for result in results if result.key().name() is None]
+        if old:
+            now = datetime.datetime.now()
+            existing = db.get([_AppEngineUtilities_Cache.key_for(
+                result.cachekey) for result in old])
+            moved = {}
+            for result, current in zip(old, existing):
+                if current is None and result.timeout > now and \
+                    result.cachekey not in moved:
+                    entry = _AppEngineUtilities_Cache.for_key(result.cachekey)
+                    entry.createTime = result.createTime
+                    entry.timeout = result.timeout
+                    entry.value = result.value
+                    moved[result.cachekey] = entry
+            db.put(moved.values())
+            db.delete(old)
+        if len(results) < batch_size:
+            return None
+        return query.cursor()
+
     def _validate_key(self, key):
         """
         Internal method for key validation. This can be used by a superclass
@@ -176,26 +365,10 @@ class Cache(object):
         if key in self:
             raise KeyError
 
-        cacheEntry = _AppEngineUtilities_Cache()
-        cacheEntry.cachekey = key
-        cacheEntry.value = pickle.dumps(value)
-        cacheEntry.timeout = timeout
+        cacheEntry = _AppEngineUtilities_Cache.for_key(key)
+        self._write(cacheEntry, value, timeout)
 
-        # try to put the entry, if it fails silently pass
-        # failures may happen due to timeouts, the datastore being read
-        # only for maintenance or other applications. However, cache
-        # not being able to write to the datastore should not
-        # break the application
-        try:
-            cacheEntry.put()
-        except:
-            pass
-
-        memcache_timeout = timeout - datetime.datetime.now()
-        memcache.set('cache-%s' % (key), value, int(memcache_timeout.seconds))
-
-        if 'AEU_Events' in __main__.__dict__:
-            __main__.AEU_Events.fire_event('cacheAdded')
+        _events.fire_event('cacheAdded')
 
         return self.get(key)
 
@@ -215,25 +388,46 @@ class Cache(object):
         self._validate_value(value)
         timeout = self._validate_timeout(timeout)
 
-        cacheEntry = self._read(key)
-        if not cacheEntry:
-            cacheEntry = _AppEngineUtilities_Cache()
-            cacheEntry.cachekey = key
-        cacheEntry.value = pickle.dumps(value)
+        # a blind put, as the entity's key comes from the cache key
+        cacheEntry = _AppEngineUtilities_Cache.for_key(key)
+        self._write(cacheEntry, value, timeout)
+
+        _events.fire_event('cacheSet')
+
+        return self.get(key)
+
+    def _write(self, cacheEntry, value, timeout):
+        """
+        _write is an internal method that pickles a value once and writes it
+        to the datastore entity, memcache and the in-instance tier.
+
+        Args:
+            cacheEntry: The entity to write the value to.
+            value: The value to cache.
+            timeout: When the value expires, as a datetime.
+
+        Returns the pickled value.
+        """
+        data = pickle.dumps(value)
+        cacheEntry.value = data
         cacheEntry.timeout = timeout
 
+        # try to put the entry, if it fails silently pass
+        # failures may happen due to timeouts, the datastore being read
+        # only for maintenance or other applications. However, cache
+        # not being able to write to the datastore should not
+        # break the application
         try:
             cacheEntry.put()
         except:
             pass
 
-        memcache_timeout = timeout - datetime.datetime.now()
-        memcache.set('cache-%s' % (key), value, int(memcache_timeout.seconds))
-
-        if 'AEU_Events' in __main__.__dict__:
-            __main__.AEU_Events.fire_event('cacheSet')
-
-        return self.get(key)
+        seconds = _seconds_until(timeout)
+        memcache.set(_memcache_key(cacheEntry.cachekey),
+            _memcache_value(data, seconds), seconds)
+        _local_cache.set(cacheEntry.cachekey, data,
+            min(seconds, self.local_ttl))
+        return data
 
     def _read(self, key = None):
         """
@@ -246,19 +440,14 @@ class Cache(object):
 
         Returns the cache entity
         """
-        query = _AppEngineUtilities_Cache.all()
-        query.filter('cachekey', key)
-        query.filter('timeout > ', datetime.datetime.now())
-        results = query.fetch(1)
-        if len(results) is 0:
+        result = db.get(_AppEngineUtilities_Cache.key_for(key))
+        if result is None or result.timeout <= datetime.datetime.now():
             return None
 
-        if 'AEU_Events' in __main__.__dict__:
-            __main__.AEU_Events.fire_event('cacheReadFromDatastore')
-        if 'AEU_Events' in __main__.__dict__:
-            __main__.AEU_Events.fire_event('cacheRead')
+        _events.fire_event('cacheReadFromDatastore')
+        _events.fire_event('cacheRead')
 
-        return results[0]
+        return result
 
     def delete(self, key = None):
         """
@@ -269,12 +458,10 @@ class Cache(object):
 
         Returns True.
         """
-        memcache.delete('cache-%s' % (key))
-        result = self._read(key)
-        if result:
-            if 'AEU_Events' in __main__.__dict__:
-                __main__.AEU_Events.fire_event('cacheDeleted')
-            result.delete()
+        _local_cache.delete(key)
+        memcache.delete_multi([_memcache_key(key), _envelope_key(key)])
+        _events.fire_event('cacheDeleted')
+        db.delete(_AppEngineUtilities_Cache.key_for(key))
         return True
 
     def get(self, key):
@@ -286,40 +473,291 @@ class Cache(object):
 
         Returns the value of the cache item.
         """
-        mc = memcache.get('cache-%s' % (key))
-        if mc:
-            if 'AEU_Events' in __main__.__dict__:
-                __main__.AEU_Events.fire_event('cacheReadFromMemcache')
-            if 'AEU_Events' in __main__.__dict__:
-                __main__.AEU_Events.fire_event('cacheRead')
-            return mc
+        data = _local_cache.get(key)
+        if data is not None:
+            _stats['local_hits'] += 1
+            _events.fire_event('cacheRead')
+            return pickle.loads(data)
+        cached = memcache.get(_memcache_key(key))
+        if cached is not None:
+            expires, data = cached
+            _stats['memcache_hits'] += 1
+            _local_cache.set(key, data,
+                min(expires - time.time(), self.local_ttl))
+            _events.fire_event('cacheReadFromMemcache')
+            _events.fire_event('cacheRead')
+            return pickle.loads(data)
         result = self._read(key)
         if result:
-            timeout = result.timeout - datetime.datetime.now()
-            memcache.set('cache-%s' % (key), pickle.loads(result.value),
-               int(timeout.seconds))
-            if 'AEU_Events' in __main__.__dict__:
-                __main__.AEU_Events.fire_event('cacheRead')
+            _stats['datastore_hits'] += 1
+            seconds = _seconds_until(result.timeout)
+            memcache.set(_memcache_key(key),
+                _memcache_value(result.value, seconds), seconds)
+            _local_cache.set(key, result.value, min(seconds, self.local_ttl))
+            _events.fire_event('cacheRead')
             return pickle.loads(result.value)
         else:
+            _stats['misses'] += 1
             raise KeyError
 
+    def get_or_compute(self, key, fn, ttl = None):
+        """
+        Returns the value for key, calling fn() to compute and cache it for
+        ttl seconds if it's missing or expired.
+
+        Only the request holding the key's memcache lease recomputes. While
+        it does, other requests are served the expired value for up to
+        stale_grace seconds past its expiry. Requests with no value to serve
+        wait briefly for the lease holder before computing it themselves.
+
+        Values may also be refreshed a little before they expire, with a
+        chance growing as expiry nears and with how long fn took, so a hot
+        key is usually rebuilt before any request finds it expired.
+
+        A key used here should otherwise only be removed, with delete or
+        delete_many; set doesn't replace the value get_or_compute serves.
+
+        Args:
+            key: Key name of the cache object
+            fn: Called with no arguments to compute the value, which must
+                not be None.
+            ttl: Seconds the computed value is fresh for.
+
+        Returns the value.
+        """
+        self._validate_key(key)
+        data = _local_cache.get(key)
+        if data is not None:
+            _stats['local_hits'] += 1
+            return pickle.loads(data)
+
+        envelope = memcache.get(_envelope_key(key))
+        if envelope is not None:
+            expires, delta, data = envelope
+            now = time.time()
+            if not self._refresh_early(expires, delta, now):
+                _stats['memcache_hits'] += 1
+                _local_cache.set(key, data,
+                    min(expires - now, self.local_ttl))
+                return pickle.loads(data)
+            if not memcache.add(_lease_key(key), 1, self.lease_seconds):
+                # another request is recomputing, serve what we have
+                _stats['memcache_hits'] += 1
+                return pickle.loads(data)
+        else:
+            # memcache may have evicted the envelope but not the value
+            try:
+                return self.get(key)
+            except KeyError:
+                pass
+            if not memcache.add(_lease_key(key), 1, self.lease_seconds):
+                for i in range(LEASE_WAITS):
+                    time.sleep(LEASE_WAIT_SECONDS)
+                    envelope = memcache.get(_envelope_key(key))
+                    if envelope is not None:
+                        return pickle.loads(envelope[2])
+                # the lease holder is slow or gone, compute without it
+                return self._compute(key, fn, ttl)
+
+        try:
+            return self._compute(key, fn, ttl)
+        finally:
+            memcache.delete(_lease_key(key))
+
+    def _refresh_early(self, expires, delta, now):
+        """
+        _refresh_early is an internal method that decides whether a value
+        expiring at expires, which took delta seconds to compute, should be
+        recomputed now. Expired values always are; fresh ones are with a
+        chance that grows as expiry nears.
+
+        Returns True if the value should be recomputed.
+        """
+        # 1 - random() is in (0, 1], so the log is finite and <= 0
+        gap = -delta * self.early_refresh_beta * \
+            math.log(1.0 - random.random())
+        return now + gap >= expires
+
+    def _compute(self, key, fn, ttl):
+        """
+        _compute is an internal method that calls fn, caches its value for
+        get and get_or_compute, and returns it.
+        """
+        start = time.time()
+        value = fn()
+        delta = time.time() - start
+        self._validate_value(value)
+        timeout = self._validate_timeout(ttl)
+        seconds = _seconds_until(timeout)
+
+        data = self._write(_AppEngineUtilities_Cache.for_key(key), value,
+            timeout)
+        memcache.set(_envelope_key(key), (time.time() + seconds, delta, data),
+            min(seconds + self.stale_grace, MAX_MEMCACHE_SECONDS))
+
+        _events.fire_event('cacheSet')
+        return value
+
+    def _read_many(self, keys):
+        """
+        _read_many is an internal method that gets the unexpired cache
+        entries for several keys directly from the datastore.
+
+        Args:
+            keys: The keys to retrieve
+
+        Returns a dictionary mapping keys to cache entities, for the keys
+        found.
+        """
+        entries = {}
+        now = datetime.datetime.now()
+        results = db.get([_AppEngineUtilities_Cache.key_for(key)
+            for key in keys])
+        for key, result in zip(keys, results):
+            if result is not None and result.timeout > now:
+                entries[key] = result
+        return entries
+
     def get_many(self, keys):
         """
         Returns a dict mapping each key in keys to its value. If the given
         key is missing, it will be missing from the response dict.
 
+        Keys missing from the in-instance tier are read with one memcache
+        call, and keys missing from memcache with one datastore read, after
+        which memcache is filled in with one more call.
+
         Args:
             keys: A list of keys to retrieve.
 
         Returns a dictionary of key/value pairs.
         """
-        dict = {}
+        found = {}
+        missing = []
         for key in keys:
-            value = self.get(key)
-            if value is not None:
-                dict[key] = val
-        return dict
+            data = _local_cache.get(key)
+            if data is None:
+                missing.append(key)
+            else:
+                _stats['local_hits'] += 1
+                found[key] = data
+        if missing:
+            memcache_keys = dict([(_memcache_key(key), key)
+                for key in missing])
+            cached = memcache.get_multi(memcache_keys.keys())
+            now = time.time()
+            for memcache_key, (expires, data) in cached.iteritems():
+                key = memcache_keys[memcache_key]
+                _stats['memcache_hits'] += 1
+                _local_cache.set(key, data, min(expires - now, self.local_ttl))
+                found[key] = data
+            missing = [key for key in missing if key not in found]
+        if missing:
+            backfill = {}
+            seconds = MAX_MEMCACHE_SECONDS
+            for key, result in self._read_many(missing).iteritems():
+                _stats['datastore_hits'] += 1
+                entry_seconds = _seconds_until(result.timeout)
+                # one set_multi call takes one timeout, so use the soonest
+                seconds = min(seconds, entry_seconds)
+                _local_cache.set(key, result.value,
+                    min(entry_seconds, self.local_ttl))
+                backfill[_memcache_key(key)] = _memcache_value(
+                    result.value, entry_seconds)
+                found[key] = result.value
+            _stats['misses'] += len(missing) - len(backfill)
+            if backfill:
+                memcache.set_multi(backfill, seconds)
+        if found:
+            _events.fire_event('cacheRead')
+        return dict([(key, pickle.loads(data))
+            for key, data in found.iteritems()])
+
+    def set_many(self, mapping, timeout = None):
+        """
+        Sets several entries, overwriting existing values, with one
+        datastore put and one memcache call. Nothing is read first.
+
+        Args:
+            mapping: A dictionary of key/value pairs.
+            timeout: timeout value for the cache objects.
+
+        Returns True.
+        """
+        if not mapping:
+            return True
+        for key, value in mapping.iteritems():
+            self._validate_key(key)
+            self._validate_value(value)
+        timeout = self._validate_timeout(timeout)
+        seconds = _seconds_until(timeout)
+
+        entries = []
+        cached = {}
+        for key, value in mapping.iteritems():
+            data = pickle.dumps(value)
+            entry = _AppEngineUtilities_Cache.for_key(key)
+            entry.value = data
+            entry.timeout = timeout
+            entries.append(entry)
+            cached[_memcache_key(key)] = _memcache_value(data, seconds)
+            _local_cache.set(key, data, min(seconds, self.local_ttl))
+
+        try:
+            db.put(entries)
+        except:
+            pass
+        memcache.set_multi(cached, seconds)
+
+        _events.fire_event('cacheSet')
+        return True
+
+    def delete_many(self, keys):
+        """
+        Deletes several cache objects, with one memcache call and one
+        datastore delete.
+
+        Args:
+            keys: The keys of the cache objects to delete.
+
+        Returns True.
+        """
+        for key in keys:
+            _local_cache.delete(key)
+        memcache.delete_multi([_memcache_key(key) for key in keys] +
+            [_envelope_key(key) for key in keys])
+        _events.fire_event('cacheDeleted')
+        db.delete([_AppEngineUtilities_Cache.key_for(key) for key in keys])
+        return True
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Returns the hits on each tier since the instance started, or since
+        clear_local(). Each ratio is the share of the reads that reached a
+        tier that were answered there; for example, memcache_ratio is
+        memcache_hits over the reads the in-instance tier missed.
+        """
+        stats = dict(_stats)
+        reads = 0
+        for name in reversed(_STAT_NAMES):
+            reads += stats[name]
+            if name != 'misses':
+                tier = name[:-len('_hits')]
+                if reads:
+                    stats[tier + '_ratio'] = float(stats[name]) / reads
+                else:
+                    stats[tier + '_ratio'] = 0.0
+        return stats
+
+    @classmethod
+    def clear_local(cls):
+        """
+        Empties the in-instance tier and resets the hit counts.
+        """
+        _local_cache.clear()
+        for name in _STAT_NAMES:
+            _stats[name] = 0
 
     def __getitem__(self, key):
         """
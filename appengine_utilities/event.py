@@ -24,8 +24,26 @@ ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+import time
 import __main__
 
+from google.appengine.ext import deferred
+
+
+def _run_callback(callback, args):
+    """
+    Runs a callback with its subscription arguments, the way fire_event
+    does. Deferred callbacks run through this in a task.
+    """
+    if type(args) == type([]):
+        callback(*args)
+    elif type(args) == type({}):
+        callback(**args)
+    elif args == None:
+        callback()
+    else:
+        callback(args)
+
 
 class Event(object):
     """
@@ -35,27 +53,34 @@ class Event(object):
     application, you can set events to fire, and then subscribe to them with
     callback methods in other methods in your application.
 
-    It sets itself to the __main__ function. In order to use it,
-    you must import it with your __main__ method, and make sure
-    you import __main__ and it's accessible for the methods where
-    you want to use it.
+    It sets itself to the __main__ function, and to AEU_Events in this
+    module. Modules that fire events should keep a reference to the module's
+    AEU_Events rather than looking it up on __main__ each time.
 
     For example, from sessions.py
 
-            # if the event class has been loaded, fire off the sessionDeleted event
-        if u"AEU_Events" in __main__.__dict__:
-            __main__.AEU_Events.fire_event(u"sessionDelete")
+        from event import AEU_Events as _events
+        ...
+        _events.fire_event(u"sessionDelete")
 
     You can the subscribe to session delete events, adding a callback
 
-        if u"AEU_Events" in __main__.__dict__:
-            __main__.AEU_Events.subscribe(u"sessionDelete", clear_user_session)
+        _events.subscribe(u"sessionDelete", clear_user_session)
+
+    Subscriptions are kept by event name, so firing an event nobody
+    subscribed to is a single dictionary lookup. Slow callbacks can be
+    subscribed with deferred=True to run in a task queue task instead of
+    during the request. get_stats() reports, per event, how often it fired
+    with subscribers and how long its callbacks took.
     """
 
     def __init__(self):
-        self.events = []
+        # maps event names to lists of (callback, args, deferred)
+        self.events = {}
+        # maps event names to [fires, seconds]
+        self.stats = {}
 
-    def subscribe(self, event, callback, args = None):
+    def subscribe(self, event, callback, args = None, deferred = False):
         """
         This method will subscribe a callback function to an event name.
 
@@ -63,16 +88,20 @@ class Event(object):
             event: The event to subscribe to.
             callback: The callback method to run.
             args: Optional arguments to pass with the callback.
+            deferred: If True, the callback runs in a task queue task rather
+                than when the event fires. The callback and args must be
+                picklable, so the callback should be a module level
+                function.
 
         Returns True
         """
-        if not {"event": event, "callback": callback, "args": args, } \
-            in self.events:
-            self.events.append({"event": event, "callback": callback, \
-                "args": args, })
+        subscription = (callback, args, deferred)
+        subscriptions = self.events.setdefault(event, [])
+        if not subscription in subscriptions:
+            subscriptions.append(subscription)
         return True
 
-    def unsubscribe(self, event, callback, args = None):
+    def unsubscribe(self, event, callback, args = None, deferred = False):
         """
         This method will unsubscribe a callback from an event.
 
@@ -80,13 +109,15 @@ class Event(object):
             event: The event to subscribe to.
             callback: The callback method to run.
             args: Optional arguments to pass with the callback.
+            deferred: Whether the callback was subscribed as deferred.
 
         Returns True
         """
-        if {"event": event, "callback": callback, "args": args, }\
-            in self.events:
-            self.events.remove({"event": event, "callback": callback,\
-                "args": args, })
+        subscriptions = self.events.get(event)
+        if subscriptions and (callback, args, deferred) in subscriptions:
+            subscriptions.remove((callback, args, deferred))
+            if not subscriptions:
+                del self.events[event]
 
         return True
 
@@ -100,18 +131,40 @@ class Event(object):
 
         Returns True
         """
-        for e in self.events:
-            if e["event"] == event:
-                if type(e["args"]) == type([]):
-                    e["callback"](*e["args"])
-                elif type(e["args"]) == type({}):
-                    e["callback"](**e["args"])
-                elif e["args"] == None:
-                    e["callback"]()
-                else:
-                    e["callback"](e["args"])
+        subscriptions = self.events.get(event)
+        if not subscriptions:
+            return True
+        start = time.time()
+        # copy, so callbacks may unsubscribe themselves
+        for callback, args, defer in list(subscriptions):
+            if defer:
+                deferred.defer(_run_callback, callback, args)
+            else:
+                _run_callback(callback, args)
+        stats = self.stats.get(event)
+        if stats is None:
+            stats = self.stats[event] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += time.time() - start
         return True
+
+    def get_stats(self):
+        """
+        Returns a dictionary mapping each event that fired with subscribers
+        to a dictionary of its fires and the total seconds its callbacks
+        took. Deferred callbacks count the time taken to queue them.
+        """
+        return dict([(event, {"fires": fires, "seconds": seconds})
+            for event, (fires, seconds) in self.stats.iteritems()])
+
+    def clear_stats(self):
+        """
+        Resets the counts returned by get_stats.
+        """
+        self.stats.clear()
+
 """
 Assign to the event class to __main__
 """
-__main__.AEU_Events = Event()
+AEU_Events = Event()
+__main__.AEU_Events = AEU_Events
@@ -64,11 +64,20 @@ class Flash(object):
         {% endif %}
     """
 
-    def __init__(self, cookie=None):
+    def __init__(self, cookie=None, collect_headers=False):
         """
         Load the flash message and clear the cookie.
+
+        Args:
+            cookie: The request's cookies, if already loaded.
+            collect_headers: If True, headers aren't printed; call
+                write_headers() at the end of the request to add them to the
+                response.
         """
-        print self.no_cache_headers()
+        self.__dict__['collect_headers'] = collect_headers
+        self.__dict__['output_cookie'] = Cookie.SimpleCookie()
+        if not collect_headers:
+            print self.no_cache_headers()
        # load cookie
         if cookie is None:
             browser_cookie = os.environ.get('HTTP_COOKIE', '')
@@ -89,10 +98,10 @@ class Flash(object):
                 # the next request, and only blanks out the content.
                 pass
             # clear the cookie
-            self.cookie[COOKIE_NAME] = ''
-            self.cookie[COOKIE_NAME]['path'] = '/'
-            self.cookie[COOKIE_NAME]['expires'] = 0
-            print self.cookie[COOKIE_NAME]
+            self.output_cookie[COOKIE_NAME] = ''
+            self.output_cookie[COOKIE_NAME]['path'] = '/'
+            self.output_cookie[COOKIE_NAME]['expires'] = 0
+            self._send_cookie()
         else:
             # default 'msg' attribute to None
             self.__dict__['msg'] = None
@@ -105,12 +114,29 @@ class Flash(object):
             self.__dict__['cookie'] = value
         elif name == 'msg':
             self.__dict__['msg'] = value
-            self.__dict__['cookie'][COOKIE_NAME] = simplejson.dumps(value)
-            self.__dict__['cookie'][COOKIE_NAME]['path'] = '/'
-            print self.cookie
+            self.output_cookie[COOKIE_NAME] = simplejson.dumps(value)
+            self.output_cookie[COOKIE_NAME]['path'] = '/'
+            self._send_cookie()
         else:
             raise ValueError('You can only set the "msg" attribute.')
 
+    def _send_cookie(self):
+        """
+        Prints the flash cookie, unless headers are being collected.
+        """
+        if not self.collect_headers:
+            print self.output_cookie[COOKIE_NAME]
+
+    def write_headers(self, response):
+        """
+        Adds the flash cookie, if it changed, to a response.
+
+        Args:
+            response: The webapp Response to add the header to.
+        """
+        for morsel in self.output_cookie.values():
+            response.headers.add_header('Set-Cookie', morsel.OutputString())
+
     def no_cache_headers(self):
         """
         Generates headers to avoid any page caching in the browser.
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) 2008, appengine-utilities project
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+- Redistributions of source code must retain the above copyright notice, this
+  list of conditions and the following disclaimer.
+- Redistributions in binary form must reproduce the above copyright notice,
+  this list of conditions and the following disclaimer in the documentation
+  and/or other materials provided with the distribution.
+- Neither the name of the appengine-utilities project nor the names of its
+  contributors may be used to endorse or promote products derived from this
+  software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import pickle
+import time
+
+
+class LRUCache(object):
+    """
+    A bounded in-instance mapping that evicts the least recently used
+    entries. Entries expire ttl seconds after they're set, where ttl is
+    given to set or defaults to the one the cache was made with; a ttl of
+    None never expires.
+
+    The cache holds at most max_size entries and, if max_bytes is given, at
+    most max_bytes of values. Strings are measured by their length and
+    other values by the length of their pickle, so the byte bound is
+    approximate for those.
+    """
+
+    def __init__(self, max_size, ttl = None, max_bytes = None):
+        """
+        Args:
+            max_size: the most entries to hold; 0 or less disables the cache
+            ttl: default seconds an entry lives, for sets that don't give one
+            max_bytes: the most bytes of values to hold, or None for no limit
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = {}
+        # circular doubly linked list of [prev, next, key] links, most
+        # recently used first, with the root link as a sentinel
+        self._root = []
+        self._root[:] = [self._root, self._root, None]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _push_front(self, link):
+        first = self._root[1]
+        link[0] = self._root
+        link[1] = first
+        first[0] = link
+        self._root[1] = link
+
+    def _size_of(self, value):
+        """
+        Returns the approximate size of value in bytes, or 0 if there is no
+        byte bound to check it against.
+        """
+        if self.max_bytes is None:
+            return 0
+        if isinstance(value, str):
+            return len(value)
+        return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def get(self, key, default = None):
+        """
+        Returns the value for key, marking it as recently used, or default
+        if it's missing or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        link, value, expires, size = entry
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return default
+        self._unlink(link)
+        self._push_front(link)
+        return value
+
+    def set(self, key, value, ttl = None):
+        """
+        Sets a value for ttl seconds, or the cache's ttl if None, evicting
+        the least recently used entries while over max_size or max_bytes.
+        Values larger than max_bytes aren't kept.
+        """
+        self.delete(key)
+        if self.max_size <= 0:
+            return
+        size = self._size_of(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires = None
+        else:
+            expires = time.time() + ttl
+        link = [None, None, key]
+        self._push_front(link)
+        self._entries[key] = (link, value, expires, size)
+        self.bytes += size
+        while len(self._entries) > self.max_size or \
+            (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.delete(self._root[0][2])
+
+    def delete(self, key):
+        """
+        Removes key, if present.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry[0])
+            self.bytes -= entry[3]
+
+    def clear(self):
+        """
+        Removes every entry.
+        """
+        self._entries.clear()
+        self._root[:] = [self._root, self._root, None]
+        self.bytes = 0
@@ -32,9 +32,12 @@ import time
 import datetime
 import random
 import hashlib
+import hmac
+import base64
+import binascii
+import zlib
 import Cookie
 import pickle
-import __main__
 from time import strftime
 
 # google appengine imports
@@ -45,6 +48,7 @@ from django.utils import simplejson
 
 # appengine_utilities import
 from rotmodel import ROTModel
+from event import AEU_Events as _events
 
 # settings
 try:
@@ -53,6 +57,146 @@ except:
     import settings_default as settings
 
 
+# The most entities a single db.delete call may delete.
+MAX_DELETE_BATCH = 500
+
+
+def _delete_in_batches(keys):
+    """
+    Deletes entities with as few datastore calls as possible.
+
+    Args:
+        keys: A list of keys to delete.
+    """
+    for i in range(0, len(keys), MAX_DELETE_BATCH):
+        db.delete(keys[i:i + MAX_DELETE_BATCH])
+
+
+# The version of the key signed cookies are signed with. Bump it to rotate
+# the key; cookies signed with the previous version are still accepted.
+SIGNED_COOKIE_KEY_VERSION = settings.session["SIGNED_COOKIE_KEY_VERSION"]
+
+# Headers that keep the browser from caching pages, for write_headers().
+NO_CACHE_HEADERS = (
+    ("Expires", "Tue, 03 Jul 2001 06:00:00 GMT"),
+    ("Cache-Control", "no-store, no-cache, must-revalidate, max-age=0, "
+        "post-check=0, pre-check=0"),
+    ("Pragma", "no-cache"),
+)
+
+# How many times a compare-and-set update of the session data cache is tried
+# before the cached copy is dropped.
+CAS_RETRIES = 5
+
+
+# Session keys are drawn at random from [2**52, 2**53), where floats hold
+# every whole number, so they never need checking for uniqueness.
+SESSION_KEY_BITS = 52
+
+_random = random.SystemRandom()
+
+
+def _session_key_string(session_key):
+    """
+    Returns a session_key as a unicode string. Random keys are written out
+    in full, as unicode() would round them. Strings are returned as is.
+    """
+    if isinstance(session_key, basestring):
+        return session_key
+    if session_key == int(session_key):
+        return u"%d" % (session_key)
+    # keys created before keys were random were timestamps
+    return unicode(session_key)
+
+
+def _session_cache_key(session_key):
+    """
+    Returns the memcache key for a session.
+    """
+    return u"_AppEngineUtilities_Session_%s" % \
+        (_session_key_string(session_key))
+
+
+def _session_data_cache_key(session_key):
+    """
+    Returns the memcache key for a session's data, which is cached as a
+    dictionary of SessionData entities keyed by keyname.
+    """
+    return u"_AppEngineUtilities_SessionData_%s" % \
+        (_session_key_string(session_key))
+
+
+def _items_by_keyname(items):
+    """
+    Returns a dictionary of SessionData entities keyed by keyname.
+    """
+    return dict([(item.keyname, item) for item in items])
+
+
+def _update_session_data_cache(session_key, update):
+    """
+    Applies an update to the cached session data dictionary. Uses
+    compare-and-set, so concurrent requests for the same session don't
+    overwrite each other's changes. If the dictionary isn't cached nothing is
+    done, as the next read rebuilds it from the datastore.
+
+    Args:
+        session_key: The session_key of the session.
+        update: A function that modifies the dictionary in place.
+
+    Returns True if the cached dictionary was updated.
+    """
+    client = memcache.Client()
+    cache_key = _session_data_cache_key(session_key)
+    for i in range(CAS_RETRIES):
+        items = client.gets(cache_key)
+        if not isinstance(items, dict):
+            return False
+        update(items)
+        if client.cas(cache_key, items):
+            return True
+    # Too much contention; drop the cached copy rather than risk it going
+    # stale.
+    memcache.delete(cache_key)
+    return False
+
+
+class _AppEngineUtilities_SigningKey(db.Model):
+    """
+    Model for the secrets used to sign session tokens. The key_name is the
+    name of the secret.
+    """
+    secret = db.StringProperty()
+
+
+# signing secrets already read on this instance, by name
+_signing_keys = {}
+
+
+def _get_signing_key(name):
+    """
+    Returns the named signing secret, creating it the first time it's used.
+    The datastore is only read once per instance.
+    """
+    if name not in _signing_keys:
+        entity = _AppEngineUtilities_SigningKey.get_or_insert(name,
+            secret=binascii.hexlify(os.urandom(20)))
+        _signing_keys[name] = str(entity.secret)
+    return _signing_keys[name]
+
+
+def _constant_time_equals(a, b):
+    """
+    Compares two strings in time that doesn't depend on where they differ.
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
 class _AppEngineUtilities_Session(ROTModel):
     """
     Model for the sessions in the datastore. This contains the identifier and
@@ -68,6 +212,10 @@ class _AppEngineUtilities_Session(ROTModel):
     dirty = db.BooleanProperty(default=False)
     working = db.BooleanProperty(default=False)
     deleted = db.BooleanProperty(default=False) 
+    # newest signed token window issued, and a counter bumped to invalidate
+    # every outstanding signed token
+    token_window = db.IntegerProperty()
+    token_generation = db.IntegerProperty(default=0)
 
     def put(self):
         """
@@ -79,12 +227,8 @@ class _AppEngineUtilities_Session(ROTModel):
 
         Returns the session object.
         """
-        if self.session_key:
-            memcache.set(u"_AppEngineUtilities_Session_%s" % \
-                (unicode(self.session_key)), self)
-        else:
-            # new session, generate a new key, which will handle the
-            # put and set the memcache
+        if not self.session_key:
+            # new session, generate a new key
             self.create_key()
 
         self.last_activity = datetime.datetime.now()
@@ -92,15 +236,21 @@ class _AppEngineUtilities_Session(ROTModel):
         try:
             self.dirty = False
             db.put(self)
-            memcache.set(u"_AppEngineUtilities_Session_%s" % \
-                (unicode(self.session_key)), self)
+            memcache.set(_session_cache_key(self.session_key), self)
         except:
             self.dirty = True
-            memcache.set(u"_AppEngineUtilities_Session_%s" % \
-                (unicode(self.session_key)), self)
+            memcache.set(_session_cache_key(self.session_key), self)
 
         return self
 
+    def put_memcache(self):
+        """
+        Writes the session to memcache only, for changes that don't need
+        to reach the datastore on every request, such as signed token
+        rotation.
+        """
+        memcache.set(_session_cache_key(self.session_key), self)
+
     @classmethod
     def get_session(cls, session_obj=None):
         """
@@ -115,8 +265,10 @@ class _AppEngineUtilities_Session(ROTModel):
         if session_obj.sid == None:
             return None
         session_key = session_obj.sid.split(u'_')[0]
-        session = memcache.get(u"_AppEngineUtilities_Session_%s" % \
-            (unicode(session_key)))
+        signed = session_obj.parse_signed_sid()
+        if signed is not None:
+            session_key = signed[0]
+        session = memcache.get(_session_cache_key(session_key))
         if session:
             if session.deleted == True:
                 session.delete()
@@ -126,10 +278,9 @@ class _AppEngineUtilities_Session(ROTModel):
                 # which can happen with ajax oriented sites, don't try to put
                 # at the same time
                 session.working = True
-                memcache.set(u"_AppEngineUtilities_Session_%s" % \
-                    (unicode(session_key)), session)
+                memcache.set(_session_cache_key(session_key), session)
                 session.put()
-            if session_obj.sid in session.sid:
+            if session_obj.is_valid_sid(session):
                 sessionAge = datetime.datetime.now() - session.last_activity
                 if sessionAge.seconds > session_obj.session_expire_time:
                     session.delete()
@@ -140,17 +291,19 @@ class _AppEngineUtilities_Session(ROTModel):
  
         # Not in memcache, check datastore
         query = _AppEngineUtilities_Session.all()
-        query.filter(u"sid = ", session_obj.sid)
+        if signed is not None:
+            query.filter(u"session_key = ", signed[0])
+        else:
+            query.filter(u"sid = ", session_obj.sid)
         results = query.fetch(1)
-        if len(results) > 0:
+        if len(results) > 0 and session_obj.is_valid_sid(results[0]):
             sessionAge = datetime.datetime.now() - results[0].last_activity
             if sessionAge.seconds > session_obj.session_expire_time:
                 results[0].delete()
                 return None
-            memcache.set(u"_AppEngineUtilities_Session_%s" % \
-                (unicode(session_key)), results[0])
-            memcache.set(u"_AppEngineUtilities_SessionData_%s" % \
-                (unicode(session_key)), results[0].get_items_ds())
+            memcache.set(_session_cache_key(session_key), results[0])
+            memcache.set(_session_data_cache_key(session_key),
+                _items_by_keyname(results[0].get_items_ds()))
             return results[0]
         else:
             return None
@@ -160,18 +313,13 @@ class _AppEngineUtilities_Session(ROTModel):
         Returns all the items stored in a session. Queries memcache first
         and will try the datastore next.
         """
-        items = memcache.get(u"_AppEngineUtilities_SessionData_%s" % \
-            (unicode(self.session_key)))
-        if items:
-            for item in items:
-                if item.deleted == True:
-                    item.delete()
-                    items.remove(item)
-            return items
-
-        query = _AppEngineUtilities_SessionData.all()
-        query.filter(u"session_key", self.session_key)
-        results = query.fetch(1000)
+        items = self._get_items_dict()
+        results = []
+        for item in items.values():
+            if item.deleted == True:
+                item.delete()
+            else:
+                results.append(item)
         return results
 
     def get_item(self, keyname = None):
@@ -183,24 +331,28 @@ class _AppEngineUtilities_Session(ROTModel):
 
         Returns the session data object if it exists, otherwise returns None
         """
-        mc = memcache.get(u"_AppEngineUtilities_SessionData_%s" % \
-            (unicode(self.session_key)))
-        if mc:
-            for item in mc:
-                if item.keyname == keyname:
-                    if item.deleted == True:
-                        item.delete()
-                        return None
-                    return item
-        query = _AppEngineUtilities_SessionData.all()
-        query.filter(u"session_key = ", self.session_key)
-        query.filter(u"keyname = ", keyname)
-        results = query.fetch(1)
-        if len(results) > 0:
-            memcache.set(u"_AppEngineUtilities_SessionData_%s" % \
-                (unicode(self.session_key)), self.get_items_ds())
-            return results[0]
-        return None
+        item = self._get_items_dict().get(keyname)
+        if item is not None and item.deleted == True:
+            item.delete()
+            return None
+        return item
+
+    def _get_items_dict(self):
+        """
+        private method
+
+        Returns the session data objects as a dictionary keyed by keyname.
+        The dictionary is read from memcache, or built from the datastore
+        and cached when missing.
+        """
+        cache_key = _session_data_cache_key(self.session_key)
+        items = memcache.get(cache_key)
+        if isinstance(items, dict):
+            return items
+        items = _items_by_keyname(self.get_items_ds())
+        # add rather than set, so a concurrent update isn't overwritten
+        memcache.add(cache_key, items)
+        return items
 
     def get_items_ds(self):
         """
@@ -222,20 +374,24 @@ class _AppEngineUtilities_Session(ROTModel):
         Returns True
         """
         try:
-            query = _AppEngineUtilities_SessionData.all()
+            keys = [self.key()]
+            query = _AppEngineUtilities_SessionData.all(keys_only=True)
             query.filter(u"session_key = ", self.session_key)
-            results = query.fetch(1000)
-            db.delete(results)
-            db.delete(self)
-            memcache.delete_multi([u"_AppEngineUtilities_Session_%s" % \
-                (unicode(self.session_key)), \
-                u"_AppEngineUtilities_SessionData_%s" % \
-                (unicode(self.session_key))])
+            results = query.fetch(MAX_DELETE_BATCH)
+            while results:
+                keys.extend(results)
+                if len(results) < MAX_DELETE_BATCH:
+                    break
+                query.with_cursor(query.cursor())
+                results = query.fetch(MAX_DELETE_BATCH)
+            _delete_in_batches(keys)
+            memcache.delete_multi([_session_cache_key(self.session_key), \
+                _session_data_cache_key(self.session_key)])
         except:
-            mc = memcache.get(u"_AppEngineUtilities_Session_%s" %+ \
-                (unicode(self.session_key)))
+            mc = memcache.get(_session_cache_key(self.session_key))
             if mc:
                 mc.deleted = True
+                memcache.set(_session_cache_key(self.session_key), mc)
             else:
                 # not in the memcache, check to see if it should be
                 query = _AppEngineUtilities_Session.all()
@@ -243,40 +399,22 @@ class _AppEngineUtilities_Session(ROTModel):
                 results = query.fetch(1)
                 if len(results) > 0:
                     results[0].deleted = True
-                    memcache.set(u"_AppEngineUtilities_Session_%s" % \
-                        (unicode(self.session_key)), results[0])
+                    memcache.set(_session_cache_key(self.session_key), results[0])
         return True
 
     def create_key(self):
         """
-        Creates a unique key for the session.
+        Creates a random key for the session. Keys are random enough that
+        they're unique without being checked, so this doesn't touch the
+        datastore; the key is saved with the session's next put().
 
         Returns the key value as a unicode string.
         """
-        self.session_key = time.time()
-        valid = False
-        while valid == False:
-            # verify session_key is unique
-            if memcache.get(u"_AppEngineUtilities_Session_%s" % \
-                (unicode(self.session_key))):
-                self.session_key = self.session_key + 0.001
-            else:
-                query = _AppEngineUtilities_Session.all()
-                query.filter(u"session_key = ", self.session_key)
-                results = query.fetch(1)
-                if len(results) > 0:
-                    self.session_key = self.session_key + 0.001
-                else:
-                    try:
-                        self.put()
-                        memcache.set(u"_AppEngineUtilities_Session_%s" %+ \
-                            (unicode(self.session_key)), self)
-                    except:
-                        self.dirty = True
-                        memcache.set(u"_AppEngineUtilities_Session_%s" % \
-                            (unicode(self.session_key)), self)
-                    valid = True
-        return unicode(self.session_key)
+        self.session_key = float(
+            _random.getrandbits(SESSION_KEY_BITS) + 2 ** SESSION_KEY_BITS)
+        # a new session has no data, so cache that to avoid querying for it
+        memcache.set(_session_data_cache_key(self.session_key), {})
+        return _session_key_string(self.session_key)
             
 class _AppEngineUtilities_SessionData(ROTModel):
     """
@@ -305,24 +443,9 @@ class _AppEngineUtilities_SessionData(ROTModel):
             self.dirty = True
 
         # update or insert in memcache
-        mc_items = memcache.get(u"_AppEngineUtilities_SessionData_%s" % \
-            (unicode(self.session_key)))
-        if mc_items:
-            value_updated = False
-            for item in mc_items:
-                if value_updated == True:
-                    break
-                if item.keyname == self.keyname:
-                    item.content = self.content
-                    item.model = self.model
-                    memcache.set(u"_AppEngineUtilities_SessionData_%s" % \
-                        (unicode(self.session_key)), mc_items)
-                    value_updated = True
-                    break
-            if value_updated == False:
-                mc_items.append(self)
-                memcache.set(u"_AppEngineUtilities_SessionData_%s" % \
-                    (unicode(self.session_key)), mc_items)
+        def update(items):
+            items[self.keyname] = self
+        _update_session_data_cache(self.session_key, update)
         return return_val
 
     def delete(self):
@@ -335,19 +458,13 @@ class _AppEngineUtilities_SessionData(ROTModel):
             db.delete(self)
         except:
             self.deleted = True
-        mc_items = memcache.get(u"_AppEngineUtilities_SessionData_%s" % \
-            (unicode(self.session_key)))
-        value_handled = False
-        for item in mc_items:
-            if value_handled == True:
-                break
-            if item.keyname == self.keyname:
-                if self.deleted == True:
-                    item.deleted = True
-                else:
-                    mc_items.remove(item)
-                memcache.set(u"_AppEngineUtilities_SessionData_%s" % \
-                    (unicode(self.session_key)), mc_items)
+        def update(items):
+            if self.deleted == True:
+                # keep it marked so a later request retries the delete
+                items[self.keyname] = self
+            else:
+                items.pop(self.keyname, None)
+        _update_session_data_cache(self.session_key, update)
         return True
         
 
@@ -367,20 +484,37 @@ class _DatastoreWriter(object):
         if value is None:
             raise ValueError(u"You must pass a value to put.")
 
-        # datestore write trumps cookie. If there is a cookie value
-        # with this keyname, delete it so we don't have conflicting
-        # entries.
-        if session.cookie_vals.has_key(keyname):
-            del(session.cookie_vals[keyname])
-            session.output_cookie["%s_data" % (session.cookie_name)] = \
-                simplejson.dumps(session.cookie_vals)
-            print session.output_cookie.output()
+        self.remove_cookie_value(keyname, session)
 
         sessdata = session._get(keyname=keyname)
         if sessdata is None:
             sessdata = _AppEngineUtilities_SessionData()
             sessdata.session_key = session.session.session_key
             sessdata.keyname = keyname
+        self.set_content(sessdata, value)
+            
+        session.cache[keyname] = value
+        return sessdata.put()
+
+    @staticmethod
+    def remove_cookie_value(keyname, session):
+        """
+        datestore write trumps cookie. If there is a cookie value
+        with this keyname, delete it so we don't have conflicting
+        entries.
+        """
+        if session.cookie_vals.has_key(keyname):
+            del(session.cookie_vals[keyname])
+            session.output_cookie["%s_data" % (session.cookie_name)] = \
+                simplejson.dumps(session.cookie_vals)
+            session._send_cookies()
+
+    @staticmethod
+    def set_content(sessdata, value):
+        """
+        Stores a value on a session data entity, as a reference if it is a
+        model and pickled otherwise.
+        """
         try:
             db.model_to_protobuf(value)
             if not value.is_saved():
@@ -389,9 +523,6 @@ class _DatastoreWriter(object):
         except:
             sessdata.content = pickle.dumps(value)
             sessdata.model = None
-            
-        session.cache[keyname] = value
-        return sessdata.put()
 
 
 class _CookieWriter(object):
@@ -417,7 +548,28 @@ class _CookieWriter(object):
         # so let it raise exceptions
         session.output_cookie["%s_data" % (session.cookie_name)] = \
             simplejson.dumps(session.cookie_vals)
-        print session.output_cookie.output()
+        session._send_cookies()
+        return True
+
+class _SignedCookieWriter(object):
+    def put(self, keyname, value, session):
+        """
+        Insert a keyname/value pair into the signed cookie for the session.
+
+        Args:
+            keyname: The keyname of the mapping.
+            value: The value of the mapping.
+
+        Returns True
+        """
+        keyname = session._validate_key(keyname)
+        if value is None:
+            raise ValueError(u"You must pass a value to put.")
+        # fail now, rather than when the cookie is sent
+        simplejson.dumps(value)
+        session.cookie_vals[keyname] = value
+        session.cache[keyname] = value
+        session._cookie_vals_changed()
         return True
 
 class Session(object):
@@ -427,7 +579,7 @@ class Session(object):
     Sessions can either be stored server side in the datastore/memcache, or
     be kept entirely as cookies. This is set either with the settings file
     or on initialization, using the writer argument/setting field. Valid
-    values are "datastore" or "cookie".
+    values are "datastore", "cookie" or "signed_cookie".
 
     Session can be used as a standard dictionary object.
         session = appengine_utilities.sessions.Session()
@@ -479,8 +631,29 @@ class Session(object):
 
         Note: There is no checksum validation of session data on this method,
         it's streamlined for pure performance. If you need to make sure data
-        is not tampered with, use the datastore writer which stores the data
-        server side.
+        is not tampered with, use the signed cookie writer, or the datastore
+        writer which stores the data server side.
+
+    Signed Cookie Writer:
+        Like the cookie writer, sessions are stored in the browser, but the
+        cookie is signed with HMAC-SHA1 and expires with the session, so it
+        can't be forged or replayed later. This makes it suitable for
+        holding who is logged in. Data is compressed when that makes it
+        smaller. Values must be JSON serializable.
+
+        Signing keys are kept in the datastore and read once per instance.
+        Bump SIGNED_COOKIE_KEY_VERSION to rotate the key; cookies signed with
+        the previous key are still accepted and are re-signed with the new
+        one.
+
+        The server keeps no record of these sessions, so it can't end one.
+        Each ends SIGNED_COOKIE_MAX_AGE seconds after it was created, even
+        while in use. Applications that need to log a user out everywhere
+        should store something in the session to check against their own
+        data, such as a per-user counter they bump on logout.
+
+        A session too large for a cookie (see SIGNED_COOKIE_MAX_SIZE) is
+        moved to the datastore writer, and carries on there.
 
     django-middleware:
         Included with the GAEUtilties project is a
@@ -494,18 +667,27 @@ class Session(object):
 
     # cookie name declaration for class methods
     COOKIE_NAME = settings.session["COOKIE_NAME"]
+    # Cookie keys must be byte strings, or Morsel.set fails
+    SIGNED_COOKIE_NAME = "%s_signed" % (COOKIE_NAME)
 
     def __init__(self, cookie_path=settings.session["DEFAULT_COOKIE_PATH"],
             cookie_name=settings.session["COOKIE_NAME"],
             session_expire_time=settings.session["SESSION_EXPIRE_TIME"],
             clean_check_percent=settings.session["CLEAN_CHECK_PERCENT"],
+            clean_in_request=settings.session["CLEAN_IN_REQUEST"],
             integrate_flash=settings.session["INTEGRATE_FLASH"],
             check_ip=settings.session["CHECK_IP"],
             check_user_agent=settings.session["CHECK_USER_AGENT"],
             set_cookie_expires=settings.session["SET_COOKIE_EXPIRES"],
             session_token_ttl=settings.session["SESSION_TOKEN_TTL"],
             last_activity_update=settings.session["UPDATE_LAST_ACTIVITY"],
-            writer=settings.session["WRITER"]):
+            writer=settings.session["WRITER"],
+            unit_of_work=settings.session["UNIT_OF_WORK"],
+            signed_tokens=settings.session["SIGNED_TOKENS"],
+            compress_cookie=settings.session["COMPRESS_SIGNED_COOKIE"],
+            signed_cookie_max_size=settings.session["SIGNED_COOKIE_MAX_SIZE"],
+            signed_cookie_max_age=settings.session["SIGNED_COOKIE_MAX_AGE"],
+            collect_headers=settings.session["COLLECT_HEADERS"]):
         """
         Initializer
 
@@ -515,6 +697,8 @@ class Session(object):
               session expires.
           clean_check_percent: The percentage of requests the will fire off a
               cleaning routine that deletes stale session data.
+          clean_in_request: If False, requests never run the cleaning
+              routine; use sweep_expired from a scheduled task instead.
           integrate_flash: If appengine-utilities flash utility should be
               integrated into the session object.
           check_ip: If browser IP should be used for session validation
@@ -524,6 +708,19 @@ class Session(object):
               it saves even if the browser is closed.
           session_token_ttl: Number of sessions a session token is valid
               for before it should be regenerated.
+          unit_of_work: If True, sets and deletes with the datastore writer
+              are buffered until commit() is called.
+          signed_tokens: If True, session tokens are HMAC signed and rotate
+              without being written to the datastore.
+          compress_cookie: If True, the signed cookie writer compresses
+              session data when that makes it smaller.
+          signed_cookie_max_size: The largest signed cookie the signed cookie
+              writer will send. Larger sessions are moved to the datastore.
+          signed_cookie_max_age: Seconds after it was created that a signed
+              cookie session ends, however often it is re-signed.
+          collect_headers: If True, headers aren't printed; call
+              write_headers() at the end of the request to add them to the
+              response.
         """
 
         self.cookie_path = cookie_path
@@ -536,12 +733,27 @@ class Session(object):
         self.session_token_ttl = session_token_ttl
         self.last_activity_update = last_activity_update
         self.writer = writer
+        self.unit_of_work = unit_of_work
+        self.signed_tokens = signed_tokens
+        self.compress_cookie = compress_cookie
+        self.signed_cookie_max_size = signed_cookie_max_size
+        self.signed_cookie_max_age = signed_cookie_max_age
+        # when the signed cookie session was created, kept when re-signing
+        self._signed_cookie_created = None
+        self.signed_cookie_name = "%s_signed" % (str(cookie_name))
+        self.collect_headers = collect_headers
+        # keynames set or deleted since the last commit in unit of work mode
+        self._dirty_keys = set()
+        self._deleted_keys = set()
+        # signed cookie values changed since the last commit
+        self._cookie_dirty = False
 
         # make sure the page is not cached in the browser
-        print self.no_cache_headers()
+        if not self.collect_headers:
+            print self.no_cache_headers()
         # Check the cookie and, if necessary, create a new one.
         self.cache = {}
-        string_cookie = os.environ.get(u"HTTP_COOKIE", u"")
+        string_cookie = os.environ.get(u"HTTP_COOKIE", "")
         self.cookie = Cookie.SimpleCookie()
         self.output_cookie = Cookie.SimpleCookie()
         self.cookie.load(string_cookie)
@@ -557,105 +769,376 @@ class Session(object):
                     self.cookie["%s_data" % (self.cookie_name)]
         except:
             self.cookie_vals = {}
-
+        if writer == "signed_cookie":
+            # unsigned cookie values can't be trusted
+            self.cache = {}
+            self.cookie_vals = {}
 
         if writer == "cookie":
             pass
-        else:
-            self.sid = None
-            new_session = True
-
-            # do_put is used to determine if a datastore write should
-            # happen on this request.
-            do_put = False
-
-            # check for existing cookie
-            if self.cookie.get(cookie_name):
-                self.sid = self.cookie[cookie_name].value
-                # The following will return None if the sid has expired.
-                self.session = _AppEngineUtilities_Session.get_session(self)
-                if self.session:
-                    new_session = False
-
-            if new_session:
-                # start a new session
-                self.session = _AppEngineUtilities_Session()
-                self.session.put()
-                self.sid = self.new_sid()
-                if u"HTTP_USER_AGENT" in os.environ:
-                    self.session.ua = os.environ[u"HTTP_USER_AGENT"]
-                else:
-                    self.session.ua = None
-                if u"REMOTE_ADDR" in os.environ:
-                    self.session.ip = os.environ["REMOTE_ADDR"]
-                else:
-                    self.session.ip = None
-                self.session.sid = [self.sid]
-                # do put() here to get the session key
-                self.session.put()
+        elif writer == "signed_cookie":
+            # sessions that outgrew the cookie carry on in the datastore
+            if self.cookie.get(cookie_name) and \
+                self._open_datastore_session(create=False):
+                self.writer = "datastore"
             else:
-                # check the age of the token to determine if a new one
-                # is required
-                duration = datetime.timedelta(seconds=self.session_token_ttl)
-                session_age_limit = datetime.datetime.now() - duration
-                if self.session.last_activity < session_age_limit:
-                    self.sid = self.new_sid()
-                    if len(self.session.sid) > 2:
-                        self.session.sid.remove(self.session.sid[0])
-                    self.session.sid.append(self.sid)
-                    do_put = True
-                else:
-                    self.sid = self.session.sid[-1]
-                    # check if last_activity needs updated
-                    ula = datetime.timedelta(seconds=self.last_activity_update)
-                    if datetime.datetime.now() > self.session.last_activity + \
-                        ula:
-                        do_put = True
-
-            self.output_cookie[cookie_name] = self.sid
-            self.output_cookie[cookie_name]["path"] = cookie_path
-            if self.set_cookie_expires:
-                self.output_cookie[cookie_name]["expires"] = \
-                    self.session_expire_time
-
-            self.cache[u"sid"] = self.sid
-
-            if do_put:
-                if self.sid != None or self.sid != u"":
-                    self.session.put()
+                if self.cookie.get(cookie_name):
+                    # expire the stale token so it isn't looked up again
+                    self.output_cookie[cookie_name] = u""
+                    self.output_cookie[cookie_name]["path"] = cookie_path
+                    self.output_cookie[cookie_name]["expires"] = 0
+                self._load_signed_cookie()
+        else:
+            self._open_datastore_session()
 
         if self.set_cookie_expires:
             if not self.output_cookie.has_key("%s_data" % (cookie_name)):
                 self.output_cookie["%s_data" % (cookie_name)] = u""
             self.output_cookie["%s_data" % (cookie_name)]["expires"] = \
                 self.session_expire_time
-        print self.output_cookie.output()
+        self._send_cookies()
 
         # fire up a Flash object if integration is enabled
         if self.integrate_flash:
             import flash
-            self.flash = flash.Flash(cookie=self.cookie)
+            self.flash = flash.Flash(cookie=self.cookie,
+                collect_headers=self.collect_headers)
 
         # randomly delete old stale sessions in the datastore (see
         # CLEAN_CHECK_PERCENT variable)
-        if random.randint(1, 100) < clean_check_percent:
-            self._clean_old_sessions() 
+        if clean_in_request and random.randint(1, 100) < clean_check_percent:
+            self._clean_old_sessions()
+
+    def _sign_cookie(self, version, message):
+        """
+        private method
+
+        Returns the signature of a signed cookie message, made with the
+        given version of the cookie signing key.
+        """
+        return hmac.new(_get_signing_key(u"session-cookie-%d" % version),
+            message, hashlib.sha1).hexdigest()
+
+    def _encode_signed_cookie(self, data):
+        """
+        private method
 
-    def new_sid(self):
+        Encodes session data as a signed cookie value. The value holds the
+        signing key version, the time the session was created, the time the
+        value was issued, the JSON encoded and possibly compressed data, and
+        the signature of all four. Re-signing keeps the creation time.
+
+        Returns the cookie value as a unicode string.
+        """
+        payload = simplejson.dumps(data, separators=(",", ":"))
+        flag = u"j"
+        if self.compress_cookie:
+            compressed = zlib.compress(payload)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flag = u"z"
+        payload = flag + base64.urlsafe_b64encode(payload).rstrip("=")
+        now = int(time.time())
+        if self._signed_cookie_created is None:
+            self._signed_cookie_created = now
+        message = u"%d.%d.%d.%s" % (SIGNED_COOKIE_KEY_VERSION,
+            self._signed_cookie_created, now, payload)
+        return u"%s.%s" % (message,
+            self._sign_cookie(SIGNED_COOKIE_KEY_VERSION, message))
+
+    def _decode_signed_cookie(self, value):
+        """
+        private method
+
+        Decodes a signed cookie value. Values signed with the current or
+        the previous signing key are accepted, so rotating the key doesn't
+        end sessions. Values idle for longer than session_expire_time, or
+        created more than signed_cookie_max_age ago, have expired.
+
+        Returns a (version, created, issued, data) tuple, or None if the
+        value is invalid, tampered with or expired.
+        """
+        try:
+            version, created, issued, payload, signature = value.split(u".")
+            version = int(version)
+            created = int(created)
+            issued = int(issued)
+        except ValueError:
+            return None
+        if not SIGNED_COOKIE_KEY_VERSION - 1 <= version <= \
+            SIGNED_COOKIE_KEY_VERSION:
+            return None
+        message = u"%d.%d.%d.%s" % (version, created, issued, payload)
+        if not _constant_time_equals(str(signature),
+            self._sign_cookie(version, message)):
+            return None
+        now = time.time()
+        if issued + self.session_expire_time < now or \
+            created + self.signed_cookie_max_age < now:
+            return None
+        try:
+            data = str(payload[1:])
+            data = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+            if payload[0] == u"z":
+                data = zlib.decompress(data)
+            return version, created, issued, simplejson.loads(data)
+        except:
+            return None
+
+    def _load_signed_cookie(self):
+        """
+        private method
+
+        Loads the session data from the signed cookie. The cookie is sent
+        again if it was signed with an old key or needs its expiry pushed
+        back.
+        """
+        if not self.cookie.get(self.signed_cookie_name):
+            return
+        decoded = self._decode_signed_cookie(
+            self.cookie[self.signed_cookie_name].value)
+        if decoded is None:
+            return
+        version, created, issued, data = decoded
+        self._signed_cookie_created = created
+        self.cookie_vals = data
+        self.cache.update(data)
+        if version != SIGNED_COOKIE_KEY_VERSION or \
+            issued + self.last_activity_update < time.time():
+            self._cookie_vals_changed()
+
+    def _save_cookie_vals(self):
+        """
+        private method
+
+        Sends the cookie values to the browser. With the signed cookie
+        writer, sessions too large for a cookie are moved to the datastore.
+        """
+        if self.writer != "signed_cookie":
+            self.output_cookie["%s_data" % (self.cookie_name)] = \
+                simplejson.dumps(self.cookie_vals)
+            self._send_cookies()
+            return
+        value = self._encode_signed_cookie(self.cookie_vals)
+        if len(value) > self.signed_cookie_max_size:
+            self._move_to_datastore()
+            return
+        self.output_cookie[self.signed_cookie_name] = value
+        self.output_cookie[self.signed_cookie_name]["path"] = self.cookie_path
+        if self.set_cookie_expires:
+            self.output_cookie[self.signed_cookie_name]["expires"] = \
+                self.session_expire_time
+        self._send_cookies()
+
+    def _cookie_vals_changed(self):
+        """
+        private method
+
+        Sends the changed cookie values, or with the signed cookie writer in
+        unit of work mode, leaves them for commit() to send.
+        """
+        if self.writer == "signed_cookie" and self.unit_of_work:
+            self._cookie_dirty = True
+        else:
+            self._save_cookie_vals()
+
+    def _move_to_datastore(self):
+        """
+        private method
+
+        Moves a signed cookie session that has outgrown the cookie into a
+        new datastore session, and expires the signed cookie.
+        """
+        values = self.cookie_vals
+        self.cookie_vals = {}
+        self._cookie_dirty = False
+        self.writer = u"datastore"
+        self._open_datastore_session()
+        for keyname in values:
+            self._put(keyname, values[keyname])
+        self.output_cookie[self.signed_cookie_name] = u""
+        self.output_cookie[self.signed_cookie_name]["path"] = self.cookie_path
+        self.output_cookie[self.signed_cookie_name]["expires"] = 0
+        self._send_cookies()
+
+    def _open_datastore_session(self, create=True):
+        """
+        private method
+
+        Loads the datastore session named by the session cookie, starting a
+        new one if there isn't a valid one, and sets the session cookie.
+
+        Args:
+            create: If False, no new session is started.
+
+        Returns True if a session was opened.
+        """
+        self.sid = None
+        new_session = True
+
+        # do_put is used to determine if a datastore write should
+        # happen on this request.
+        do_put = False
+        # cache_put is used for changes that only go to memcache.
+        cache_put = False
+
+        # check for existing cookie
+        if self.cookie.get(self.cookie_name):
+            self.sid = self.cookie[self.cookie_name].value
+            # The following will return None if the sid has expired.
+            session = _AppEngineUtilities_Session.get_session(self)
+            if session:
+                self.session = session
+                new_session = False
+
+        if new_session:
+            if not create:
+                self.sid = None
+                return False
+            # start a new session
+            self.session = _AppEngineUtilities_Session()
+            self.session.token_window = self._token_window()
+            self.session.create_key()
+            self.sid = self.new_sid()
+            if u"HTTP_USER_AGENT" in os.environ:
+                self.session.ua = os.environ[u"HTTP_USER_AGENT"]
+            else:
+                self.session.ua = None
+            if u"REMOTE_ADDR" in os.environ:
+                self.session.ip = os.environ["REMOTE_ADDR"]
+            else:
+                self.session.ip = None
+            self.session.sid = [self.sid]
+            self.session.put()
+        elif self.signed_tokens:
+            # tokens rotate with the time window, and the newest window
+            # issued is only kept in memcache until the next write
+            window = self._token_window()
+            if self.session.token_window is None or \
+                self.session.token_window < window:
+                self.session.token_window = window
+                cache_put = True
+            self.sid = self.new_sid(self.session.token_window)
+            ula = datetime.timedelta(seconds=self.last_activity_update)
+            if datetime.datetime.now() > self.session.last_activity + \
+                ula:
+                do_put = True
+        else:
+            # check the age of the token to determine if a new one
+            # is required
+            duration = datetime.timedelta(seconds=self.session_token_ttl)
+            session_age_limit = datetime.datetime.now() - duration
+            if self.session.last_activity < session_age_limit:
+                self.sid = self.new_sid()
+                if len(self.session.sid) > 2:
+                    self.session.sid.remove(self.session.sid[0])
+                self.session.sid.append(self.sid)
+                do_put = True
+            else:
+                self.sid = self.session.sid[-1]
+                # check if last_activity needs updated
+                ula = datetime.timedelta(seconds=self.last_activity_update)
+                if datetime.datetime.now() > self.session.last_activity + \
+                    ula:
+                    do_put = True
+
+        self.output_cookie[self.cookie_name] = self.sid
+        self.output_cookie[self.cookie_name]["path"] = self.cookie_path
+        if self.set_cookie_expires:
+            self.output_cookie[self.cookie_name]["expires"] = \
+                self.session_expire_time
+
+        self.cache[u"sid"] = self.sid
+
+        if do_put:
+            if self.sid != None or self.sid != u"":
+                self.session.put()
+        elif cache_put:
+            self.session.put_memcache()
+        return True
+
+    def new_sid(self, window=None):
         """
         Create a new session id.
 
+        Args:
+            window: For signed tokens, the time window to issue the token
+                for. Defaults to the current one.
+
         Returns session id as a unicode string.
         """
-        sid = u"%s_%s" % (self.session.session_key,
-            hashlib.md5(repr(time.time()) + \
-            unicode(random.random())).hexdigest()
-        )
-        #sid = unicode(self.session.session_key) + "_" + \
-        #        hashlib.md5(repr(time.time()) + \
-        #        unicode(random.random())).hexdigest()
+        if self.signed_tokens:
+            if window is None:
+                window = self._token_window()
+            return u"%r_%d_%s" % (self.session.session_key, window,
+                self._sign_token(self.session, window))
+        sid = u"%s_%s" % (_session_key_string(self.session.session_key),
+            binascii.hexlify(os.urandom(16)))
         return sid
 
+    def _token_window(self):
+        """
+        private method
+
+        Returns the current signed token window. A new window starts every
+        session_token_ttl seconds.
+        """
+        return int(time.time() / self.session_token_ttl)
+
+    def _sign_token(self, session, window):
+        """
+        private method
+
+        Returns the signature of a token for the session and window.
+        """
+        message = u"%r:%d:%d" % (session.session_key, window,
+            session.token_generation or 0)
+        return hmac.new(_get_signing_key(u"session-token"), message,
+            hashlib.sha1).hexdigest()
+
+    def parse_signed_sid(self):
+        """
+        Splits a signed session id into its parts.
+
+        Returns a (session_key, window, signature) tuple, or None if signed
+        tokens are off or the session id isn't a signed token.
+        """
+        if not self.signed_tokens or self.sid is None:
+            return None
+        try:
+            session_key, window, signature = self.sid.split(u"_")
+            session_key = float(session_key)
+            window = int(window)
+        except ValueError:
+            return None
+        # float() also accepts "nan" and "inf", which no session has as its
+        # key; subtracting either from itself gives nan, never 0
+        if session_key - session_key != 0:
+            return None
+        return session_key, window, signature
+
+    def is_valid_sid(self, session):
+        """
+        Checks the session id against a session. Stored tokens must be one
+        of the session's last three. Signed tokens must carry a valid
+        signature and be from the newest window issued or the two before
+        it, so they're good for the same 15 seconds by default.
+
+        Tokens issued before signed tokens were turned on are still
+        accepted, so existing sessions carry over.
+
+        Returns True/False
+        """
+        signed = self.parse_signed_sid()
+        if signed is None:
+            return self.sid in session.sid
+        session_key, window, signature = signed
+        newest = session.token_window or 0
+        if not newest - 2 <= window <= self._token_window():
+            return False
+        return _constant_time_equals(str(signature),
+            self._sign_token(session, window))
+
     def _get(self, keyname=None):
         """
         private method
@@ -708,11 +1191,81 @@ class Session(object):
         """
         if self.writer == "datastore":
             writer = _DatastoreWriter()
+        elif self.writer == "signed_cookie":
+            writer = _SignedCookieWriter()
         else:
             writer = _CookieWriter()
 
         return writer.put(keyname, value, self)
 
+    def _buffering(self):
+        """
+        private method
+
+        Returns True if writes are being buffered until commit().
+        """
+        return self.unit_of_work and self.writer == "datastore"
+
+    def commit(self):
+        """
+        Writes the sets and deletes buffered in unit of work mode, using one
+        datastore put, one datastore delete and one memcache update. Does
+        nothing when nothing has changed.
+
+        Returns True if anything was written.
+        """
+        wrote = False
+        if self._cookie_dirty:
+            self._cookie_dirty = False
+            self._save_cookie_vals()
+            wrote = True
+        if not self._dirty_keys and not self._deleted_keys:
+            return wrote
+        items = self.session._get_items_dict()
+        to_put = []
+        for keyname in self._dirty_keys:
+            sessdata = items.get(keyname)
+            if sessdata is None:
+                sessdata = _AppEngineUtilities_SessionData()
+                sessdata.session_key = self.session.session_key
+                sessdata.keyname = keyname
+            _DatastoreWriter.set_content(sessdata, self.cache[keyname])
+            sessdata.deleted = False
+            to_put.append(sessdata)
+        to_delete = []
+        for keyname in self._deleted_keys:
+            if keyname in items:
+                to_delete.append(items[keyname])
+        self._dirty_keys = set()
+        self._deleted_keys = set()
+
+        if to_put:
+            try:
+                db.put(to_put)
+                for sessdata in to_put:
+                    sessdata.dirty = False
+            except:
+                for sessdata in to_put:
+                    sessdata.dirty = True
+        if to_delete:
+            try:
+                db.delete(to_delete)
+            except:
+                # keep them marked so a later request retries the delete
+                for sessdata in to_delete:
+                    sessdata.deleted = True
+
+        def update(items):
+            for sessdata in to_put:
+                items[sessdata.keyname] = sessdata
+            for sessdata in to_delete:
+                if sessdata.deleted == True:
+                    items[sessdata.keyname] = sessdata
+                else:
+                    items.pop(sessdata.keyname, None)
+        _update_session_data_cache(self.session.session_key, update)
+        return True
+
     def _delete_session(self):
         """
         private method
@@ -721,19 +1274,19 @@ class Session(object):
 
         Returns True.
         """
+        self._dirty_keys = set()
+        self._deleted_keys = set()
         # if the event class has been loaded, fire off the preSessionDelete event
-        if u"AEU_Events" in __main__.__dict__:
-            __main__.AEU_Events.fire_event(u"preSessionDelete")
+        _events.fire_event(u"preSessionDelete")
         if hasattr(self, u"session"):
             self.session.delete()
         self.cookie_vals = {}
         self.cache = {}
-        self.output_cookie["%s_data" % (self.cookie_name)] = \
-            simplejson.dumps(self.cookie_vals)
-        print self.output_cookie.output()
+        # the next signed cookie starts a new session
+        self._signed_cookie_created = None
+        self._cookie_vals_changed()
         # if the event class has been loaded, fire off the sessionDelete event
-        if u"AEU_Events" in __main__.__dict__:
-            __main__.AEU_Events.fire_event(u"sessionDelete")
+        _events.fire_event(u"sessionDelete")
         return True
 
     def delete(self):
@@ -750,28 +1303,129 @@ class Session(object):
     @classmethod
     def delete_all_sessions(cls):
         """
-        Deletes all sessions and session data from the data store. This
-        does not delete the entities from memcache (yet). Depending on the
-        amount of sessions active in your datastore, this request could
-        timeout before completion and may have to be called multiple times.
+        Deletes all sessions and session data from the datastore and
+        memcache. Depending on the amount of sessions active in your
+        datastore, this request could timeout before completion; in that
+        case run delete_sessions_batch from a task queue instead.
 
         NOTE: This can not delete cookie only sessions as it has no way to
         access them. It will only delete datastore writer sessions.
 
         Returns True on completion.
         """
-        all_sessions_deleted = False
+        cursor = cls.delete_sessions_batch()
+        while cursor:
+            cursor = cls.delete_sessions_batch(cursor=cursor)
+        return True
+
+    @classmethod
+    def delete_sessions_batch(cls, cursor=None, batch_size=MAX_DELETE_BATCH):
+        """
+        Deletes one batch of sessions or, once all sessions are gone, one
+        batch of session data. Each call is a single query and datastore
+        delete, so it can be run from a task queue, passing the returned
+        cursor on to the next task.
+
+        Sessions are fetched whole, as their session_key is needed to remove
+        them from memcache; session data is found with keys only queries.
+
+        Args:
+            cursor: The cursor returned by the previous call.
+            batch_size: The number of entities to delete, at most 500.
 
-        while not all_sessions_deleted:
+        Returns a cursor to pass to the next call, or None when done.
+        """
+        phase, query_cursor = u"session", None
+        if cursor:
+            phase, query_cursor = cursor.split(u":", 1)
+        if phase == u"session":
             query = _AppEngineUtilities_Session.all()
-            results = query.fetch(75)
-            if len(results) is 0:
-                all_sessions_deleted = True
-            else:
-                for result in results:
-                    result.delete()
-        return True
+        else:
+            query = _AppEngineUtilities_SessionData.all(keys_only=True)
+        if query_cursor:
+            query.with_cursor(query_cursor)
+        results = query.fetch(batch_size)
+        if phase == u"session":
+            memcache_keys = []
+            for result in results:
+                memcache_keys.extend([_session_cache_key(result.session_key),
+                    _session_data_cache_key(result.session_key)])
+            memcache.delete_multi(memcache_keys)
+            results = [result.key() for result in results]
+        _delete_in_batches(results)
+        if len(results) == batch_size:
+            return u"%s:%s" % (phase, query.cursor())
+        if phase == u"session":
+            return u"data:"
+        return None
 
+    @classmethod
+    def sweep_expired(cls, cursor=None, batch_size=50,
+            session_expire_time=settings.session["SESSION_EXPIRE_TIME"]):
+        """
+        Deletes one batch of expired sessions, along with their session data.
+        Meant to be run from a scheduled task rather than during requests.
+
+        Args:
+            cursor: The cursor returned by the previous call.
+            batch_size: The number of sessions to delete.
+            session_expire_time: Sessions idle for longer than this many
+                seconds are deleted.
+
+        Returns a cursor to pass to the next call, or None when done.
+        """
+        duration = datetime.timedelta(seconds=session_expire_time)
+        query = _AppEngineUtilities_Session.all()
+        query.filter(u"last_activity <", datetime.datetime.now() - duration)
+        if cursor:
+            query.with_cursor(cursor)
+        results = query.fetch(batch_size)
+        keys = []
+        memcache_keys = []
+        for result in results:
+            keys.append(result.key())
+            data_query = _AppEngineUtilities_SessionData.all(keys_only=True)
+            data_query.filter(u"session_key", result.session_key)
+            keys.extend(data_query.fetch(1000))
+            memcache_keys.extend([
+                _session_cache_key(result.session_key),
+                _session_data_cache_key(result.session_key)])
+        _delete_in_batches(keys)
+        memcache.delete_multi(memcache_keys)
+        if len(results) < batch_size:
+            return None
+        return query.cursor()
+
+    @classmethod
+    def sweep_orphaned_data(cls, cursor=None, batch_size=100):
+        """
+        Deletes session data left behind by sessions that no longer exist,
+        looking at one batch of session data per call. Meant to be run from
+        a scheduled task rather than during requests.
+
+        Args:
+            cursor: The cursor returned by the previous call.
+            batch_size: The number of session data entities to check.
+
+        Returns a cursor to pass to the next call, or None when done.
+        """
+        query = _AppEngineUtilities_SessionData.all()
+        if cursor:
+            query.with_cursor(cursor)
+        results = query.fetch(batch_size)
+        exists = {}
+        orphans = []
+        for result in results:
+            if result.session_key not in exists:
+                session_query = _AppEngineUtilities_Session.all(keys_only=True)
+                session_query.filter(u"session_key", result.session_key)
+                exists[result.session_key] = session_query.get() is not None
+            if not exists[result.session_key]:
+                orphans.append(result.key())
+        _delete_in_batches(orphans)
+        if len(results) < batch_size:
+            return None
+        return query.cursor()
 
     def _clean_old_sessions(self):
         """
@@ -797,6 +1451,15 @@ class Session(object):
 
         Returns new token.
         """
+        if self.signed_tokens:
+            # outstanding signed tokens can't be listed, so they're all
+            # invalidated instead
+            self.session.token_generation = \
+                (self.session.token_generation or 0) + 1
+            self.session.token_window = self._token_window()
+            self.sid = self.new_sid()
+            self.session.put()
+            return self.sid
         self.sid = self.new_sid()
         if len(self.session.sid) > 2:
             self.session.sid.remove(self.session.sid[0])
@@ -814,6 +1477,34 @@ class Session(object):
         self.__init__()
         return True
 
+    def _send_cookies(self):
+        """
+        private method
+
+        Prints the session cookies, unless headers are being collected, in
+        which case write_headers() sends each of them once.
+        """
+        if not self.collect_headers:
+            print self.output_cookie.output()
+
+    def write_headers(self, response):
+        """
+        Adds the no cache headers and the session and flash cookies to a
+        response. Used when headers are collected rather than printed, once
+        the request's session changes are done.
+
+        Args:
+            response: The webapp Response to add the headers to.
+        """
+        for name, value in NO_CACHE_HEADERS:
+            response.headers[name] = value
+        response.headers["Last-Modified"] = \
+            strftime("%a, %d %b %y %H:%M:%S %Z")
+        for morsel in self.output_cookie.values():
+            response.headers.add_header("Set-Cookie", morsel.OutputString())
+        if self.integrate_flash:
+            self.flash.write_headers(response)
+
     def no_cache_headers(self):
         """
         Generates headers to avoid any page caching in the browser.
@@ -836,17 +1527,16 @@ class Session(object):
 
         Returns True
         """
-        sessiondata = self._get()
         # delete from datastore
-        if sessiondata is not None:
-            for sd in sessiondata:
-                sd.delete()
+        if hasattr(self, u"session"):
+            sessiondata = self._get()
+            if sessiondata is not None:
+                for sd in sessiondata:
+                    sd.delete()
         # delete from memcache
         self.cache = {}
         self.cookie_vals = {}
-        self.output_cookie["%s_data" %s (self.cookie_name)] = \
-            simplejson.dumps(self.cookie_vals)
-        print self.output_cookie.output()
+        self._cookie_vals_changed()
         return True
 
     def has_key(self, keyname):
@@ -957,12 +1647,18 @@ class Session(object):
         Returns True/False
         """
 
-        string_cookie = os.environ.get(u"HTTP_COOKIE", u"")
+        string_cookie = os.environ.get(u"HTTP_COOKIE", "")
         cookie = Cookie.SimpleCookie()
         cookie.load(string_cookie)
         if cookie.has_key(cookie_name):
             query = _AppEngineUtilities_Session.all()
-            query.filter(u"sid", cookie[cookie_name].value)
+            token = cookie[cookie_name].value
+            try:
+                # signed tokens aren't stored, so look up their session
+                session_key, window, signature = token.split(u"_")
+                query.filter(u"session_key", float(session_key))
+            except ValueError:
+                query.filter(u"sid", token)
             results = query.fetch(1)
             if len(results) > 0:
                 return True
@@ -996,6 +1692,8 @@ class Session(object):
 
         if self.integrate_flash and (keyname == u"flash"):
             return self.flash.msg
+        if keyname in self._deleted_keys:
+            raise KeyError(unicode(keyname))
         if keyname in self.cache:
             return self.cache[keyname]
         if keyname in self.cookie_vals:
@@ -1033,6 +1731,14 @@ class Session(object):
             self.flash.msg = value
         else:
             keyname = self._validate_key(keyname)
+            if self._buffering():
+                if value is None:
+                    raise ValueError(u"You must pass a value to put.")
+                _DatastoreWriter.remove_cookie_value(keyname, self)
+                self.cache[keyname] = value
+                self._deleted_keys.discard(keyname)
+                self._dirty_keys.add(keyname)
+                return True
             self.cache[keyname] = value
             return self._put(keyname, value)
 
@@ -1063,8 +1769,18 @@ class Session(object):
         Args:
             keyname: The keyname of the object to delete.
         """
+        if self._buffering() and keyname not in self.cookie_vals:
+            if keyname not in self:
+                raise KeyError(unicode(keyname))
+            self._dirty_keys.discard(keyname)
+            self._deleted_keys.add(keyname)
+            self.cache.pop(keyname, None)
+            return
         bad_key = False
-        sessdata = self._get(keyname = keyname)
+        sessdata = None
+        # signed cookie sessions have no datastore session to delete from
+        if hasattr(self, u"session"):
+            sessdata = self._get(keyname = keyname)
         if sessdata is None:
             bad_key = True
         else:
@@ -1072,9 +1788,7 @@ class Session(object):
         if keyname in self.cookie_vals:
             del self.cookie_vals[keyname]
             bad_key = False
-            self.output_cookie["%s_data" % (self.cookie_name)] = \
-                simplejson.dumps(self.cookie_vals)
-            print self.output_cookie.output()
+            self._cookie_vals_changed()
         if bad_key:
             raise KeyError(unicode(keyname))
         if keyname in self.cache:
@@ -1115,7 +1829,11 @@ class Session(object):
             vals = self._get()
             if vals is not None:
                 for k in vals:
-                    yield k.keyname
+                    if k.keyname not in self._deleted_keys and \
+                        k.keyname not in self._dirty_keys:
+                        yield k.keyname
+            for k in self._dirty_keys:
+                yield k
         for k in self.cookie_vals:
             yield k
 
@@ -39,13 +39,33 @@ session = {
     "SET_COOKIE_EXPIRES": True,     # Set to True to add expiration field to
                                     # cookie
     "WRITER":"datastore",           # Use the datastore writer by default. 
-                                    # cookie is the other option.
+                                    # cookie and signed_cookie are the other
+                                    # options.
+    "COMPRESS_SIGNED_COOKIE": True, # compress signed_cookie writer data when
+                                    # that makes it smaller
+    "SIGNED_COOKIE_MAX_SIZE": 3800, # signed_cookie writer sessions larger
+                                    # than this move to the datastore
+    "SIGNED_COOKIE_KEY_VERSION": 1, # bump to rotate the signed cookie key
+    "SIGNED_COOKIE_MAX_AGE": 86400, # signed_cookie writer sessions end this
+                                    # many seconds after they were created,
+                                    # however active they are
+    "COLLECT_HEADERS": False,       # Set to True to add headers to the
+                                    # response with Session.write_headers()
+                                    # instead of printing them
+    "UNIT_OF_WORK": False,          # Set to True to buffer datastore writer
+                                    # sets and deletes until Session.commit()
     "CLEAN_CHECK_PERCENT": 50,      # By default, 50% of all requests will clean
                                     # the datastore of expired sessions
+    "CLEAN_IN_REQUEST": False,      # Set to True to clean expired sessions
+                                    # during requests (see
+                                    # CLEAN_CHECK_PERCENT). Leave False when
+                                    # Session.sweep_expired runs from cron.
     "CHECK_IP": True,               # validate sessions by IP
     "CHECK_USER_AGENT": True,       # validate sessions by user agent
     "SESSION_TOKEN_TTL": 5,         # Number of seconds a session token is valid
                                     # for.
+    "SIGNED_TOKENS": False,         # Set to True to use HMAC signed tokens,
+                                    # which rotate without datastore writes
     "UPDATE_LAST_ACTIVITY": 60,     # Number of seconds that may pass before
                                     # last_activity is updated
 }
@@ -55,6 +75,22 @@ cache = {
     "DEFAULT_TIMEOUT": 3600, # cache expires after one hour (3600 sec)
     "CLEAN_CHECK_PERCENT": 50, # 50% of all requests will clean the database
     "MAX_HITS_TO_CLEAN": 20, # the maximum number of cache hits to clean
+    "LOCAL_CACHE_SIZE": 0, # number of values to keep in an in-instance LRU
+                           # in front of memcache, 0 to turn it off
+    "LOCAL_CACHE_BYTES": 1048576, # most bytes of pickled values to keep
+                                  # in the in-instance LRU, 0 for no limit
+    "LOCAL_CACHE_TTL": 10, # longest time in seconds a value stays in the
+                           # in-instance LRU without rereading memcache
+    "CLEAN_IN_REQUEST": False, # Set to True to clean expired entries during
+                               # requests. Leave False when
+                               # Cache.sweep_expired runs from cron.
+    "STALE_GRACE_SECONDS": 300, # how long get_or_compute may serve an
+                                # expired value while another request
+                                # recomputes it
+    "COMPUTE_LEASE_SECONDS": 30, # how long a get_or_compute recompute holds
+                                 # its lease before others may try
+    "EARLY_REFRESH_BETA": 1.0, # how eagerly get_or_compute refreshes values
+                               # before they expire, 0 to turn it off
 }
 
 # Configuration settings for the flash class
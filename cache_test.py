@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""Unittest for appengine_utilities/cache.py"""
+
+import datetime
+import pickle
+import time
+import unittest
+
+from google.appengine.api import memcache
+
+from appengine_utilities import cache
+import rpc_util
+import test_util
+
+
+class CacheTestBase(test_util.AppEngineTestBase):
+
+    LOCAL_CACHE_SIZE = 100
+
+    def setUp(self):
+        test_util.AppEngineTestBase.setUp(self)
+        self.max_size = cache._local_cache.max_size
+        cache._local_cache.max_size = self.LOCAL_CACHE_SIZE
+        cache.Cache.clear_local()
+        self.cache = cache.Cache()
+
+    def tearDown(self):
+        cache._local_cache.max_size = self.max_size
+        cache.Cache.clear_local()
+
+
+class LocalTierTest(CacheTestBase):
+
+    def testWarmReadsMakeNoRpcs(self):
+        self.cache['sidebar'] = ['Home', 'Members']
+        counter = rpc_util.RpcCounter()
+        self.assertEquals(['Home', 'Members'], self.cache['sidebar'])
+        self.assertEquals(0, counter.Count())
+
+    def testReadThrough(self):
+        self.cache['directory'] = [1, 2, 3]
+        cache._local_cache.clear()
+        self.assertEquals([1, 2, 3], self.cache['directory'])
+        memcache.flush_all()
+        cache._local_cache.clear()
+        self.assertEquals([1, 2, 3], self.cache['directory'])
+
+        counter = rpc_util.RpcCounter()
+        self.assertEquals([1, 2, 3], self.cache['directory'])
+        self.assertEquals(0, counter.Count())
+
+    def testLocalCopyExpiresWithEntry(self):
+        self.cache.set('get', 1, 2)
+        self.cache.set('get_many', 1, 2)
+        cache._local_cache.clear()
+        # Both are read from memcache, so the local tier must learn when
+        # they expire from there.
+        self.cache.get('get')
+        self.cache.get_many(['get_many'])
+        orig_time = time.time
+        time.time = lambda: orig_time() + 5
+        try:
+            self.assertEquals(None, cache._local_cache.get('get'))
+            self.assertEquals(None, cache._local_cache.get('get_many'))
+        finally:
+            time.time = orig_time
+
+    def testValuesAreCopies(self):
+        self.cache['list'] = [1]
+        self.cache['list'].append(2)
+        self.assertEquals([1], self.cache['list'])
+
+    def testDelete(self):
+        self.cache['key'] = 'value'
+        del self.cache['key']
+        self.failIf('key' in self.cache)
+
+    def testFalseValues(self):
+        self.cache['zero'] = 0
+        cache._local_cache.clear()
+        self.assertEquals(0, self.cache['zero'])
+
+    def testStats(self):
+        self.cache['key'] = 'value'
+        cache.Cache.clear_local()
+        self.cache['key']
+        self.cache['key']
+        self.assertRaises(KeyError, self.cache.get, 'missing')
+
+        stats = cache.Cache.get_stats()
+        self.assertEquals(1, stats['local_hits'])
+        self.assertEquals(1, stats['memcache_hits'])
+        self.assertEquals(0, stats['datastore_hits'])
+        self.assertEquals(1, stats['misses'])
+        self.assertAlmostEquals(1.0 / 3, stats['local_ratio'])
+        self.assertAlmostEquals(0.5, stats['memcache_ratio'])
+        self.assertAlmostEquals(0.0, stats['datastore_ratio'])
+
+
+class ManyTest(CacheTestBase):
+
+    LOCAL_CACHE_SIZE = 0
+
+    def testGetMany(self):
+        self.cache.set_many({'a': 1, 'b': 0, 'c': [3]})
+        memcache.delete('%sc' % cache.MEMCACHE_PREFIX)
+
+        counter = rpc_util.RpcCounter()
+        self.assertEquals({'a': 1, 'b': 0, 'c': [3]},
+                          self.cache.get_many(['a', 'b', 'c', 'missing']))
+        counts = counter.Counts()
+        self.assertEquals(1, counts['memcache.Get'])
+        self.assertEquals(1, counts['memcache.Set'])
+        self.assertEquals({'datastore_v3.Get': 1}, dict(
+            [(name, count) for name, count in counts.iteritems()
+             if name.startswith('datastore_v3')]))
+
+        counter = rpc_util.RpcCounter()
+        self.assertEquals({'c': [3]}, self.cache.get_many(['c']))
+        self.assertEquals(0, counter.Count('datastore_v3'))
+
+    def testKeysMatchGet(self):
+        self.cache['a'] = 'str'
+        self.cache[u'\u00e9'] = 'unicode'
+        self.cache.set_many({'b': 'str', u'\u00e8': 'unicode'})
+        keys = ['a', 'b', u'\u00e9', u'\u00e8']
+        for key in keys:
+            self.assertEquals(self.cache.get(key),
+                              self.cache.get_many([key])[key])
+        # Like get, a key that can't have been set is a miss.
+        self.assertRaises(KeyError, self.cache.get, 1)
+        self.assertEquals({}, self.cache.get_many([1]))
+
+        counter = rpc_util.RpcCounter()
+        self.assertEquals(4, len(self.cache.get_many(keys)))
+        self.assertEquals({'memcache.Get': 1}, counter.Counts())
+        memcache.flush_all()
+        self.assertEquals(4, len(self.cache.get_many(keys)))
+        self.assertEquals(4, len(self.cache.get_many(keys)))
+        self.assertEquals(1, counter.Count('datastore_v3'))
+
+    def testBatchRpcsDoNotGrow(self):
+        for size in (10, 100, 1000):
+            keys = ['key%d' % i for i in range(size)]
+            self.cache.set_many(dict([(key, key) for key in keys]))
+
+            counter = rpc_util.RpcCounter()
+            for key in keys:
+                self.cache.get(key)
+            self.assertEquals(size, counter.Count())
+
+            counter = rpc_util.RpcCounter()
+            self.cache.get_many(keys)
+            self.assertEquals({'memcache.Get': 1}, counter.Counts())
+
+            memcache.flush_all()
+            counter = rpc_util.RpcCounter()
+            self.assertEquals(size, len(self.cache.get_many(keys)))
+            counts = counter.Counts()
+            self.assertEquals(1, counts['memcache.Get'])
+            self.assertEquals(1, counts['memcache.Set'])
+            # The SDK splits a large db.get into several RPCs.
+            self.assertTrue(counts['datastore_v3.Get'] <= size / 10)
+
+    def testSetManyOverwrites(self):
+        self.cache['a'] = 1
+        self.cache.set_many({'a': 2, 'b': 3})
+        self.assertEquals(2, cache._AppEngineUtilities_Cache.all().count())
+        memcache.flush_all()
+        self.assertEquals({'a': 2, 'b': 3}, self.cache.get_many(['a', 'b']))
+
+    def testDeleteMany(self):
+        self.cache.set_many({'a': 1, 'b': 2, 'c': 3})
+        self.cache.delete_many(['a', 'b'])
+        self.assertEquals({'c': 3}, self.cache.get_many(['a', 'b', 'c']))
+        self.assertEquals(1, cache._AppEngineUtilities_Cache.all().count())
+
+
+class KeyNameTest(CacheTestBase):
+
+    LOCAL_CACHE_SIZE = 0
+
+    def testReadsAreGets(self):
+        self.cache['a'] = 1
+        memcache.flush_all()
+        counter = rpc_util.RpcCounter()
+        self.assertEquals(1, self.cache['a'])
+        self.assertEquals(['datastore_v3.Get'], [
+            name for name in counter.Counts()
+            if name.startswith('datastore_v3')])
+
+    def testSetIsBlindPut(self):
+        counter = rpc_util.RpcCounter()
+        self.cache.set('a', 1)
+        self.assertEquals(['datastore_v3.Put'], [
+            name for name in counter.Counts()
+            if name.startswith('datastore_v3')])
+        self.cache.set('a', 2)
+        self.assertEquals(1, cache._AppEngineUtilities_Cache.all().count())
+
+    def testKeyNames(self):
+        key_name_for = cache._AppEngineUtilities_Cache.key_name_for
+        self.assertEquals(u'k:1', key_name_for(1))
+        self.assertNotEquals(key_name_for('a' * 401), key_name_for('a' * 402))
+        self.cache['b' * 1000] = 'long'
+        memcache.flush_all()
+        self.assertEquals('long', self.cache['b' * 1000])
+
+        # The datastore limit is in bytes, not characters.
+        accented = u'\u00e9' * 300
+        self.assertTrue(key_name_for(accented).startswith(u'h:'))
+        self.cache[accented] = 'accented'
+        memcache.flush_all()
+        self.assertEquals('accented', self.cache[accented])
+
+    def testExpiredIgnored(self):
+        entry = cache._AppEngineUtilities_Cache.for_key('old')
+        entry.value = pickle.dumps(1)
+        entry.timeout = datetime.datetime.now() - datetime.timedelta(1)
+        entry.put()
+        self.failIf('old' in self.cache)
+
+    def testMigrate(self):
+        now = datetime.datetime.now()
+        def PutOld(key, value, days):
+            cache._AppEngineUtilities_Cache(
+                cachekey=key, value=pickle.dumps(value),
+                timeout=now + datetime.timedelta(days)).put()
+        PutOld('live', 1, 1)
+        PutOld('expired', 2, -1)
+        PutOld('rewritten', 3, 1)
+        self.cache['rewritten'] = 4
+
+        cursor = cache.Cache.migrate_to_key_names(batch_size=2)
+        while cursor:
+            cursor = cache.Cache.migrate_to_key_names(
+                cursor=cursor, batch_size=2)
+
+        memcache.flush_all()
+        self.assertEquals(1, self.cache['live'])
+        self.failIf('expired' in self.cache)
+        self.assertEquals(4, self.cache['rewritten'])
+        names = [entry.key().name()
+                 for entry in cache._AppEngineUtilities_Cache.all()]
+        self.assertEquals([u'k:live', u'k:rewritten'], sorted(names))
+
+
+class GetOrComputeTest(CacheTestBase):
+
+    LOCAL_CACHE_SIZE = 0
+
+    def setUp(self):
+        CacheTestBase.setUp(self)
+        self.calls = []
+        self.cache = cache.Cache(early_refresh_beta=0)
+
+    def Compute(self):
+        self.calls.append(1)
+        return len(self.calls)
+
+    def Expire(self, key):
+        """Makes the envelope for key look expired, as after its ttl."""
+        envelope = memcache.get(cache._envelope_key(key))
+        memcache.set(cache._envelope_key(key),
+                     (time.time() - 1,) + envelope[1:])
+        memcache.delete(cache._memcache_key(key))
+
+    def testComputesOnce(self):
+        self.assertEquals(1, self.cache.get_or_compute('k', self.Compute, 60))
+        self.assertEquals(1, self.cache.get_or_compute('k', self.Compute, 60))
+        self.assertEquals(1, len(self.calls))
+        self.assertEquals(1, self.cache['k'])
+
+    def testRecomputesWhenExpired(self):
+        self.cache.get_or_compute('k', self.Compute, 60)
+        self.Expire('k')
+        self.assertEquals(2, self.cache.get_or_compute('k', self.Compute, 60))
+        self.failIf(memcache.get(cache._lease_key('k')))
+
+    def testServesStaleWhileLeased(self):
+        self.cache.get_or_compute('k', self.Compute, 60)
+        self.Expire('k')
+        memcache.add(cache._lease_key('k'), 1)
+        self.assertEquals(1, self.cache.get_or_compute('k', self.Compute, 60))
+        self.assertEquals(1, len(self.calls))
+
+    def testComputesWhenLeaseHolderIsGone(self):
+        memcache.add(cache._lease_key('k'), 1)
+        self.assertEquals(1, self.cache.get_or_compute('k', self.Compute, 60))
+        self.assertEquals(1, len(self.calls))
+
+    def testEarlyRefresh(self):
+        eager = cache.Cache(early_refresh_beta=1e9)
+        eager.get_or_compute('k', self.Compute, 60)
+        # pretend the value took a second to compute
+        expires, delta, data = memcache.get(cache._envelope_key('k'))
+        memcache.set(cache._envelope_key('k'), (expires, 1.0, data))
+        self.assertEquals(2, eager.get_or_compute('k', self.Compute, 60))
+
+    def testDeleteRemovesEnvelope(self):
+        self.cache.get_or_compute('k', self.Compute, 60)
+        del self.cache['k']
+        self.assertEquals(2, self.cache.get_or_compute('k', self.Compute, 60))
+
+
+if __name__ == '__main__':
+    unittest.main()
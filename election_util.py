@@ -2,13 +2,16 @@
 
 """Utility functions for doing board elections."""
 
+import calendar
 import datetime
 import random
 
+from google.appengine.api import datastore
 from google.appengine.ext import db
 
 import freesidemodels
 import member_util
+import query_util
 
 
 class Error(Exception):
@@ -31,6 +34,138 @@ class ElectionDateError(ElectionError):
     """Raised when an election has an invalid date range."""
 
 
+# Most current elections shown at once.
+MAX_CURRENT_ELECTIONS = 100
+PREVIOUS_ELECTIONS_PAGE_SIZE = 5
+# Seconds after voting ends before results are frozen.  Votes cast just
+# before the end may still be being counted, and the ballot receipt query
+# FreezeResults uses to find them is only eventually consistent.
+FREEZE_DELAY_SECONDS = 300
+# Listed in frozen results for candidates who have since been deleted.
+DELETED_CANDIDATE = '(deleted)'
+
+
+def GetCurrentElections():
+    """Gets every election of any type whose voting has not ended.
+
+    Returns:
+      list of freesidemodels.Election, ordered by vote_end.
+    """
+    return freesidemodels.Election.all().filter(
+        'vote_end >=', datetime.datetime.now()).order('vote_end').fetch(
+            MAX_CURRENT_ELECTIONS)
+
+
+def GetPreviousElectionsPage(cursor=None,
+                             page_size=PREVIOUS_ELECTIONS_PAGE_SIZE):
+    """Gets one page of elections of any type whose voting has ended.
+
+    Args:
+      cursor: str, cursor returned with the previous page.
+      page_size: int, number of elections per page.
+    Returns:
+      (list of freesidemodels.Election, most recently ended first, str cursor
+      for the next page or None if this is the last page).
+    """
+    # The cursor also carries the cutoff time, so later pages continue the
+    # same query rather than one with a newer cutoff.  The cursor comes from
+    # the query string, so a malformed one falls back to the first page.
+    before = None
+    query_cursor = None
+    if cursor:
+        try:
+            timestamp, query_cursor = cursor.split(':', 1)
+            before = datetime.datetime.utcfromtimestamp(int(timestamp))
+        except (ValueError, OverflowError):
+            query_cursor = None
+    if before is None:
+        before = datetime.datetime.now().replace(microsecond=0)
+
+    q = freesidemodels.Election.all().filter(
+        'vote_end <', before).order('-vote_end')
+    elections, query_cursor = query_util.FetchPage(q, query_cursor, page_size)
+    if query_cursor is None:
+        return elections, None
+    return elections, '%d:%s' % (
+        calendar.timegm(before.utctimetuple()), query_cursor)
+
+
+def MigrateLegacyElections(cursor=None, batch_size=20):
+    """Moves one batch of elections stored under their type's kind.
+
+    Elections used to be stored as OfficerElection and BoardElection kinds;
+    they are now all Election entities.  Each legacy election is copied to
+    the Election kind, along with its ballot shards and receipts, then
+    deleted.  New keys
+    are derived from the old ones, so the job can be re-run safely.
+
+    Args:
+      cursor: str, name of the legacy kind returned by the previous call.
+      batch_size: int, number of elections to move.
+    Returns:
+      str name of the legacy kind to continue with, or None when done.
+    """
+    kinds = list(freesidemodels.Election.LEGACY_KINDS)
+    if cursor:
+        kinds = kinds[kinds.index(cursor):]
+    for kind in kinds:
+        entities = datastore.Query(kind).Get(batch_size)
+        if entities:
+            for entity in entities:
+                _MigrateLegacyElection(entity)
+            return kind
+    return None
+
+
+def _MigrateLegacyElection(entity):
+    """Copies a legacy election entity to the Election kind, then deletes it.
+
+    Args:
+      entity: datastore.Entity of a legacy election kind.
+    """
+    old_key = entity.key()
+    properties = dict([(str(name), value) for name, value in entity.items()])
+    election = getattr(freesidemodels, entity.kind())(
+        key_name='legacy-%s-%s' % (entity.kind(), old_key.id_or_name()),
+        **properties)
+
+    old_key_names = [freesidemodels.BallotShard.KeyName(old_key, i)
+                     for i in range(election.ballot_shards)]
+    shards = []
+    old_counted = []
+    old_shards = freesidemodels.BallotShard.get_by_key_name(old_key_names)
+    for index, old_shard in enumerate(old_shards):
+        if old_shard is not None:
+            shard = freesidemodels.BallotShard(
+                key_name=freesidemodels.BallotShard.KeyName(
+                    election.key(), index),
+                candidates=old_shard.candidates,
+                counts=old_shard.counts)
+            shards.append(shard)
+            counted = freesidemodels.CountedBallot.all(
+                keys_only=True).ancestor(old_shard).fetch(1000)
+            shards.extend([freesidemodels.CountedBallot(
+                               parent=shard.key(), key_name=key.name())
+                           for key in counted])
+            old_counted.extend(counted)
+    old_receipts = freesidemodels.BallotReceipt.all().filter(
+        'election =', old_key).fetch(1000)
+    receipts = [freesidemodels.BallotReceipt(
+                    key_name=freesidemodels.BallotReceipt.KeyName(
+                        election.key(), receipt.voter_hash),
+                    election=election.key(),
+                    voter_hash=receipt.voter_hash,
+                    ballot=receipt.ballot,
+                    shard=receipt.shard,
+                    candidate=receipt.candidate)
+                for receipt in old_receipts]
+
+    db.put([election] + shards + receipts)
+    db.delete([old_key] + [shard.key() for shard in old_shards
+                           if shard is not None]
+              + old_counted + [receipt.key() for receipt in old_receipts])
+
+
 def _IsOfficerElection(election):
     """Determines if an election is an officer election.
 
@@ -53,6 +188,136 @@ def _IsBoardElection(election):
     return isinstance(election, freesidemodels.BoardElection)
 
 
+def _AddToTally(candidates, counts, candidate_key, count=1):
+    """Adds votes for a candidate to a tally.
+
+    Args:
+      candidates: list of db.Key, the tally's candidates.
+      counts: list of int, vote counts parallel to candidates.
+      candidate_key: db.Key
+      count: int, number of votes to add.
+    """
+    if candidate_key in candidates:
+        counts[candidates.index(candidate_key)] += count
+    else:
+        candidates.append(candidate_key)
+        counts.append(count)
+
+
+def _BallotReceiptKeyName(election, voter_key):
+    """Gets the key name of a voter's ballot receipt for an election.
+
+    Args:
+      election: freesidemodels.Election
+      voter_key: db.Key
+    Returns:
+      str
+    """
+    return freesidemodels.BallotReceipt.KeyName(
+        election.key(), freesidemodels.BallotReceipt.VoterHash(voter_key))
+
+
+def GetBallotShards(election):
+    """Gets all of an election's ballot shards that have been written.
+
+    Args:
+      election: freesidemodels.Election
+    Returns:
+      list of freesidemodels.BallotShard
+    """
+    key_names = [freesidemodels.BallotShard.KeyName(election.key(), i)
+                 for i in range(election.ballot_shards)]
+    return [shard for shard in
+            freesidemodels.BallotShard.get_by_key_name(key_names)
+            if shard is not None]
+
+
+class ElectionView(object):
+    """An election with its key lists loaded into sets.
+
+    Build one per election per request; every membership check after that
+    is a constant time set lookup.  Ballot receipt lookups for HasVoted are
+    made once per voter, or for several elections at once with LoadBallots.
+    """
+
+    def __init__(self, election):
+        self.election = election
+        self._nominees = set(election.nominees)
+        self._nominators = set(election.nominators)
+        self._legacy_voters = set(election.voters)
+        # Maps str(voter key) to whether the voter has a ballot receipt.
+        self._has_ballot = {}
+
+    def IsNominee(self, key):
+        """Whether the person with this key has been nominated."""
+        return key in self._nominees
+
+    def HasNominated(self, key):
+        """Whether the member with this key has nominated someone."""
+        return key in self._nominators
+
+    def CanBeNominatedBy(self, nominee_key, nominator_key):
+        """Whether nominee_key may be nominated by nominator_key."""
+        return (nominee_key != nominator_key
+                and nominee_key not in self._nominees)
+
+    def HasLegacyVote(self, key):
+        """Whether this member voted before ballots were sharded."""
+        return key in self._legacy_voters
+
+    def HasVoted(self, key):
+        """Whether the member with this key has voted."""
+        if self.HasLegacyVote(key):
+            return True
+        if str(key) not in self._has_ballot:
+            LoadBallots([self], key)
+        return self._has_ballot[str(key)]
+
+
+def LoadBallots(views, voter_key):
+    """Looks up a voter's ballot receipts in several elections with one get.
+
+    Args:
+      views: list of ElectionView
+      voter_key: db.Key
+    """
+    key_names = [_BallotReceiptKeyName(view.election, voter_key)
+                 for view in views]
+    receipts = freesidemodels.BallotReceipt.get_by_key_name(key_names)
+    for view, receipt in zip(views, receipts):
+        view._has_ballot[str(voter_key)] = receipt is not None
+
+
+def HasVoted(election, voter_key):
+    """Determines if a person has voted in an election.
+
+    Args:
+      election: freesidemodels.Election
+      voter_key: db.Key
+    Returns:
+      bool
+    """
+    return ElectionView(election).HasVoted(voter_key)
+
+
+def GetTally(election):
+    """Counts an election's votes.
+
+    Args:
+      election: freesidemodels.Election
+    Returns:
+      (list of candidate db.Keys, list of parallel int vote counts)
+    """
+    candidates = []
+    counts = []
+    for vote in election.votes:
+        _AddToTally(candidates, counts, vote)
+    for shard in GetBallotShards(election):
+        for candidate, count in zip(shard.candidates, shard.counts):
+            _AddToTally(candidates, counts, candidate, count)
+    return candidates, counts
+
+
 def Nominate(election, nominee, current_user):
     """Nominate a Person for an election.
 
@@ -79,11 +344,12 @@ def Nominate(election, nominee, current_user):
     if nominee.key() == current_user.key():
         raise NomineeError('You can\'t nominate yourself.')
 
-    if nominee.key() in election.nominees:
+    view = ElectionView(election)
+    if view.IsNominee(nominee.key()):
         raise NomineeError('%s has already been nominated for %s.' %
                             (nominee.username, election.position))
 
-    if current_user.key() in election.nominators:
+    if view.HasNominated(current_user.key()):
         raise ElectionError('You can only nominate one person per election.')
 
     now = datetime.datetime.now()
@@ -102,17 +368,33 @@ def Nominate(election, nominee, current_user):
 def Vote(election, candidate, current_user):
     """Cast a vote for a candidate.
 
+    The voter gets a BallotReceipt, and the ballot is counted on a randomly
+    chosen BallotShard, so voters only contend with others on the same shard
+    and no entity links a voter to a candidate once the ballot is counted.
+    The two can't share a transaction, so the receipt holds the ballot until
+    it is counted.  A vote interrupted after its receipt is written is
+    counted by the voter's next Vote call, or by FreezeResults.
+
     Args:
       election: freesidemodels.Election, the election to vote in.
       candidate: freesidemodels.Person, the candidate to cast a vote for.
       current_user: freesidemodels.Person, the current user.
     """
-    def DoVote():
-        election.votes.append(candidate.key())
-        election.voters.append(current_user.key())
-        # Shuffle teh voters so they are anonymous.
-        random.shuffle(election.voters)
-        election.put()
+    def DoReceipt():
+        receipt = freesidemodels.BallotReceipt.get_by_key_name(
+            receipt_key_name)
+        if receipt is not None:
+            return receipt, False
+        receipt = freesidemodels.BallotReceipt(
+            key_name=receipt_key_name,
+            election=election.key(),
+            voter_hash=freesidemodels.BallotReceipt.VoterHash(
+                current_user.key()),
+            ballot='%032x' % random.getrandbits(128),
+            shard=random.randrange(election.ballot_shards),
+            candidate=str(candidate.key()))
+        receipt.put()
+        return receipt, True
 
     try:
         election.key()
@@ -123,10 +405,113 @@ def Vote(election, candidate, current_user):
     if not election.vote_start < now < election.vote_end:
         raise ElectionDateError('Election is not accepting votes.')
 
-    if candidate.key() not in election.nominees:
+    view = ElectionView(election)
+    if not view.IsNominee(candidate.key()):
         raise NomineeError('Candidate has not been nominated.')
 
-    if current_user.key() in election.voters:
+    if view.HasLegacyVote(current_user.key()):
+        raise ElectionError('You can only vote once per election.')
+
+    receipt_key_name = _BallotReceiptKeyName(election, current_user.key())
+    receipt, created = db.run_in_transaction(DoReceipt)
+    if receipt.ballot:
+        _CountBallot(election, receipt)
+    if not created:
         raise ElectionError('You can only vote once per election.')
 
-    db.run_in_transaction(DoVote)
+
+def _CountBallot(election, receipt):
+    """Counts the ballot held by a receipt, then clears it from the receipt.
+
+    Safe to repeat: a CountedBallot child of the shard records the ballot's
+    id, and ballots that have one are skipped.
+
+    Args:
+      election: freesidemodels.Election
+      receipt: freesidemodels.BallotReceipt, with its ballot set.
+    """
+    shard_key_name = freesidemodels.BallotShard.KeyName(
+        election.key(), receipt.shard)
+    counted_key = freesidemodels.CountedBallot.KeyFor(
+        shard_key_name, receipt.ballot)
+
+    def DoCount():
+        shard, counted = db.get([counted_key.parent(), counted_key])
+        if counted is not None:
+            return
+        if shard is None:
+            shard = freesidemodels.BallotShard(key_name=shard_key_name)
+        _AddToTally(shard.candidates, shard.counts, db.Key(receipt.candidate))
+        db.put([shard, freesidemodels.CountedBallot(
+            parent=counted_key.parent(), key_name=receipt.ballot)])
+
+    def DoClear():
+        current = db.get(receipt.key())
+        if current.ballot == receipt.ballot:
+            current.ballot = None
+            current.shard = None
+            current.candidate = None
+            current.put()
+
+    db.run_in_transaction(DoCount)
+    db.run_in_transaction(DoClear)
+
+
+def _CountPendingBallots(election):
+    """Counts any ballots whose Vote call was interrupted.
+
+    Args:
+      election: freesidemodels.Election
+    """
+    q = freesidemodels.BallotReceipt.all().filter('election =', election)
+    for receipt in q:
+        if receipt.ballot:
+            _CountBallot(election, receipt)
+
+
+def _ResultName(person):
+    """Gets the name a candidate is listed under in frozen results.
+
+    Args:
+      person: freesidemodels.Person, or None if the candidate was deleted.
+    Returns:
+      str
+    """
+    if person is None:
+        return DELETED_CANDIDATE
+    return person.username
+
+
+def FreezeResults(election):
+    """Stores a snapshot of an ended election's results on the election.
+
+    Does nothing if the results are already frozen, or until
+    FREEZE_DELAY_SECONDS after voting has ended.
+
+    Args:
+      election: freesidemodels.Election
+    Returns:
+      bool, whether the election's results are frozen.
+    """
+    if election.results_frozen:
+        return True
+    delay = datetime.timedelta(seconds=FREEZE_DELAY_SECONDS)
+    if election.vote_end + delay > datetime.datetime.now():
+        return False
+
+    _CountPendingBallots(election)
+    candidates, counts = GetTally(election)
+    people = member_util.GetPeopleByKeys(candidates)
+    results = sorted(
+        [(_ResultName(people.get(str(key))), count)
+         for key, count in zip(candidates, counts)],
+        key=lambda result: result[1], reverse=True)
+
+    def DoFreeze():
+        election.results_frozen = True
+        election.result_usernames = [username for username, _ in results]
+        election.result_counts = [count for _, count in results]
+        election.put()
+
+    db.run_in_transaction(DoFreeze)
+    return True
@@ -4,12 +4,17 @@
 
 import datetime
 import random
+import threading
 import unittest
 
+from google.appengine.api import datastore
+from google.appengine.ext import db
+
 import freesidemodels
 import member_util
 import election_util
 import random_util
+import rpc_util
 import test_util
 
 
@@ -67,6 +72,11 @@ class ElectionUtilTest(test_util.AppEngineTestBase):
             vote_start=now-delta*2,
             vote_end=now+delta*2)
 
+    def EndVoting(self, election):
+        """Moves vote_end back far enough for results to be frozen."""
+        election.vote_end = datetime.datetime.now() - datetime.timedelta(
+            seconds=election_util.FREEZE_DELAY_SECONDS + 60)
+
     def testNominate(self):
         el = self.MakeElection(freesidemodels.OfficerElection)
 
@@ -182,13 +192,347 @@ class ElectionUtilTest(test_util.AppEngineTestBase):
 
         # Successful vote
         election_util.Vote(el, self.members[0], self.members[1])
-        self.assertEquals([self.members[0].key()], el.votes)
-        self.assertEquals([self.members[1].key()], el.voters)
+        self.assertTrue(election_util.HasVoted(el, self.members[1].key()))
+        self.assertFalse(election_util.HasVoted(el, self.members[2].key()))
+        self.assertEquals(
+            ([self.members[0].key()], [1]), election_util.GetTally(el))
+
+        # Voting again, with a ballot receipt
+        self.assertRaises(
+            election_util.ElectionError,
+            election_util.Vote,
+            el, self.members[0], self.members[1])
 
         # Another successful vote
         election_util.Vote(el, self.members[0], self.members[2])
-        self.assertEquals([self.members[0].key()] * 2, el.votes)
-        self.assertTrue(self.members[2].key() in el.voters)
+        self.assertTrue(election_util.HasVoted(el, self.members[2].key()))
+        self.assertEquals(
+            ([self.members[0].key()], [2]), election_util.GetTally(el))
+
+        # Votes are kept off the election entity.
+        el = db.get(el.key())
+        self.assertEquals([], el.votes)
+        self.assertEquals([], el.voters)
+
+    def testGetCurrentElections(self):
+        officer = self.MakeElection(freesidemodels.OfficerElection)
+        officer.put()
+        board = self.MakeElection(freesidemodels.BoardElection)
+        board.vote_end = datetime.datetime.now() + datetime.timedelta(days=1)
+        board.put()
+        ended = self.MakeElection(freesidemodels.BoardElection)
+        ended.vote_end = datetime.datetime.now() - datetime.timedelta(days=1)
+        ended.put()
+
+        elections = election_util.GetCurrentElections()
+        self.assertEquals([board.key(), officer.key()],
+                          [e.key() for e in elections])
+        self.assertTrue(isinstance(elections[0],
+                                   freesidemodels.BoardElection))
+        self.assertTrue(isinstance(elections[1],
+                                   freesidemodels.OfficerElection))
+
+    def testGetPreviousElectionsPage(self):
+        now = datetime.datetime.now()
+        expected = []
+        for days in range(1, 6):
+            cls = random.choice([freesidemodels.OfficerElection,
+                                 freesidemodels.BoardElection])
+            el = self.MakeElection(cls)
+            el.vote_end = now - datetime.timedelta(days=days)
+            el.put()
+            expected.append(el.key())
+        self.MakeElection(freesidemodels.BoardElection).put()
+
+        elections, cursor = election_util.GetPreviousElectionsPage(
+            page_size=3)
+        self.assertEquals(expected[:3], [e.key() for e in elections])
+        elections, cursor = election_util.GetPreviousElectionsPage(
+            cursor=cursor, page_size=3)
+        self.assertEquals(expected[3:], [e.key() for e in elections])
+        self.assertEquals(None, cursor)
+
+    def testGetPreviousElectionsPageBadCursor(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        el.vote_end = datetime.datetime.now() - datetime.timedelta(days=1)
+        el.put()
+
+        for cursor in ['garbage', 'abc:def', '99999999999999999999:x',
+                       '1:not-a-cursor']:
+            elections, _ = election_util.GetPreviousElectionsPage(
+                cursor=cursor)
+            if cursor.startswith('1:'):
+                # A valid cutoff before any election ended.
+                self.assertEquals([], elections)
+            else:
+                self.assertEquals([el.key()], [e.key() for e in elections])
+
+    def testMigrateLegacyElections(self):
+        legacy = datastore.Entity('BoardElection')
+        legacy.update({
+            'position': 'board member',
+            'nominate_start': datetime.datetime(2009, 1, 1),
+            'nominate_end': datetime.datetime(2009, 1, 2),
+            'vote_start': datetime.datetime(2009, 1, 3),
+            'vote_end': datetime.datetime(2009, 1, 4),
+            'nominees': [self.members[0].key()],
+        })
+        datastore.Put(legacy)
+        shard = freesidemodels.BallotShard(
+            key_name=freesidemodels.BallotShard.KeyName(legacy.key(), 3),
+            candidates=[self.members[0].key()],
+            counts=[1])
+        counted = freesidemodels.CountedBallot(
+            parent=shard.key(), key_name='counted')
+        db.put([shard, counted])
+        receipt = freesidemodels.BallotReceipt(
+            key_name=freesidemodels.BallotReceipt.KeyName(
+                legacy.key(),
+                freesidemodels.BallotReceipt.VoterHash(self.members[1].key())),
+            election=legacy.key(),
+            voter_hash=freesidemodels.BallotReceipt.VoterHash(
+                self.members[1].key()))
+        receipt.put()
+
+        self.assertEquals(
+            'BoardElection', election_util.MigrateLegacyElections())
+        self.assertEquals(
+            None,
+            election_util.MigrateLegacyElections(cursor='BoardElection'))
+
+        [el] = freesidemodels.Election.all().fetch(10)
+        self.assertTrue(isinstance(el, freesidemodels.BoardElection))
+        self.assertEquals('board member', el.position)
+        self.assertEquals([self.members[0].key()], el.nominees)
+        self.assertEquals(
+            ([self.members[0].key()], [1]), election_util.GetTally(el))
+        self.assertEquals(None, db.get(legacy.key()))
+        self.assertEquals(None, db.get(shard.key()))
+        self.assertEquals(None, db.get(counted.key()))
+        self.assertEquals(None, db.get(receipt.key()))
+        [new_shard] = election_util.GetBallotShards(el)
+        self.assertEquals(
+            ['counted'],
+            [key.name() for key in freesidemodels.CountedBallot.all(
+                keys_only=True).ancestor(new_shard)])
+        self.assertTrue(election_util.HasVoted(el, self.members[1].key()))
+
+    def testElectionView(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        el.nominees = [self.members[0].key()]
+        el.nominators = [self.members[1].key()]
+        el.voters = [self.members[2].key()]
+        el.put()
+        election_util.Vote(el, self.members[0], self.members[3])
+
+        view = election_util.ElectionView(el)
+        self.assertTrue(view.IsNominee(self.members[0].key()))
+        self.assertFalse(view.IsNominee(self.members[1].key()))
+        self.assertTrue(view.HasNominated(self.members[1].key()))
+        self.assertFalse(view.HasNominated(self.members[0].key()))
+        self.assertFalse(view.CanBeNominatedBy(
+            self.members[0].key(), self.members[4].key()))
+        self.assertFalse(view.CanBeNominatedBy(
+            self.members[4].key(), self.members[4].key()))
+        self.assertTrue(view.CanBeNominatedBy(
+            self.members[5].key(), self.members[4].key()))
+
+        other = self.MakeElection(freesidemodels.OfficerElection)
+        other.put()
+        other_view = election_util.ElectionView(other)
+        counter = rpc_util.RpcCounter()
+        election_util.LoadBallots([view, other_view], self.members[3].key())
+        self.assertTrue(view.HasVoted(self.members[3].key()))
+        self.assertFalse(other_view.HasVoted(self.members[3].key()))
+        self.assertEquals(1, counter.Count('datastore_v3'))
+        # Legacy voters are found without looking at the shards.
+        self.assertTrue(view.HasVoted(self.members[2].key()))
+        self.assertEquals(1, counter.Count('datastore_v3'))
+
+        # Nor can they vote again.
+        self.assertRaises(
+            election_util.ElectionError,
+            election_util.Vote,
+            el, self.members[0], self.members[2])
+        self.assertEquals(
+            1, freesidemodels.BallotReceipt.all().filter(
+                'election =', el).count())
+
+    def testFreezeResults(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        el.nominees = [self.members[0].key(), self.members[1].key()]
+        el.put()
+        election_util.Vote(el, self.members[1], self.members[2])
+        election_util.Vote(el, self.members[0], self.members[3])
+        election_util.Vote(el, self.members[1], self.members[4])
+
+        # Voting has not ended yet.
+        self.assertFalse(election_util.FreezeResults(el))
+        self.assertFalse(el.results_frozen)
+        # Voting has just ended, and votes may still be being counted.
+        el.vote_end = datetime.datetime.now() - datetime.timedelta(minutes=1)
+        self.assertFalse(election_util.FreezeResults(el))
+        self.assertFalse(el.results_frozen)
+
+        self.EndVoting(el)
+        self.assertTrue(election_util.FreezeResults(el))
+        el = db.get(el.key())
+        self.assertTrue(el.results_frozen)
+        self.assertEquals(
+            [self.members[1].username, self.members[0].username],
+            el.result_usernames)
+        self.assertEquals([2, 1], el.result_counts)
+
+    def testBallotsAreAnonymous(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        el.nominees = [self.members[0].key()]
+        el.put()
+        election_util.Vote(el, self.members[0], self.members[1])
+
+        [shard] = election_util.GetBallotShards(el)
+        voter_key = self.members[1].key()
+        self.assertFalse(voter_key in shard.candidates)
+        [counted] = freesidemodels.CountedBallot.all(
+            keys_only=True).ancestor(shard).fetch(10)
+        self.assertNotEquals(
+            freesidemodels.BallotReceipt.VoterHash(voter_key), counted.name())
+        [receipt] = freesidemodels.BallotReceipt.all().fetch(10)
+        self.assertEquals(None, receipt.ballot)
+        self.assertEquals(None, receipt.shard)
+        self.assertEquals(None, receipt.candidate)
+
+    def _PendingReceipt(self, el, voter):
+        """Writes a receipt as a Vote interrupted before counting would."""
+        voter_hash = freesidemodels.BallotReceipt.VoterHash(voter.key())
+        freesidemodels.BallotReceipt(
+            key_name=freesidemodels.BallotReceipt.KeyName(
+                el.key(), voter_hash),
+            election=el.key(),
+            voter_hash=voter_hash,
+            ballot='pending',
+            shard=2,
+            candidate=str(self.members[0].key())).put()
+
+    def testInterruptedVoteCountedOnRetry(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        el.nominees = [self.members[0].key(), self.members[2].key()]
+        el.put()
+        self._PendingReceipt(el, self.members[1])
+        self.assertTrue(election_util.HasVoted(el, self.members[1].key()))
+
+        # The retry counts the original ballot, not the new choice.
+        self.assertRaises(
+            election_util.ElectionError,
+            election_util.Vote,
+            el, self.members[2], self.members[1])
+        self.assertEquals(
+            ([self.members[0].key()], [1]), election_util.GetTally(el))
+        self.assertRaises(
+            election_util.ElectionError,
+            election_util.Vote,
+            el, self.members[2], self.members[1])
+        self.assertEquals(
+            ([self.members[0].key()], [1]), election_util.GetTally(el))
+
+    def testInterruptedVoteCountedOnFreeze(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        el.nominees = [self.members[0].key()]
+        el.put()
+        self._PendingReceipt(el, self.members[1])
+        # Counted on the shard, but not yet cleared from the receipt.
+        shard = freesidemodels.BallotShard(
+            key_name=freesidemodels.BallotShard.KeyName(el.key(), 2),
+            candidates=[self.members[0].key()],
+            counts=[1])
+        db.put([shard, freesidemodels.CountedBallot(
+            parent=shard.key(), key_name='pending')])
+
+        self.EndVoting(el)
+        self.assertTrue(election_util.FreezeResults(el))
+        self.assertEquals([1], el.result_counts)
+        [receipt] = freesidemodels.BallotReceipt.all().fetch(10)
+        self.assertEquals(None, receipt.ballot)
+
+    def testFreezeResultsWithDeletedCandidate(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        el.nominees = [self.members[0].key()]
+        el.put()
+        election_util.Vote(el, self.members[0], self.members[1])
+        self.members[0].delete()
+
+        self.EndVoting(el)
+        self.assertTrue(election_util.FreezeResults(el))
+        self.assertEquals([election_util.DELETED_CANDIDATE],
+                          el.result_usernames)
+        self.assertEquals([1], el.result_counts)
+
+    def testFreezeResultsWithLegacyVotes(self):
+        el = self.MakeElection(freesidemodels.BoardElection)
+        self.EndVoting(el)
+        el.votes = [self.members[0].key(), self.members[1].key(),
+                    self.members[0].key()]
+        el.put()
+        self.assertTrue(election_util.FreezeResults(el))
+        self.assertEquals(
+            [self.members[0].username, self.members[1].username],
+            el.result_usernames)
+        self.assertEquals([2, 1], el.result_counts)
+
+
+class VoteContentionTest(test_util.AppEngineTestBase):
+    """Drives concurrent Vote calls against the datastore stub.
+
+    The stub serializes transactions, so contention is checked as the most
+    ballots written to any one entity group; in production every write to the
+    same group beyond about one per second risks a transaction collision.
+    """
+
+    VOTERS = 100
+    THREADS = 10
+
+    def testConcurrentVotes(self):
+        now = datetime.datetime.now()
+        delta = datetime.timedelta(days=1)
+        candidate = random_util.Member()
+        candidate.put()
+        el = freesidemodels.BoardElection(
+            position='board member',
+            nominate_start=now - delta * 4,
+            nominate_end=now - delta * 2,
+            vote_start=now - delta,
+            vote_end=now + delta,
+            nominees=[candidate.key()])
+        el.put()
+        voters = []
+        for _ in range(self.VOTERS):
+            voter = random_util.Member()
+            voter.put()
+            voters.append(voter)
+
+        errors = []
+        def DoVotes(voters):
+            for voter in voters:
+                try:
+                    election_util.Vote(el, candidate, voter)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=DoVotes,
+                                    args=(voters[i::self.THREADS],))
+                   for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals([], errors)
+        self.assertEquals(
+            ([candidate.key()], [self.VOTERS]), election_util.GetTally(el))
+        # Shards are picked at random, so allow some imbalance; 3 times the
+        # even share is exceeded with odds of under one in ten million.
+        busiest = max([sum(shard.counts)
+                       for shard in election_util.GetBallotShards(el)])
+        self.assertTrue(busiest <= 3 * self.VOTERS / el.ballot_shards)
 
 
 if __name__ == '__main__':
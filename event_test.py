@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Unittest for appengine_utilities/event.py"""
+
+import unittest
+
+from appengine_utilities import event
+
+
+class EventTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = event.Event()
+        self.calls = []
+
+    def Record(self, *args, **kwargs):
+        self.calls.append((args, kwargs))
+
+    def testArgs(self):
+        self.events.subscribe('e', self.Record)
+        self.events.subscribe('e', self.Record, [1, 2])
+        self.events.subscribe('e', self.Record, {'a': 1})
+        self.events.subscribe('e', self.Record, 'x')
+        self.events.fire_event('e')
+        self.assertEquals([((), {}), ((1, 2), {}), ((), {'a': 1}),
+                           (('x',), {})], self.calls)
+
+    def testOnlyNamedEvent(self):
+        self.events.subscribe('e', self.Record)
+        self.events.fire_event('other')
+        self.assertEquals([], self.calls)
+
+    def testSubscribeTwice(self):
+        self.events.subscribe('e', self.Record)
+        self.events.subscribe('e', self.Record)
+        self.events.fire_event('e')
+        self.assertEquals(1, len(self.calls))
+
+    def testUnsubscribe(self):
+        self.events.subscribe('e', self.Record)
+        self.events.unsubscribe('e', self.Record)
+        self.events.unsubscribe('missing', self.Record)
+        self.events.fire_event('e')
+        self.assertEquals([], self.calls)
+        self.assertEquals({}, self.events.events)
+
+    def testUnsubscribeWhileFiring(self):
+        def Once():
+            self.events.unsubscribe('e', Once)
+            self.calls.append('once')
+        self.events.subscribe('e', Once)
+        self.events.subscribe('e', self.Record)
+        self.events.fire_event('e')
+        self.events.fire_event('e')
+        self.assertEquals(['once', ((), {}), ((), {})], self.calls)
+
+    def testDeferred(self):
+        queued = []
+        defer = event.deferred.defer
+        event.deferred.defer = lambda *args: queued.append(args)
+        try:
+            self.events.subscribe('e', self.Record, [1], deferred=True)
+            self.events.fire_event('e')
+        finally:
+            event.deferred.defer = defer
+        self.assertEquals([], self.calls)
+        self.assertEquals(
+            [(event._run_callback, self.Record, [1])], queued)
+        queued[0][0](*queued[0][1:])
+        self.assertEquals([((1,), {})], self.calls)
+
+    def testStats(self):
+        self.events.subscribe('e', self.Record)
+        self.events.fire_event('e')
+        self.events.fire_event('e')
+        self.events.fire_event('unsubscribed')
+        stats = self.events.get_stats()
+        self.assertEquals(['e'], stats.keys())
+        self.assertEquals(2, stats['e']['fires'])
+        self.failUnless(stats['e']['seconds'] >= 0)
+        self.events.clear_stats()
+        self.assertEquals({}, self.events.get_stats())
+
+    def testSharedDispatcher(self):
+        import __main__
+        self.failUnless(__main__.AEU_Events is event.AEU_Events)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,26 +4,36 @@
 
 import datetime
 import logging
-import operator
 import os
 import random
 import sys
 import urllib
 
 from google.appengine.api import mail
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import webapp
 from google.appengine.ext import db
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp import util
 
+from appengine_utilities.cache import Cache
 from appengine_utilities.sessions import Session
 
 import election_util
 import freesidemodels
 import member_util
+import rpc_util
 import timezones
 
 
+# Seconds a page of the member directory is cached for.  Members joining or
+# leaving may take this long (plus the cache's stale grace) to show up.
+DIRECTORY_CACHE_SECONDS = 60
+# Seconds a session's principal is trusted before it is checked against the
+# member again.  Ending a member's sessions takes effect within this long.
+PRINCIPAL_CHECK_SECONDS = 60
+
+
 class Error(Exception):
   """Base error class for this module."""
 
@@ -74,17 +84,98 @@ def RedirectIfNotAdmin(fn):
   return MaybeRedirect
 
 
+# Per-instance count of requests that opened a session, split by whether the
+# browser sent a session cookie ('loaded') or not ('created').
+_session_stats = {'created': 0, 'loaded': 0}
+
+
+def GetSessionStats():
+  """Gets the number of requests on this instance that opened a session.
+
+  Returns:
+    dict with 'created' and 'loaded' counts.
+  """
+  return dict(_session_stats)
+
+
 class FreesideHandler(webapp.RequestHandler):
   """Request Handler with some common functions."""
 
   def __init__(self):
     super(FreesideHandler, self).__init__()
-    self.session = Session()
+    self._session = None
+    self._principal = None
+    self._user = None
+
+  def initialize(self, request, response):
+    super(FreesideHandler, self).initialize(request, response)
+    wsgi_write = response.wsgi_write
+    def CommitAndWrite(start_response):
+      self.CommitSession()
+      return wsgi_write(start_response)
+    response.wsgi_write = CommitAndWrite
+
+  def _GetSession(self):
+    if self._session is None:
+      if self.HasSession():
+        _session_stats['loaded'] += 1
+      else:
+        _session_stats['created'] += 1
+      self._session = Session(writer='signed_cookie', unit_of_work=True,
+                              signed_tokens=True, collect_headers=True)
+    return self._session
+
+  # The request's Session, opened on first use.  Changes to it are buffered
+  # and written once by CommitSession, at the end of the request.
+  session = property(_GetSession)
+
+  def CommitSession(self):
+    """Writes any session changes made during this request.
+
+    The session's cookies and no-cache headers are added to the response.
+    """
+    if self._session is not None:
+      self._session.commit()
+      self._session.write_headers(self.response)
 
-  user = property(lambda self: self.session['user'])
+  def HasSession(self):
+    """Determines if this request has a session, without opening one.
+
+    Returns:
+      bool
+    """
+    return (self._session is not None
+            or Session.COOKIE_NAME in self.request.cookies
+            or Session.SIGNED_COOKIE_NAME in self.request.cookies)
+
+  def _GetPrincipal(self):
+    if self._principal is None:
+      value = self.session['user']
+      if isinstance(value, freesidemodels.Member):
+        # Sessions from before principals were stored held the whole Member.
+        self._principal = member_util.Principal.FromMember(value)
+      else:
+        self._principal = member_util.Principal.FromDict(value)
+    return self._principal
+
+  def _SetPrincipal(self, principal):
+    self._principal = principal
+    self._user = None
+    self.session['user'] = principal.ToDict()
+
+  # The logged in member's member_util.Principal, from the session.
+  principal = property(_GetPrincipal, _SetPrincipal)
+
+  def _GetUser(self):
+    if self._user is None:
+      self._user = member_util.GetMemberByKey(self.principal.key)
+    return self._user
+
+  # The logged in member's full freesidemodels.Member, fetched on first use.
+  user = property(_GetUser)
 
   def _GetError(self):
-    if 'error' in self.session:
+    if self.HasSession() and 'error' in self.session:
       return self.session['error']
     else:
       return None
@@ -121,12 +212,13 @@ class FreesideHandler(webapp.RequestHandler):
     if self.error_msg is not None:
       template_values['errors'] = [self.error_msg]
     # TODO(dknowles): Empty errors here?
-    if 'error' in self.session: del self.session['error']
+    if self.HasSession() and 'error' in self.session:
+      del self.session['error']
 
     if self.CheckAuth():
       template_values['admin'] = self.CheckAdmin()
       template_values['sidebar'] = self.GetSideBar()
-      template_values['user'] = self.session['user']
+      template_values['user'] = self.principal
 
     template_path = os.path.join('templates', template_name)
     self.response.out.write(template.render(template_path, template_values))
@@ -134,18 +226,39 @@ class FreesideHandler(webapp.RequestHandler):
   def CheckAuth(self):
     """Determines if the current user has logged in.
 
+    Every PRINCIPAL_CHECK_SECONDS the session's principal is checked against
+    the member, and refreshed from it.  A session whose member has since
+    changed their password or had their sessions ended is logged out then.
+
     Returns:
       bool
     """
-    return 'user' in self.session
+    if not (self.HasSession() and 'user' in self.session):
+      return False
+    if not self.principal.NeedsCheck(PRINCIPAL_CHECK_SECONDS):
+      return True
+    member = self.user
+    if not self.principal.IsCurrent(member):
+      del self.session['user']
+      self._principal = None
+      self._user = None
+      return False
+    self.principal = member_util.Principal.FromMember(member)
+    self._user = member
+    return True
 
   def CheckAdmin(self):
     """Determines if the current user is a site admin.
 
+    The member is only loaded for principals marked admin, so revoking
+    admin takes effect at once, without a lookup for everyone else.
+
     Returns:
       bool
     """
-    return self.session['user'].admin
+    if not self.principal.admin:
+      return False
+    return self.user is not None and self.user.admin
 
 
 class LoginPage(FreesideHandler):
@@ -166,7 +279,7 @@ class LoginPage(FreesideHandler):
 
     if user:
       if hashedpass == user.password:
-        self.session['user'] = user
+        self.principal = member_util.Principal.FromMember(user)
         self.redirect('/home')
       else:
         self.error_msg = 'Incorrect password.'
@@ -218,7 +331,7 @@ class AdminPage(FreesideHandler):
         starving=self.request.get('starving') == 'True'))
     self.redirect('/admin')
 
-  def _ParseDate(self, date_str, tzinfo=timezones.Eastern()):
+  def _ParseDate(self, date_str, tzinfo=timezones.EASTERN_TZ):
     """Parses a date string in format "MM/DD/YYYY".
 
     Args:
@@ -266,8 +379,7 @@ class AdminPage(FreesideHandler):
       'positions': self.positions,
       }
     if template_values['admintask'] == 'ResetPassword':
-      members = sorted(member_util.GetActiveMembers(), key=lambda m: m.username)
-      template_values['members'] = members
+      template_values['members'] = member_util.GetMemberDirectory()
     self.RenderTemplate('admin.html', template_values)
 
   @RedirectIfUnauthorized
@@ -307,8 +419,17 @@ class MembersList(FreesideHandler):
 
   @RedirectIfUnauthorized
   def get(self):
-    members = sorted(member_util.GetActiveMembers(), key=lambda m: m.username)
-    self.RenderTemplate('members.html', {'members': members})
+    cursor = self.request.get('cursor')
+    if cursor:
+      # Only the first page is cached, so arbitrary cursors in the query
+      # string can't fill the cache.
+      members, next_cursor = member_util.GetMemberDirectoryPage(cursor=cursor)
+    else:
+      members, next_cursor = Cache().get_or_compute(
+          'members-page', member_util.GetMemberDirectoryPage,
+          DIRECTORY_CACHE_SECONDS)
+    self.RenderTemplate(
+        'members.html', {'members': members, 'next_cursor': next_cursor})
 
 
 class Profile(FreesideHandler):
@@ -322,9 +443,9 @@ class Profile(FreesideHandler):
       self.redirect('/members')
       return
 
-    user = self.session['user']
+    user = self.principal
     edit = self.request.get('mode') == 'edit'
-    canedit = user.key() == member.key() or user.admin
+    canedit = user.key == member.key() or user.admin
 
     self.RenderTemplate(
       'profile.html',
@@ -350,6 +471,8 @@ class Profile(FreesideHandler):
       else:
         member.password = freesidemodels.Person.EncryptPassword(newpass)
         member.password_expired = False
+        # End the member's other sessions.
+        member.session_generation += 1
 
     member.firstname = self.request.get('firstname')
     member.lastname = self.request.get('lastname')
@@ -365,104 +488,104 @@ class Profile(FreesideHandler):
         return
 
     member_util.SaveIfChanged(member)
+    if member.key() == self.principal.key:
+      # Keep the session's username and password_expired up to date.
+      self.principal = member_util.Principal.FromMember(member)
     self.redirect('/members/%s' % member.username)
 
 
 class Elections(FreesideHandler):
   """Serve the voting page."""
 
-  def _GetActiveElections(self, election_type):
-    if election_type not in freesidemodels.GetAllElectionTypes():
-      raise Error('Invalid election type')
-
-    return getattr(freesidemodels, election_type).all().filter(
-      'vote_end >=', datetime.datetime.now(timezones.UTC())).fetch(1000)
-
-  def _GetPreviousElections(self, election_type):
-    if election_type not in freesidemodels.GetAllElectionTypes():
-      raise Error('Invalid election type')
-
-    return getattr(freesidemodels, election_type).all().filter(
-      'vote_end <', datetime.datetime.now(timezones.UTC())).fetch(1000)
-
   @RedirectIfUnauthorized
   def get(self):
-    now = datetime.datetime.now(timezones.UTC())
-    current_elections = map(
-      self._GetActiveElections, freesidemodels.GetAllElectionTypes())
-    previous_elections = map(
-      self._GetPreviousElections, freesidemodels.GetAllElectionTypes())
-
-    # Flatten the elections lists
-    current_elections = [
-      election for elections in current_elections for election in elections]
-    previous_elections = [
-      election for elections in previous_elections for election in elections]
+    rpc_counter = rpc_util.RpcCounter()
+    now = datetime.datetime.now(timezones.UTC_TZ)
+    current_elections = election_util.GetCurrentElections()
+    previous_elections, previous_cursor = (
+        election_util.GetPreviousElectionsPage(
+            cursor=self.request.get('previous_cursor') or None))
 
     voting = []
     nominating = []
     ended = []
-    user = self.session['user']
+    user = self.principal
 
     # Sort current elections by voting and nominating
+    nominating_elections = []
+    voting_elections = []
     for election in current_elections:
-      nominate_start = election.nominate_start.replace(tzinfo=timezones.UTC())
-      nominate_end = election.nominate_end.replace(tzinfo=timezones.UTC())
-      vote_start = election.vote_start.replace(tzinfo=timezones.UTC())
-      vote_end = election.vote_end.replace(tzinfo=timezones.UTC())
+      nominate_start = election.nominate_start.replace(tzinfo=timezones.UTC_TZ)
+      nominate_end = election.nominate_end.replace(tzinfo=timezones.UTC_TZ)
+      vote_start = election.vote_start.replace(tzinfo=timezones.UTC_TZ)
+      vote_end = election.vote_end.replace(tzinfo=timezones.UTC_TZ)
 
       if nominate_start < now < nominate_end:
-        eligible = []
-        nominees = []
-        has_nominated = user.key() in election.nominators
-        for member in member_util.GetActiveMembers():
-          if member.key() not in election.nominees and member.key() != user.key():
-            eligible.append(member)
-
-        for nomineekey in election.nominees:
-          nominees.append(db.get(nomineekey))
-
-        nominating.append(
-            {'election': election,
-             'eligible': eligible,
-             'nominate_end': nominate_end.astimezone(timezones.Eastern()),
-             'nominees': nominees,
-             'has_nominated': has_nominated})
+        nominating_elections.append((election, nominate_end))
       elif vote_start < now < vote_end:
-        eligible = []
-        has_voted = user.key() in election.voters
-        for nominee in election.nominees:
-            eligible.append(db.get(nominee))
+        voting_elections.append((election, vote_end))
+
+    # Resolve every nominee and ballot across all elections in one batch.
+    keys = []
+    for election, _ in nominating_elections + voting_elections:
+      keys.extend(election.nominees)
+    people = member_util.GetPeopleByKeys(keys)
+    voting_views = [election_util.ElectionView(election)
+                    for election, _ in voting_elections]
+    if voting_views:
+      election_util.LoadBallots(voting_views, user.key)
+    if nominating_elections:
+      directory = list(member_util.GetMemberDirectory())
+    else:
+      directory = []
+
+    for election, nominate_end in nominating_elections:
+      view = election_util.ElectionView(election)
+      has_nominated = view.HasNominated(user.key)
+      eligible = [member for member in directory
+                  if view.CanBeNominatedBy(member.member_key, user.key)]
+
+      # Nominees deleted since they were nominated are left out.
+      nominees = [people[str(key)] for key in election.nominees
+                  if str(key) in people]
+
+      nominating.append(
+          {'election': election,
+           'eligible': eligible,
+           'nominate_end': nominate_end.astimezone(timezones.EASTERN_TZ),
+           'nominees': nominees,
+           'has_nominated': has_nominated})
+
+    for view, (election, vote_end) in zip(voting_views, voting_elections):
+      has_voted = view.HasVoted(user.key)
+      eligible = [people[str(key)] for key in election.nominees
+                  if str(key) in people]
 
-        voting.append(
-            {'election': election,
-             'eligible': eligible,
-             'has_voted': has_voted,
-             'vote_end': vote_end.astimezone(timezones.Eastern())})
+      voting.append(
+          {'election': election,
+           'eligible': eligible,
+           'has_voted': has_voted,
+           'vote_end': vote_end.astimezone(timezones.EASTERN_TZ)})
 
     for election in previous_elections:
-      vote_end = election.vote_end.replace(tzinfo=timezones.UTC())
+      vote_end = election.vote_end.replace(tzinfo=timezones.UTC_TZ)
 
-      total_votes = len(election.votes)
-      vote_totals = {}
-      for vote in election.votes:
-        member = db.get(vote)
-        if member.username in vote_totals:
-          vote_totals[member.username] += 1
-        else:
-          vote_totals[member.username] = 1
+      frozen = election_util.FreezeResults(election)
 
       ended.append(
           {'election': election,
-           'totals': sorted(vote_totals.iteritems(),
-                            key=operator.itemgetter(1),
-                            reverse=True),
-           'vote_end': vote_end.astimezone(timezones.Eastern())})
+           'counting': not frozen,
+           'totals': zip(election.result_usernames, election.result_counts),
+           'vote_end': vote_end.astimezone(timezones.EASTERN_TZ)})
+
+    logging.info('Elections page made %d datastore RPCs: %s',
+                 rpc_counter.Count('datastore_v3'), rpc_counter.Counts())
 
     template_values = {
         'voting': voting,
         'nominating': nominating,
-        'ended': ended}
+        'ended': ended,
+        'previous_cursor': previous_cursor}
     self.RenderTemplate('vote.html', template_values)
 
   @RedirectIfUnauthorized
@@ -479,14 +602,14 @@ class Elections(FreesideHandler):
         raise Error('You have not selected a member to nominate.')
 
       nominee = db.get(db.Key(nominee_key))
-      election_util.Nominate(election, nominee, self.session['user'])
+      election_util.Nominate(election, nominee, self.user)
 
     elif vote_key:
       if vote_key == "!none":
         raise Error('You have not selected a candidate in this election.')
 
       vote = db.get(db.Key(vote_key))
-      election_util.Vote(election, vote, self.session['user'])
+      election_util.Vote(election, vote, self.user)
 
     self.redirect('/elections')
 
@@ -496,30 +619,125 @@ class Dues(FreesideHandler):
   #TODO(raiford) eventually this will report payment status
   @RedirectIfUnauthorized
   def get(self):
-    template_values = {'starving': self.session['user'].starving}
+    template_values = {'starving': self.user.starving}
     self.RenderTemplate('dues.html', template_values)
 
 
 class Logout(FreesideHandler):
-  """Log the user out."""
+  """Log the user out of this browser, or everywhere with ?everywhere=1."""
   def get(self):
-    self.session.delete()
+    if self.request.get('everywhere') and self.CheckAuth():
+      member_util.EndSessions(self.principal.key)
+    if self.HasSession():
+      self.session.delete()
     self.redirect('/login')
 
 
+class BatchTask(webapp.RequestHandler):
+  """Task queue handler that runs a batch job one batch per task.
+
+  Subclasses set run_batch to a function taking a cursor keyword argument and
+  returning the cursor for the next batch, or None when the job is done.
+  """
+
+  run_batch = None
+
+  def get(self):
+    """Starts the job; cron requests arrive as GETs."""
+    taskqueue.add(url=self.request.path)
+
+  def post(self):
+    cursor = self.run_batch(cursor=self.request.get('cursor') or None)
+    if cursor:
+      taskqueue.add(url=self.request.path, params={'cursor': cursor})
+
+
+class BackfillDirectoryTask(BatchTask):
+  """Backfills member directory entries."""
+  run_batch = staticmethod(member_util.BackfillMemberDirectory)
+
+
+class MigrateAttachmentsTask(BatchTask):
+  """Moves inline Member blobs into MemberAttachment entities."""
+  run_batch = staticmethod(member_util.MigrateInlineAttachments)
+
+
+class MigrateElectionsTask(BatchTask):
+  """Moves elections stored under per-type kinds to the Election kind."""
+  run_batch = staticmethod(election_util.MigrateLegacyElections)
+
+
+class MigrateCacheTask(BatchTask):
+  """Moves cache entries to entities addressed by key name."""
+  run_batch = staticmethod(Cache.migrate_to_key_names)
+
+
+# Sweepers run in order by SweepExpired, each until it returns no cursor.
+_SWEEPERS = (Session.sweep_expired,
+             Session.sweep_orphaned_data,
+             Cache.sweep_expired)
+
+
+def SweepExpired(cursor=None):
+  """Runs one batch of the expired session and cache sweepers.
+
+  Args:
+    cursor: str, '<sweeper index>:<sweeper cursor>' from the previous batch.
+  Returns:
+    str cursor for the next batch, or None when every sweeper is done.
+  """
+  index, sweeper_cursor = 0, None
+  if cursor:
+    index, sweeper_cursor = cursor.split(':', 1)
+    index = int(index)
+  sweeper_cursor = _SWEEPERS[index](cursor=sweeper_cursor or None)
+  if sweeper_cursor:
+    return '%d:%s' % (index, sweeper_cursor)
+  if index + 1 < len(_SWEEPERS):
+    return '%d:' % (index + 1)
+  return None
+
+
+class SweepTask(BatchTask):
+  """Deletes expired sessions and cache entries outside the request path."""
+  run_batch = staticmethod(SweepExpired)
+
+
+class DeleteAllSessionsTask(BatchTask):
+  """Deletes every datastore session, logging everyone out.
+
+  Signed cookie sessions aren't stored; bump SIGNED_COOKIE_KEY_VERSION twice
+  to end those.
+  """
+  run_batch = staticmethod(Session.delete_sessions_batch)
+
+
+_URL_MAP = [
+    (r'/', HomePage),
+    (r'/login', LoginPage),
+    (r'/home/?', HomePage),
+    (r'/dues/?', Dues),
+    (r'/admindues/?', AdminDues),
+    (r'/admin/?', AdminPage),
+    (r'/members/?', MembersList),
+    (r'/members/(.*)', Profile),
+    (r'/logout', Logout),
+    (r'/elections/?', Elections),
+    (r'/tasks/backfill_directory', BackfillDirectoryTask),
+    (r'/tasks/migrate_attachments', MigrateAttachmentsTask),
+    (r'/tasks/migrate_elections', MigrateElectionsTask),
+    (r'/tasks/migrate_cache', MigrateCacheTask),
+    (r'/tasks/sweep', SweepTask),
+    (r'/tasks/delete_all_sessions', DeleteAllSessionsTask),
+]
+
+# Built once per instance.  Handlers send headers through the response, so
+# the application can be served as a long-lived WSGI app.
+application = webapp.WSGIApplication(_URL_MAP, debug=True)
+
+
 def main():
-  url_map = {
-    r'/': HomePage,
-    r'/login': LoginPage,
-    r'/home/?': HomePage,
-    r'/dues/?': Dues,
-    r'/admindues/?': AdminDues,
-    r'/admin/?': AdminPage,
-    r'/members/?': MembersList,
-    r'/members/(.*)': Profile,
-    r'/logout': Logout,
-    r'/elections/?': Elections}
-  util.run_wsgi_app(webapp.WSGIApplication(url_map.items(), debug=True))
+  util.run_wsgi_app(application)
 
 
 if __name__ == '__main__':
@@ -5,6 +5,7 @@
 import hashlib
 
 from google.appengine.ext import db
+from google.appengine.ext.db import polymodel
 
 
 class Person(db.Model):
@@ -44,15 +45,79 @@ class Member(Person):
   introductory = db.BooleanProperty(default=False)
   starving = db.BooleanProperty(default=False)
   rfid = db.IntegerProperty()
-  doormusic = db.BlobProperty()
   liability = db.BooleanProperty(default=False)
+  website = db.StringProperty()
+  # Sessions remember the generation they were started under, and end once
+  # it changes.  Bumped by member_util.EndSessions and password changes.
+  session_generation = db.IntegerProperty(default=0)
+  # Legacy inline attachments.  New data lives in MemberAttachment; these are
+  # only read by member_util.MigrateInlineAttachments, which clears them.
+  doormusic = db.BlobProperty()
   liabilitypdf = db.BlobProperty()
   picture = db.BlobProperty()
-  website = db.StringProperty()
 
 
-class Election(db.Model):
-  """Election Base Class."""
+class MemberAttachment(db.Model):
+  """A binary attachment for a Member, fetched only when it is needed.
+
+  Stored as a child of its Member, with the attachment name (one of
+  ATTACHMENT_NAMES) as the key name.
+  """
+
+  ATTACHMENT_NAMES = ('doormusic', 'liabilitypdf', 'picture')
+
+  content = db.BlobProperty(required=True)
+  content_type = db.StringProperty()
+
+
+class MemberDirectoryEntry(db.Model):
+  """Compact copy of a Member's listing fields, without any blob payloads.
+
+  Stored as a child of its Member (key name 'directory') so it can be written
+  in the same transaction.  Kept in sync by member_util.SaveMember.
+  """
+
+  KEY_NAME = 'directory'
+
+  username = db.StringProperty(required=True)
+  email = db.EmailProperty(required=True)
+  joined = db.DateProperty()
+  active = db.BooleanProperty(default=True)
+  admin = db.BooleanProperty(default=False)
+  # Lowercased username; the directory is listed in this order.
+  sortkey = db.StringProperty()
+
+  member_key = property(lambda self: self.parent_key())
+
+  @classmethod
+  def FromMember(cls, member):
+    """Builds the directory entry for a saved member.
+
+    Args:
+      member: Member, a member that has already been put.
+    Returns:
+      MemberDirectoryEntry
+    """
+    return cls(
+        parent=member,
+        key_name=cls.KEY_NAME,
+        username=member.username,
+        email=member.email,
+        joined=member.joined,
+        active=member.active,
+        admin=member.admin,
+        sortkey=member.username.lower())
+
+
+class Election(polymodel.PolyModel):
+  """Election Base Class.
+
+  All election types are stored as the Election kind, so a single query
+  returns every type.  Elections saved under their own type's kind before
+  this are moved over by election_util.MigrateLegacyElections.
+  """
+
+  LEGACY_KINDS = ('OfficerElection', 'BoardElection')
 
   position = db.StringProperty(required=True)
   description = db.TextProperty()
@@ -62,16 +127,81 @@ class Election(db.Model):
   vote_end = db.DateTimeProperty(required=True)
   # Unique list of Nominees
   nominees = db.ListProperty(item_type=db.Key)
-  # List of votes stored as keys to Members or boardmembers
-  votes = db.ListProperty(item_type=db.Key)
-  # Unique list of member keys to prevent double voting.
+  # Unique list of member keys to prevent double nominating.
   nominators = db.ListProperty(item_type=db.Key)
+  # Votes are recorded in BallotShards.  votes and voters only hold votes cast
+  # before ballots were sharded.
+  votes = db.ListProperty(item_type=db.Key)
   voters = db.ListProperty(item_type=db.Key)
+  # Number of BallotShards votes are spread over.  Must not change once
+  # voting has started.
+  ballot_shards = db.IntegerProperty(default=10)
+  # Results snapshot taken once voting has ended, by
+  # election_util.FreezeResults.  Sorted by vote count, highest first.
+  results_frozen = db.BooleanProperty(default=False)
+  result_usernames = db.StringListProperty()
+  result_counts = db.ListProperty(item_type=int)
+
+
+class BallotShard(db.Model):
+  """One shard of an election's vote counts.
+
+  Each ballot is counted on a shard picked at random, so concurrent voters
+  are spread over separate entity groups.  Shards hold no voter keys: who
+  voted is recorded on BallotReceipts.  The key name is
+  KeyName(election key, index).
+  """
+
+  # candidates[i] has received counts[i] votes in this shard.
+  candidates = db.ListProperty(item_type=db.Key)
+  counts = db.ListProperty(item_type=int)
+
+  @staticmethod
+  def KeyName(election_key, index):
+    return '%s:%d' % (election_key, index)
+
+
+class CountedBallot(db.Model):
+  """Marks a ballot as counted on a BallotShard.
+
+  A child of the shard, keyed by the ballot's random id, so a retried count
+  isn't added twice without the shard keeping a growing list of ids.
+  """
+
+  @staticmethod
+  def KeyFor(shard_key_name, ballot):
+    return db.Key.from_path(
+        'BallotShard', shard_key_name, 'CountedBallot', ballot)
+
+
+class BallotReceipt(db.Model):
+  """Records that a member has voted in an election.
+
+  The key name is KeyName(election key, VoterHash(voter key)), so each
+  receipt is its own entity group.  While the ballot is being counted the
+  receipt also holds it; once counted, ballot, shard and candidate are
+  cleared and the receipt no longer says how the member voted.
+  """
+
+  election = db.ReferenceProperty(Election, collection_name='receipts')
+  voter_hash = db.StringProperty()
+  # Set only until the ballot has been counted on its shard.
+  ballot = db.StringProperty()
+  shard = db.IntegerProperty()
+  candidate = db.StringProperty()
+
+  @staticmethod
+  def VoterHash(voter_key):
+    return hashlib.sha256(str(voter_key)).hexdigest()
+
+  @staticmethod
+  def KeyName(election_key, voter_hash):
+    return '%s:%s' % (election_key, voter_hash)
 
 
 def GetAllElectionTypes():
   """Gets all valid election types."""
-  return [s.__name__ for s in Election.__subclasses__()]
+  return list(_ELECTION_TYPES)
 
 
 class OfficerElection(Election):
@@ -82,6 +212,9 @@ class BoardElection(Election):
   """A Board Member Election."""
 
 
+_ELECTION_TYPES = tuple([s.__name__ for s in Election.__subclasses__()])
+
+
 class Payment(db.Model):
   """Base class for Payments."""
   gross = db.FloatProperty(required=True)
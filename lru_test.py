@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Unittest for appengine_utilities/lru.py"""
+
+import time
+import unittest
+
+from appengine_utilities import lru
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = lru.LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEquals(1, cache.get('a'))
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(3, cache.get('c'))
+        self.assertEquals(2, len(cache))
+
+    def testExpires(self):
+        cache = lru.LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2, 120)
+        orig_time = time.time
+        time.time = lambda: orig_time() + 61
+        try:
+            self.assertEquals(None, cache.get('a'))
+            self.assertEquals(2, cache.get('b'))
+        finally:
+            time.time = orig_time
+        self.assertEquals(1, len(cache))
+
+    def testDefault(self):
+        cache = lru.LRUCache(2, 60)
+        self.assertEquals('missing', cache.get('a', 'missing'))
+        cache.set('a', 1, -1)
+        self.assertEquals('expired', cache.get('a', 'expired'))
+
+    def testNoTtl(self):
+        cache = lru.LRUCache(2)
+        cache.set('a', 1)
+        orig_time = time.time
+        time.time = lambda: orig_time() + 10 ** 9
+        try:
+            self.assertEquals(1, cache.get('a'))
+        finally:
+            time.time = orig_time
+
+    def testMaxBytes(self):
+        cache = lru.LRUCache(10, 60, max_bytes=10)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        cache.get('a')
+        cache.set('c', 'x' * 4)
+        self.assertEquals(None, cache.get('b'))
+        self.assertEquals(8, cache.bytes)
+        cache.set('d', 'x' * 11)
+        self.assertEquals(None, cache.get('d'))
+        self.assertEquals(2, len(cache))
+        # Other values are measured by their pickle.
+        cache.set('e', range(100))
+        self.assertEquals(None, cache.get('e'))
+        cache.delete('a')
+        cache.clear()
+        self.assertEquals(0, cache.bytes)
+
+    def testDeleteAndClear(self):
+        cache = lru.LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        cache.delete('missing')
+        self.assertEquals(None, cache.get('a'))
+        cache.clear()
+        self.assertEquals(0, len(cache))
+        cache.set('c', 3)
+        self.assertEquals(3, cache.get('c'))
+
+    def testDisabled(self):
+        cache = lru.LRUCache(0, 60)
+        cache.set('a', 1)
+        self.assertEquals(None, cache.get('a'))
+        self.assertEquals(0, len(cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
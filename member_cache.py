@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""Two-tier cache of Member entities: an in-instance LRU in front of memcache.
+
+Entities are cached under their key.  Lookups by username or email go through
+small index entries that point at the key, and the entity found is checked
+against the requested value, so an index left behind by a rename or email
+change is simply a miss.
+
+Memcache entries are removed by Invalidate.  In-instance entries on other
+instances can't be reached from here, so they expire after LOCAL_TTL seconds.
+
+Put fills the cache after a datastore read with memcache.add, and Invalidate
+replaces entries with placeholders that block those adds for INVALIDATE_LOCK
+seconds.  A read that raced a save therefore can't put the old entity back.
+"""
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+from appengine_utilities.lru import LRUCache
+
+
+LOCAL_SIZE = 500
+# Seconds an in-instance entry is trusted before going back to memcache.
+LOCAL_TTL = 10
+MEMCACHE_TTL = 600
+# Seconds after an Invalidate during which Put can't refill memcache.  Longer
+# than a datastore read should take.
+INVALIDATE_LOCK = 10
+# Memcache value left by Invalidate, read as a miss.
+_INVALIDATED = ''
+MEMCACHE_PREFIX = 'member-cache:'
+
+_STAT_NAMES = ('local_hits', 'memcache_hits', 'misses')
+
+
+_local = LRUCache(LOCAL_SIZE, LOCAL_TTL)
+_stats = dict.fromkeys(_STAT_NAMES, 0)
+
+
+def _KeyId(key):
+    return 'key:%s' % key
+
+
+def _IndexId(field, value):
+    return '%s:%s' % (field, value)
+
+
+def _Encode(member):
+    return db.model_to_protobuf(member).Encode()
+
+
+def _Decode(data):
+    return db.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+def _GetEncoded(key):
+    """Gets an encoded entity from the in-instance tier, then memcache."""
+    cache_id = _KeyId(key)
+    data = _local.get(cache_id)
+    if data is not None:
+        _stats['local_hits'] += 1
+        return data
+    data = memcache.get(MEMCACHE_PREFIX + cache_id)
+    if data is None or data == _INVALIDATED:
+        return None
+    _stats['memcache_hits'] += 1
+    _local.set(cache_id, data)
+    return data
+
+
+def Get(key):
+    """Gets a cached Member by key.
+
+    Each call returns a fresh copy, so callers may modify it.
+
+    Args:
+      key: db.Key
+    Returns:
+      freesidemodels.Member, or None on a miss.
+    """
+    data = _GetEncoded(key)
+    if data is None:
+        _stats['misses'] += 1
+        return None
+    return _Decode(data)
+
+
+def GetMany(keys):
+    """Gets cached Members for several keys, with one memcache call.
+
+    Args:
+      keys: list of db.Key
+    Returns:
+      dict mapping str(key) to freesidemodels.Member for every key found.
+    """
+    found = {}
+    missing = []
+    for key in map(str, keys):
+        data = _local.get(_KeyId(key))
+        if data is None:
+            missing.append(key)
+        else:
+            _stats['local_hits'] += 1
+            found[key] = data
+    if missing:
+        cached = memcache.get_multi(
+            map(_KeyId, missing), key_prefix=MEMCACHE_PREFIX)
+        for key in missing:
+            data = cached.get(_KeyId(key))
+            if data is None or data == _INVALIDATED:
+                _stats['misses'] += 1
+            else:
+                _stats['memcache_hits'] += 1
+                _local.set(_KeyId(key), data)
+                found[key] = data
+    return dict([(key, _Decode(data)) for key, data in found.iteritems()])
+
+
+def GetByIndex(field, value):
+    """Gets a cached Member by the value of an indexed field.
+
+    Args:
+      field: str, 'username' or 'email'.
+      value: str, value to look up.
+    Returns:
+      freesidemodels.Member, or None on a miss.
+    """
+    index_id = _IndexId(field, value)
+    key = _local.get(index_id)
+    if key is None:
+        key = memcache.get(MEMCACHE_PREFIX + index_id)
+        if key == _INVALIDATED:
+            key = None
+        if key is not None:
+            _local.set(index_id, key)
+    member = None
+    if key is not None:
+        data = _GetEncoded(key)
+        if data is not None:
+            member = _Decode(data)
+    if member is None or getattr(member, field) != value:
+        _stats['misses'] += 1
+        return None
+    return member
+
+
+def Put(member):
+    """Caches a Member just read from datastore under its key, username and
+    email.
+
+    Entries already cached, or invalidated in the last INVALIDATE_LOCK
+    seconds, are left alone.
+    """
+    key = str(member.key())
+    data = _Encode(member)
+    mapping = {
+        _KeyId(key): data,
+        _IndexId('username', member.username): key,
+        _IndexId('email', member.email): key,
+    }
+    not_added = memcache.add_multi(
+        mapping, time=MEMCACHE_TTL, key_prefix=MEMCACHE_PREFIX)
+    for cache_id, value in mapping.iteritems():
+        if cache_id not in not_added:
+            _local.set(cache_id, value)
+
+
+def Invalidate(member):
+    """Removes a Member from the cache.
+
+    Index entries for its old username and email need not be removed, as
+    lookups check them against the entity.
+    """
+    cache_ids = [_KeyId(member.key()),
+                 _IndexId('username', member.username),
+                 _IndexId('email', member.email)]
+    for cache_id in cache_ids:
+        _local.delete(cache_id)
+    memcache.set_multi(dict.fromkeys(cache_ids, _INVALIDATED),
+                       time=INVALIDATE_LOCK, key_prefix=MEMCACHE_PREFIX)
+
+
+def GetStats():
+    """Gets hit and miss counters for this instance.
+
+    Returns:
+      dict with 'local_hits', 'memcache_hits' and 'misses' counts.
+    """
+    return dict(_stats)
+
+
+def Clear():
+    """Empties the in-instance tier and resets the counters."""
+    _local.clear()
+    for name in _STAT_NAMES:
+        _stats[name] = 0
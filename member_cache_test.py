@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""Unittest for member_cache.py"""
+
+import unittest
+
+from google.appengine.api import memcache
+
+import member_cache
+import random_util
+import test_util
+
+
+class MemberCacheTest(test_util.AppEngineTestBase):
+
+    def setUp(self):
+        test_util.AppEngineTestBase.setUp(self)
+        self.member = random_util.Member()
+        self.member.put()
+
+    def testPutAndGet(self):
+        self.assertEquals(None, member_cache.Get(self.member.key()))
+        member_cache.Put(self.member)
+        self.assertEquals(
+            self.member.username, member_cache.Get(self.member.key()).username)
+        self.assertEquals(
+            self.member.key(),
+            member_cache.GetByIndex('username', self.member.username).key())
+        self.assertEquals(
+            self.member.key(),
+            member_cache.GetByIndex('email', self.member.email).key())
+        self.assertEquals(
+            {'local_hits': 3, 'memcache_hits': 0, 'misses': 1},
+            member_cache.GetStats())
+
+    def testGetMany(self):
+        other = random_util.Member()
+        other.put()
+        member_cache.Put(self.member)
+        member_cache.Put(other)
+        member_cache.Clear()
+        member_cache.Get(self.member.key())
+
+        members = member_cache.GetMany(
+            [self.member.key(), other.key(), random_util.Member().put()])
+        self.assertEquals(
+            sorted([str(self.member.key()), str(other.key())]),
+            sorted(members.keys()))
+        self.assertEquals(
+            {'local_hits': 1, 'memcache_hits': 2, 'misses': 1},
+            member_cache.GetStats())
+
+    def testGetReturnsCopies(self):
+        member_cache.Put(self.member)
+        member_cache.Get(self.member.key()).username = 'changed'
+        self.assertEquals(
+            self.member.username, member_cache.Get(self.member.key()).username)
+
+    def testStaleIndexIsAMiss(self):
+        member_cache.Put(self.member)
+        old_username = self.member.username
+        self.member.username = 'renamed'
+        # Saving drops the entity, but not the old username's index entry.
+        memcache.delete(
+            member_cache.MEMCACHE_PREFIX + member_cache._KeyId(
+                self.member.key()))
+        member_cache.Clear()
+        member_cache.Put(self.member)
+        self.assertEquals(None, member_cache.GetByIndex('username',
+                                                        old_username))
+
+    def testInvalidate(self):
+        member_cache.Put(self.member)
+        member_cache.Invalidate(self.member)
+        self.assertEquals(None, member_cache.Get(self.member.key()))
+        self.assertEquals(
+            None, member_cache.GetByIndex('username', self.member.username))
+
+    def testPutRacingInvalidateIgnored(self):
+        # A read that started before a save fills the cache after the save
+        # invalidated it.
+        stale_username = self.member.username
+        self.member.username = 'saved'
+        member_cache.Invalidate(self.member)
+        self.member.username = stale_username
+        member_cache.Put(self.member)
+        self.assertEquals(None, member_cache.Get(self.member.key()))
+
+    def testPutDoesNotOverwrite(self):
+        member_cache.Put(self.member)
+        username = self.member.username
+        self.member.username = 'other'
+        member_cache.Put(self.member)
+        self.assertEquals(
+            username, member_cache.Get(self.member.key()).username)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,13 +2,76 @@
 
 """Utility functions for dealing with members."""
 
+import time
+
 from google.appengine.ext import db
 from google.appengine.api import mail
 
 import freesidemodels
+import member_cache
+import query_util
 import random_util
 
 
+class Principal(object):
+    """The few fields of a logged-in member that most pages need.
+
+    This is what the session stores, as a dict from ToDict, so the session
+    never holds a full Member.  Use GetMemberByKey(principal.key) for the rest.
+    checked is when the fields were last copied from the member, in seconds
+    since the epoch.
+    """
+
+    def __init__(self, key, username, admin=False, password_expired=False,
+                 session_generation=0, checked=0):
+        self.key = db.Key(str(key))
+        self.username = username
+        self.admin = admin
+        self.password_expired = password_expired
+        self.session_generation = session_generation
+        self.checked = checked
+
+    @classmethod
+    def FromMember(cls, member):
+        """Creates a principal for a saved member."""
+        return cls(member.key(), member.username, admin=member.admin,
+                   password_expired=member.password_expired,
+                   session_generation=member.session_generation,
+                   checked=int(time.time()))
+
+    @classmethod
+    def FromDict(cls, values):
+        """Creates a principal from the output of ToDict."""
+        return cls(values['key'], values['username'], admin=values['admin'],
+                   password_expired=values['password_expired'],
+                   session_generation=values.get('session_generation', 0),
+                   checked=values.get('checked', 0))
+
+    def ToDict(self):
+        """Gets a plain dict of this principal, suitable for the session."""
+        return {'key': str(self.key),
+                'username': self.username,
+                'admin': self.admin,
+                'password_expired': self.password_expired,
+                'session_generation': self.session_generation,
+                'checked': self.checked}
+
+    def NeedsCheck(self, seconds):
+        """Whether seconds have passed since the member was last checked."""
+        return self.checked + seconds <= time.time()
+
+    def IsCurrent(self, member):
+        """Whether this principal's session is still valid for the member.
+
+        Args:
+          member: freesidemodels.Member or None, the principal's member.
+        Returns:
+          bool, False if the member is gone or their sessions were ended.
+        """
+        return (member is not None
+                and member.session_generation == self.session_generation)
+
+
 def MakeMember(*args, **kwargs):
     """Helper function for creating a new member.
 
@@ -27,6 +90,9 @@ def MakeMember(*args, **kwargs):
 def SaveMember(member):
     """Saves a member to datastore, with a transaction.
 
+    The member's directory entry is written in the same transaction, and the
+    member is dropped from the member cache.
+
     Args:
       member: freesidemodels.Member
     Returns:
@@ -34,7 +100,29 @@ def SaveMember(member):
     """
     def DoPut(member):
         member.put()
+        freesidemodels.MemberDirectoryEntry.FromMember(member).put()
     db.run_in_transaction(DoPut, member)
+    member_cache.Invalidate(member)
+    return member
+
+
+def EndSessions(key):
+    """Ends every session of a member, such as on logging out everywhere.
+
+    Args:
+      key: db.Key, the member's key.
+    Returns:
+      freesidemodels.Member, or None if there is no such member.
+    """
+    def DoEnd():
+        member = db.get(key)
+        if member is not None:
+            member.session_generation += 1
+            member.put()
+        return member
+    member = db.run_in_transaction(DoEnd)
+    if member is not None:
+        member_cache.Invalidate(member)
     return member
 
 
@@ -54,35 +142,262 @@ def SaveIfChanged(new_member):
     return new_member
 
 
-def GetActiveMembers():
+def _IterQuery(q, batch_size):
+    """Yields every result of a query, fetching batch_size at a time.
+
+    Args:
+      q: db.Query
+      batch_size: int, number of entities to fetch per datastore call.
+    Yields:
+      db.Model instances
+    """
+    while True:
+        results = q.fetch(batch_size)
+        for result in results:
+            yield result
+        if len(results) < batch_size:
+            return
+        q.with_cursor(q.cursor())
+
+
+def GetActiveMembers(batch_size=100):
     """Gets all active members from datastore.
 
+    Args:
+      batch_size: int, number of members to fetch per datastore call.
+    Yields:
+      freesidemodels.Member
+    """
+    return _IterQuery(
+        freesidemodels.Member.all().filter('active =', True), batch_size)
+
+
+def _MemberDirectoryQuery(active):
+    q = freesidemodels.MemberDirectoryEntry.all()
+    if active:
+        q.filter('active =', True)
+    return q.order('sortkey')
+
+
+def GetMemberDirectory(active=True, batch_size=100):
+    """Gets directory entries for members, ordered by username.
+
+    Use this instead of GetActiveMembers for pages that only list members.
+
+    Args:
+      active: bool, whether to fetch only active members.
+      batch_size: int, number of entries to fetch per datastore call.
+    Yields:
+      freesidemodels.MemberDirectoryEntry
+    """
+    return _IterQuery(_MemberDirectoryQuery(active), batch_size)
+
+
+def GetMemberDirectoryPage(cursor=None, page_size=50, active=True):
+    """Gets one page of directory entries, ordered by username.
+
+    Args:
+      cursor: str, cursor returned with the previous page.
+      page_size: int, number of entries per page.
+      active: bool, whether to fetch only active members.
     Returns:
-      list of freesidemodels.Member
+      (list of freesidemodels.MemberDirectoryEntry, str cursor for the next
+      page or None if this is the last page).  A full last page still
+      returns a cursor, whose page will be empty.  A malformed cursor gets
+      the first page.
     """
-    return freesidemodels.Member.all().filter('active =', True).fetch(1000)
+    return query_util.FetchPage(_MemberDirectoryQuery(active), cursor,
+                                page_size)
 
 
-def GetMemberByUsername(username, active=True):
-    """Gets a member by his or her username.
+def BackfillMemberDirectory(cursor=None, batch_size=100):
+    """Writes directory entries for one batch of existing members.
+
+    Members saved before the directory existed (or loaded with the bulk
+    loader) have no entry.  Call repeatedly with the returned cursor until it
+    returns None.
 
     Args:
-      username: str, the member's username.
+      cursor: str, query cursor returned by the previous call.
+      batch_size: int, number of members to process.
+    Returns:
+      str cursor for the next batch, or None when done.
+    """
+    q = freesidemodels.Member.all()
+    if cursor:
+        q.with_cursor(cursor)
+    members = q.fetch(batch_size)
+    db.put([freesidemodels.MemberDirectoryEntry.FromMember(m)
+            for m in members])
+    if len(members) < batch_size:
+        return None
+    return q.cursor()
+
+
+def GetAttachment(member_key, name):
+    """Gets one of a member's binary attachments.
+
+    Args:
+      member_key: db.Key, key of the member.
+      name: str, one of freesidemodels.MemberAttachment.ATTACHMENT_NAMES.
+    Returns:
+      freesidemodels.MemberAttachment or None
+    """
+    _ValidateAttachmentName(name)
+    return freesidemodels.MemberAttachment.get_by_key_name(
+        name, parent=member_key)
+
+
+def SaveAttachment(member, name, content, content_type=None):
+    """Stores a binary attachment for a member.
+
+    Args:
+      member: freesidemodels.Member, a saved member.
+      name: str, one of freesidemodels.MemberAttachment.ATTACHMENT_NAMES.
+      content: str, the attachment bytes.
+      content_type: str, optional MIME type.
+    Returns:
+      freesidemodels.MemberAttachment
+    """
+    _ValidateAttachmentName(name)
+    attachment = freesidemodels.MemberAttachment(
+        parent=member, key_name=name, content=content,
+        content_type=content_type)
+    attachment.put()
+    return attachment
+
+
+def _ValidateAttachmentName(name):
+    if name not in freesidemodels.MemberAttachment.ATTACHMENT_NAMES:
+        raise ValueError('Invalid attachment name: %s' % name)
+
+
+def MigrateInlineAttachments(cursor=None, batch_size=10):
+    """Moves one batch of inline Member blobs into MemberAttachment entities.
+
+    Each member is migrated in its own transaction, so the job can be
+    interrupted and re-run safely.  Call repeatedly with the returned cursor
+    until it returns None.
+
+    Args:
+      cursor: str, query cursor returned by the previous call.
+      batch_size: int, number of members to process.  Keep this small, as
+        each is read in full, blobs included, in its own transaction.
+    Returns:
+      str cursor for the next batch, or None when done.
+    """
+    def DoMigrate(key):
+        # Re-read the member, so edits made since the query aren't lost.
+        member = db.get(key)
+        if member is None:
+            return None
+        to_put = []
+        for name in freesidemodels.MemberAttachment.ATTACHMENT_NAMES:
+            content = getattr(member, name)
+            if content:
+                to_put.append(freesidemodels.MemberAttachment(
+                    parent=member, key_name=name, content=content))
+                setattr(member, name, None)
+        if not to_put:
+            return None
+        to_put.append(member)
+        db.put(to_put)
+        return member
+
+    q = freesidemodels.Member.all(keys_only=True)
+    if cursor:
+        q.with_cursor(cursor)
+    keys = q.fetch(batch_size)
+    for key in keys:
+        member = db.run_in_transaction(DoMigrate, key)
+        if member is not None:
+            # Cached copies still hold the blobs, and saving one would put
+            # them back.
+            member_cache.Invalidate(member)
+    if len(keys) < batch_size:
+        return None
+    return q.cursor()
+
+
+def GetMemberByKey(key):
+    """Gets a member by key, from the member cache if possible.
+
+    Args:
+      key: db.Key or str, the member's key.
+    Returns:
+      freesidemodels.Member or None
+    """
+    member = member_cache.Get(key)
+    if member is None:
+        member = freesidemodels.Member.get(key)
+        if member is not None:
+            member_cache.Put(member)
+    return member
+
+
+def GetPeopleByKeys(keys):
+    """Gets members and other people for a list of keys, in one batch.
+
+    Members come from the member cache where possible, and everything else is
+    fetched with a single datastore get.
+
+    Args:
+      keys: list of db.Key, may contain duplicates.
+    Returns:
+      dict mapping str(key) to freesidemodels.Person for every key found.
+    """
+    keys = dict([(str(key), key) for key in keys])
+    people = member_cache.GetMany(keys.values())
+    missing = [key for key_str, key in keys.iteritems()
+               if key_str not in people]
+    if missing:
+        for person in db.get(missing):
+            if person is None:
+                continue
+            if isinstance(person, freesidemodels.Member):
+                member_cache.Put(person)
+            people[str(person.key())] = person
+    return people
+
+
+def _GetMemberByField(field, value, active):
+    """Gets a member by username or email, from the member cache if possible.
+
+    Args:
+      field: str, 'username' or 'email'.
+      value: str, value to look up.
       active: bool, whether to fetch only an active member.
     Returns:
       freesidemodels.Member or None
     """
-    q = freesidemodels.Member.all().filter('username =', username)
+    member = member_cache.GetByIndex(field, value)
+    if member is not None and (member.active or not active):
+        return member
+
+    q = freesidemodels.Member.all().filter('%s =' % field, value)
     if active:
         q.filter('active =', True)
 
     result = q.fetch(1)
     if len(result) == 1:
+        member_cache.Put(result[0])
         return result[0]
     else:
         return None
 
 
+def GetMemberByUsername(username, active=True):
+    """Gets a member by his or her username.
+
+    Args:
+      username: str, the member's username.
+      active: bool, whether to fetch only an active member.
+    Returns:
+      freesidemodels.Member or None
+    """
+    return _GetMemberByField('username', username, active)
+
+
 def GetMemberByEmail(email, active=True):
     """Gets a member by his or her email address.
 
@@ -92,15 +407,7 @@ def GetMemberByEmail(email, active=True):
     Returns:
       freesidemodels.Member or None
     """
-    q = freesidemodels.Member.all().filter('email =', email)
-    if active:
-        q.filter('active =', True)
-
-    result = q.fetch(1)
-    if len(result) == 1:
-        return result[0]
-    else:
-        return None
+    return _GetMemberByField('email', email, active)
 
 
 def IsActiveMember(person):
@@ -124,6 +431,7 @@ def ResetAndEmailPassword(member):
   temp_password = random_util.UnencryptedPassword()
   member.password = freesidemodels.Person.EncryptPassword(temp_password)
   member.password_expired = True
+  member.session_generation += 1
   SaveMember(member)
 
   # Email the new password to the member
@@ -5,9 +5,14 @@
 import random
 import unittest
 
+from google.appengine.api import memcache
+from google.appengine.ext import db
+
 import freesidemodels
+import member_cache
 import member_util
 import random_util
+import rpc_util
 import test_util
 
 
@@ -53,6 +58,8 @@ class MemberUtilTest(test_util.AppEngineTestBase):
         self.active_members = []
         self.inactive_members = []
         self.SeedMembers()
+        # Saving left invalidation placeholders, which block caching.
+        memcache.flush_all()
 
     def SeedMembers(self):
         def DoSeed(count, member_list, active):
@@ -75,7 +82,131 @@ class MemberUtilTest(test_util.AppEngineTestBase):
     def testGetActiveMembers(self):
         self.assertEquals(
             map(GetKey, self.active_members),
-            map(GetKey, member_util.GetActiveMembers()))
+            map(GetKey, member_util.GetActiveMembers(batch_size=3)))
+
+    def testSaveMemberWritesDirectoryEntry(self):
+        member = self.active_members[0]
+        member.email = 'zoidberg@planex.com'
+        member_util.SaveMember(member)
+        entry = freesidemodels.MemberDirectoryEntry.get_by_key_name(
+            freesidemodels.MemberDirectoryEntry.KEY_NAME, parent=member)
+        self.assertEquals(member.key(), entry.member_key)
+        self.assertEquals(member.username, entry.username)
+        self.assertEquals('zoidberg@planex.com', entry.email)
+
+    def testGetMemberDirectory(self):
+        entries = list(member_util.GetMemberDirectory(batch_size=3))
+        self.assertEquals(
+            sorted(map(GetKey, self.active_members)),
+            sorted([e.member_key for e in entries]))
+        sortkeys = [e.sortkey for e in entries]
+        self.assertEquals(sorted(sortkeys), sortkeys)
+        self.assertEquals(
+            20, len(list(member_util.GetMemberDirectory(active=False))))
+
+    def testGetMemberDirectoryPage(self):
+        seen = []
+        cursor = None
+        pages = 0
+        while True:
+            entries, cursor = member_util.GetMemberDirectoryPage(
+                cursor=cursor, page_size=4)
+            seen.extend(entries)
+            pages += 1
+            if cursor is None:
+                break
+        self.assertEquals(3, pages)
+        self.assertEquals(
+            sorted(map(GetKey, self.active_members)),
+            sorted([e.member_key for e in seen]))
+
+    def testBackfillMemberDirectory(self):
+        member = random_util.Member()
+        member.put()
+        cursor = member_util.BackfillMemberDirectory(batch_size=15)
+        self.assertNotEquals(None, cursor)
+        self.assertEquals(
+            None, member_util.BackfillMemberDirectory(cursor=cursor,
+                                                      batch_size=15))
+        self.assertTrue(
+            member.key() in
+            [e.member_key for e in member_util.GetMemberDirectory()])
+
+    def testSaveAndGetAttachment(self):
+        member = self.active_members[0]
+        self.assertEquals(None, member_util.GetAttachment(member.key(),
+                                                          'picture'))
+        member_util.SaveAttachment(member, 'picture', 'png', 'image/png')
+        attachment = member_util.GetAttachment(member.key(), 'picture')
+        self.assertEquals('png', attachment.content)
+        self.assertEquals('image/png', attachment.content_type)
+        self.assertRaises(
+            ValueError, member_util.GetAttachment, member.key(), 'resume')
+
+    def testMigrateInlineAttachments(self):
+        member = self.active_members[0]
+        member.picture = 'png'
+        member.doormusic = 'mp3'
+        member.put()
+        # Cache the blob-laden member.
+        member_util.GetMemberByKey(member.key())
+
+        cursor = member_util.MigrateInlineAttachments(batch_size=15)
+        self.assertNotEquals(None, cursor)
+        self.assertEquals(
+            None,
+            member_util.MigrateInlineAttachments(cursor=cursor, batch_size=15))
+
+        member = freesidemodels.Member.get(member.key())
+        self.assertEquals(None, member.picture)
+        self.assertEquals(None, member.doormusic)
+        self.assertEquals(
+            'png', member_util.GetAttachment(member.key(), 'picture').content)
+        self.assertEquals(
+            'mp3',
+            member_util.GetAttachment(member.key(), 'doormusic').content)
+        self.assertEquals(
+            None, member_util.GetAttachment(member.key(), 'liabilitypdf'))
+        self.assertEquals(
+            None, member_util.GetMemberByKey(member.key()).picture)
+
+    def testPrincipal(self):
+        member = self.active_members[0]
+        member.admin = True
+        principal = member_util.Principal.FromMember(member)
+        self.assertEquals(member.key(), principal.key)
+        self.assertEquals(member.username, principal.username)
+        self.assertTrue(principal.admin)
+        self.assertFalse(principal.password_expired)
+
+        values = principal.ToDict()
+        self.assertEquals(str(member.key()), values['key'])
+        copy = member_util.Principal.FromDict(values)
+        self.assertEquals(principal.key, copy.key)
+        self.assertEquals(principal.username, copy.username)
+        self.assertEquals(principal.admin, copy.admin)
+        self.assertTrue(copy.IsCurrent(member))
+
+        self.assertFalse(copy.NeedsCheck(60))
+        self.assertTrue(copy.NeedsCheck(0))
+
+        # Sessions stored before generations and checks were added.
+        del values['session_generation']
+        del values['checked']
+        old = member_util.Principal.FromDict(values)
+        self.assertEquals(0, old.session_generation)
+        self.assertTrue(old.NeedsCheck(60))
+
+    def testEndSessions(self):
+        member = self.active_members[0]
+        principal = member_util.Principal.FromMember(
+            member_util.GetMemberByKey(member.key()))
+        member_util.EndSessions(member.key())
+        self.assertFalse(
+            principal.IsCurrent(member_util.GetMemberByKey(member.key())))
+        self.assertFalse(principal.IsCurrent(None))
+        self.assertEquals(None, member_util.EndSessions(
+            db.Key.from_path('Member', 'missing')))
 
     def testGetMemberByUsername(self):
         member = freesidemodels.Member(
@@ -86,7 +217,7 @@ class MemberUtilTest(test_util.AppEngineTestBase):
             member_util.GetMemberByUsername(member.username).key())
 
         member.active = False
-        member.put()
+        member_util.SaveMember(member)
         self.assertEquals(
             None, member_util.GetMemberByUsername(member.username))
         self.assertEquals(
@@ -94,6 +225,60 @@ class MemberUtilTest(test_util.AppEngineTestBase):
             member_util.GetMemberByUsername(
                 member.username, active=False).key())
 
+    def testGetMemberByUsernameCached(self):
+        member = self.active_members[0]
+        member_util.GetMemberByUsername(member.username)
+        member_cache.Clear()
+
+        # Second lookup is served from memcache, then from the instance.
+        member_util.GetMemberByUsername(member.username)
+        member_util.GetMemberByUsername(member.username)
+        self.assertEquals(
+            {'local_hits': 1, 'memcache_hits': 1, 'misses': 0},
+            member_cache.GetStats())
+
+    def testRenameInvalidatesCache(self):
+        member = self.active_members[0]
+        # Seeded usernames may repeat, so start from a unique one.
+        member.username = 'fry'
+        member_util.SaveMember(member)
+        old_username = member.username
+        member_util.GetMemberByUsername(old_username)
+
+        member.username = 'hermes'
+        member_util.SaveMember(member)
+        self.assertEquals(None, member_util.GetMemberByUsername(old_username))
+        self.assertEquals(
+            member.key(), member_util.GetMemberByUsername('hermes').key())
+
+    def testGetMemberByKey(self):
+        member = self.active_members[0]
+        self.assertEquals(
+            member.username, member_util.GetMemberByKey(member.key()).username)
+        self.assertEquals(
+            member.username, member_util.GetMemberByKey(member.key()).username)
+        self.assertEquals(1, member_cache.GetStats()['local_hits'])
+
+    def testGetPeopleByKeys(self):
+        person = random_util.Person()
+        person.put()
+        cached = self.active_members[0]
+        member_util.GetMemberByKey(cached.key())
+        keys = [person.key(), cached.key(), self.active_members[1].key(),
+                cached.key()]
+
+        counter = rpc_util.RpcCounter()
+        people = member_util.GetPeopleByKeys(keys)
+        self.assertEquals(1, counter.Count('datastore_v3'))
+        self.assertEquals(3, len(people))
+        self.assertEquals(person.username, people[str(person.key())].username)
+        self.assertEquals(cached.username, people[str(cached.key())].username)
+
+        # The uncached member is now cached; the person is not.
+        counter = rpc_util.RpcCounter()
+        member_util.GetPeopleByKeys(keys[1:])
+        self.assertEquals(0, counter.Count('datastore_v3'))
+
     def testGetMemberByEmail(self):
         member = freesidemodels.Member(
             username='bender', password='foo', email='bender@robots.com')
@@ -103,7 +288,7 @@ class MemberUtilTest(test_util.AppEngineTestBase):
             member_util.GetMemberByEmail(member.email).key())
 
         member.active = False
-        member.put()
+        member_util.SaveMember(member)
         self.assertEquals(
             None, member_util.GetMemberByEmail(member.email))
         self.assertEquals(
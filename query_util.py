@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+
+"""Utility functions for paging through datastore queries."""
+
+from google.appengine.ext import db
+
+
+def FetchPage(query, cursor, page_size):
+    """Fetches one page of a query, continuing from a cursor.
+
+    Cursors usually come from the query string, so a malformed one gets the
+    first page rather than an error.
+
+    Args:
+      query: db.Query, with its filters and order set.
+      cursor: str, cursor returned with the previous page, or None.
+      page_size: int, number of results per page.
+    Returns:
+      (list of results, str cursor for the next page or None if this is the
+      last page).  A full last page still returns a cursor, whose page will
+      be empty.
+    """
+    try:
+        # Bad cursors are rejected either here or when the query runs.
+        query.with_cursor(cursor or None)
+        results = query.fetch(page_size)
+    except db.BadValueError:
+        query.with_cursor(None)
+        results = query.fetch(page_size)
+    if len(results) < page_size:
+        return results, None
+    return results, query.cursor()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""Unittest for query_util.py"""
+
+import unittest
+
+import freesidemodels
+import query_util
+import random_util
+import test_util
+
+
+class FetchPageTest(test_util.AppEngineTestBase):
+
+    def setUp(self):
+        test_util.AppEngineTestBase.setUp(self)
+        self.keys = []
+        for i in range(5):
+            member = random_util.Member()
+            member.username = 'member%d' % i
+            member.put()
+            self.keys.append(member.key())
+
+    def Query(self):
+        return freesidemodels.Member.all().order('username')
+
+    def testPages(self):
+        results, cursor = query_util.FetchPage(self.Query(), None, 3)
+        self.assertEquals(self.keys[:3], [m.key() for m in results])
+        results, cursor = query_util.FetchPage(self.Query(), cursor, 3)
+        self.assertEquals(self.keys[3:], [m.key() for m in results])
+        self.assertEquals(None, cursor)
+
+    def testFullLastPage(self):
+        results, cursor = query_util.FetchPage(self.Query(), None, 5)
+        self.assertEquals(5, len(results))
+        self.assertEquals(([], None),
+                          query_util.FetchPage(self.Query(), cursor, 5))
+
+    def testBadCursor(self):
+        for cursor in ['garbage', 'E-ABAIICGmoJ']:
+            results, _ = query_util.FetchPage(self.Query(), cursor, 3)
+            self.assertEquals(self.keys[:3], [m.key() for m in results])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""Counts App Engine API calls, for reporting RPCs per request."""
+
+from google.appengine.api import apiproxy_stub_map
+
+
+_counts = {}
+# The api proxy the counting hook was appended to.
+_hooked_proxy = None
+
+
+def _CountCall(service, call, request, response):
+    name = '%s.%s' % (service, call)
+    _counts[name] = _counts.get(name, 0) + 1
+
+
+def _Install():
+    """Appends the counting hook to the current api proxy, once."""
+    global _hooked_proxy
+    if _hooked_proxy is not apiproxy_stub_map.apiproxy:
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'rpc_util', _CountCall)
+        _hooked_proxy = apiproxy_stub_map.apiproxy
+
+
+class RpcCounter(object):
+    """Counts the API calls made after it was created.
+
+    Example:
+      counter = rpc_util.RpcCounter()
+      DoSomeWork()
+      logging.info('%d datastore RPCs', counter.Count('datastore_v3'))
+    """
+
+    def __init__(self):
+        _Install()
+        self._start = dict(_counts)
+
+    def Counts(self):
+        """Gets the calls made so far, by name.
+
+        Returns:
+          dict mapping 'service.Call' names to call counts.
+        """
+        counts = {}
+        for name, count in _counts.iteritems():
+            count -= self._start.get(name, 0)
+            if count:
+                counts[name] = count
+        return counts
+
+    def Count(self, service=None):
+        """Gets the number of calls made so far.
+
+        Args:
+          service: str, only count calls to this service, e.g. 'memcache'.
+        Returns:
+          int
+        """
+        return sum([count for name, count in self.Counts().iteritems()
+                    if service is None or name.split('.')[0] == service])
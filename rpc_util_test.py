@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+
+"""Unittest for rpc_util.py"""
+
+import unittest
+
+from google.appengine.api import memcache
+
+import random_util
+import rpc_util
+import test_util
+
+
+class RpcCounterTest(test_util.AppEngineTestBase):
+
+    def testCount(self):
+        random_util.Member().put()
+        counter = rpc_util.RpcCounter()
+        self.assertEquals(0, counter.Count())
+
+        random_util.Member().put()
+        memcache.get('foo')
+        memcache.get('bar')
+        self.assertEquals(1, counter.Count('datastore_v3'))
+        self.assertEquals(2, counter.Count('memcache'))
+        self.assertEquals(3, counter.Count())
+        self.assertEquals(2, counter.Counts()['memcache.Get'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""Benchmark for session data caching in appengine_utilities/sessions.py.
+
+Not part of the unit tests; run it directly.
+"""
+
+import pickle
+import time
+import unittest
+
+from appengine_utilities import sessions
+import sessions_test
+import test_util
+
+
+class SessionDataBenchmark(test_util.AppEngineTestBase):
+    """Times cached session data operations against sessions of each size."""
+
+    SIZES = (1, 10, 25, 50)
+    ROUNDS = 20
+
+    def _Time(self, fn):
+        start = time.time()
+        for i in range(self.ROUNDS):
+            fn(i)
+        return (time.time() - start) * 1000 / self.ROUNDS
+
+    def testOperationCost(self):
+        for size in self.SIZES:
+            session = sessions_test.PutSession(float(size), size)
+            session.get_items()
+            last = u'key%d' % (size - 1)
+
+            def Get(i):
+                session.get_item(last)
+
+            def Put(i):
+                sessions._AppEngineUtilities_SessionData(
+                    session_key=session.session_key, keyname=u'bench%d' % i,
+                    content=pickle.dumps(i)).put()
+
+            def Delete(i):
+                session.get_item(u'bench%d' % i).delete()
+
+            print ('\n%2d keys: get %.2fms, put %.2fms, delete %.2fms per op' %
+                   (size, self._Time(Get), self._Time(Put),
+                    self._Time(Delete)))
+
+
+if __name__ == '__main__':
+    unittest.main()
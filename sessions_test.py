@@ -0,0 +1,545 @@
+#!/usr/bin/env python
+
+"""Unittest for appengine_utilities/sessions.py"""
+
+import datetime
+import os
+import pickle
+import StringIO
+import sys
+import time
+import unittest
+
+from google.appengine.api import memcache
+
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+
+from appengine_utilities import sessions
+from appengine_utilities.cache import Cache
+from appengine_utilities.cache import _AppEngineUtilities_Cache
+import freeside
+import rpc_util
+import test_util
+
+
+def PutSession(session_key, item_count=1, last_activity=None):
+    """Stores a session holding item_count data items.
+
+    The entities are stored with db.put, bypassing the put() overrides.
+    """
+    if last_activity is None:
+        last_activity = datetime.datetime.now()
+    session = sessions._AppEngineUtilities_Session(
+        session_key=session_key, last_activity=last_activity)
+    items = [sessions._AppEngineUtilities_SessionData(
+        session_key=session_key, keyname=u'key%d' % i,
+        content=pickle.dumps(i)) for i in range(item_count)]
+    db.put([session] + items)
+    return session
+
+
+def SessionKeys():
+    return sorted([s.session_key
+                   for s in sessions._AppEngineUtilities_Session.all()])
+
+
+def SessionDataKeys():
+    return sorted(set([d.session_key
+                       for d in sessions._AppEngineUtilities_SessionData.all()]))
+
+
+class SweepTest(test_util.AppEngineTestBase):
+
+    def setUp(self):
+        test_util.AppEngineTestBase.setUp(self)
+        now = datetime.datetime.now()
+        self.expired = now - datetime.timedelta(days=1)
+        self.fresh = now - datetime.timedelta(seconds=60)
+
+    def testSweepExpired(self):
+        for session_key in range(5):
+            PutSession(float(session_key), 2, self.expired)
+        PutSession(10.0, 2, self.fresh)
+
+        cursor = sessions.Session.sweep_expired(batch_size=2)
+        self.failUnless(cursor)
+        while cursor:
+            cursor = sessions.Session.sweep_expired(cursor=cursor, batch_size=2)
+
+        self.assertEquals([10.0], SessionKeys())
+        self.assertEquals([10.0], SessionDataKeys())
+
+    def testSweepOrphanedData(self):
+        PutSession(1.0, 1, self.fresh)
+        db.put(sessions._AppEngineUtilities_SessionData(
+            session_key=2.0, keyname='orphan'))
+
+        cursor = sessions.Session.sweep_orphaned_data()
+        self.assertEquals(None, cursor)
+        self.assertEquals([1.0], SessionDataKeys())
+
+    def testSweepExpiredCache(self):
+        now = datetime.datetime.now()
+        db.put([
+            _AppEngineUtilities_Cache(
+                cachekey='old', timeout=now - datetime.timedelta(minutes=1)),
+            _AppEngineUtilities_Cache(
+                cachekey='new', timeout=now + datetime.timedelta(minutes=1))])
+
+        self.assertEquals(None, Cache.sweep_expired())
+        self.assertEquals(
+            ['new'], [c.cachekey for c in _AppEngineUtilities_Cache.all()])
+
+    def testSweepTaskRunsEverySweeper(self):
+        PutSession(1.0, 1, self.expired)
+        db.put(sessions._AppEngineUtilities_SessionData(
+            session_key=2.0, keyname='orphan'))
+        db.put(_AppEngineUtilities_Cache(
+            cachekey='old',
+            timeout=datetime.datetime.now() - datetime.timedelta(minutes=1)))
+
+        cursor = freeside.SweepExpired()
+        batches = 1
+        while cursor:
+            cursor = freeside.SweepExpired(cursor=cursor)
+            batches += 1
+
+        self.assertEquals(3, batches)
+        self.assertEquals([], SessionKeys())
+        self.assertEquals([], SessionDataKeys())
+        self.assertEquals(0, _AppEngineUtilities_Cache.all().count())
+
+
+class DeleteTest(test_util.AppEngineTestBase):
+
+    def testDeleteSession(self):
+        session = PutSession(1.0, 3)
+        PutSession(2.0, 1)
+        session.get_items()
+        session.delete()
+        self.assertEquals([2.0], SessionKeys())
+        self.assertEquals([2.0], SessionDataKeys())
+        self.assertEquals(
+            None, memcache.get(sessions._session_data_cache_key(1.0)))
+
+    def testDeleteSessionsBatch(self):
+        for session_key in range(5):
+            PutSession(float(session_key), 2)
+        memcache.set(sessions._session_cache_key(1.0), 'cached')
+
+        cursor = sessions.Session.delete_sessions_batch(batch_size=2)
+        self.assertEquals(None, memcache.get(sessions._session_cache_key(1.0)))
+        batches = 1
+        while cursor:
+            cursor = sessions.Session.delete_sessions_batch(
+                cursor=cursor, batch_size=2)
+            batches += 1
+        # 3 batches of sessions, then 6 of session data, the last empty
+        self.assertEquals(9, batches)
+        self.assertEquals([], SessionKeys())
+        self.assertEquals([], SessionDataKeys())
+
+    def testDeleteAllSessions(self):
+        for session_key in range(3):
+            PutSession(float(session_key), 2)
+        self.failUnless(sessions.Session.delete_all_sessions())
+        self.assertEquals([], SessionKeys())
+        self.assertEquals([], SessionDataKeys())
+
+
+class SessionDataCacheTest(test_util.AppEngineTestBase):
+
+    def testGetItemCachesDict(self):
+        session = PutSession(1.0, 3)
+        self.assertEquals(u'key1', session.get_item(u'key1').keyname)
+
+        counter = rpc_util.RpcCounter()
+        self.assertEquals(u'key2', session.get_item(u'key2').keyname)
+        self.assertEquals(None, session.get_item(u'missing'))
+        self.assertEquals(0, counter.Count('datastore_v3'))
+        self.assertEquals(
+            [u'key0', u'key1', u'key2'],
+            sorted(memcache.get(sessions._session_data_cache_key(1.0))))
+
+    def testPutAndDeleteUpdateCache(self):
+        session = PutSession(1.0, 1)
+        session.get_items()
+
+        sessions._AppEngineUtilities_SessionData(
+            session_key=1.0, keyname=u'new', content=pickle.dumps(1)).put()
+        session.get_item(u'key0').delete()
+
+        self.assertEquals(
+            [u'new'], [item.keyname for item in session.get_items()])
+        self.assertEquals(
+            [u'new'], [item.keyname for item in session.get_items_ds()])
+
+    def testConcurrentUpdatesKept(self):
+        session = PutSession(1.0, 0)
+        session.get_items()
+        other = memcache.Client()
+        cache_key = sessions._session_data_cache_key(1.0)
+
+        def Update(items):
+            # Another request sneaks in a change between our gets and cas.
+            if u'other' not in items:
+                other_items = other.gets(cache_key)
+                other_items[u'other'] = None
+                other.cas(cache_key, other_items)
+            items[u'mine'] = None
+
+        self.failUnless(sessions._update_session_data_cache(1.0, Update))
+        self.assertEquals([u'mine', u'other'],
+                          sorted(memcache.get(cache_key)))
+
+    def testUncachedUpdateIgnored(self):
+        def Update(items):
+            self.fail('Should not update a missing dict')
+        self.failIf(sessions._update_session_data_cache(1.0, Update))
+
+
+class UnitOfWorkTest(test_util.AppEngineTestBase):
+
+    def setUp(self):
+        test_util.AppEngineTestBase.setUp(self)
+        self.session = sessions.Session(unit_of_work=True)
+
+    def StoredKeynames(self):
+        return sorted([d.keyname for d in
+                       sessions._AppEngineUtilities_SessionData.all()])
+
+    def testChangesBufferedUntilCommit(self):
+        self.session['a'] = 1
+        self.session['b'] = 2
+        self.session['c'] = 3
+        del self.session['c']
+        self.assertEquals(1, self.session['a'])
+        self.failIf('c' in self.session)
+        self.assertEquals([u'a', u'b'], sorted(self.session.keys()))
+        self.assertEquals([], self.StoredKeynames())
+
+        counter = rpc_util.RpcCounter()
+        self.failUnless(self.session.commit())
+        self.assertEquals({'datastore_v3.Put': 1},
+                          dict([(k, v) for k, v in counter.Counts().items()
+                                if k.startswith('datastore_v3')]))
+        self.assertEquals([u'a', u'b'], self.StoredKeynames())
+        self.assertEquals(
+            [u'a', u'b'], sorted([item.keyname for item in
+                                  self.session.session.get_items()]))
+
+    def testDeleteCommitted(self):
+        self.session['a'] = 1
+        self.session['b'] = 2
+        self.session.commit()
+
+        del self.session['a']
+        self.session['b'] = 3
+        self.session.commit()
+        self.assertEquals([u'b'], self.StoredKeynames())
+        [item] = self.session.session.get_items()
+        self.assertEquals(3, pickle.loads(item.content))
+
+    def testDeleteMissing(self):
+        self.assertRaises(KeyError, self.session.__delitem__, 'missing')
+
+    def testNothingChanged(self):
+        counter = rpc_util.RpcCounter()
+        self.failIf(self.session.commit())
+        self.assertEquals(0, counter.Count())
+
+
+class ClockTestBase(test_util.AppEngineTestBase):
+    """Lets tests move forward the clocks the sessions module reads.
+
+    Advance() shifts both time.time() and sessions' datetime.datetime.now(),
+    so tests don't have to sleep.
+    """
+
+    def setUp(self):
+        test_util.AppEngineTestBase.setUp(self)
+        self.offset = 0
+        self.orig_time = time.time
+        self.orig_datetime = sessions.datetime
+        test = self
+
+        class ShiftedDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return (datetime.datetime.now(tz) +
+                        datetime.timedelta(seconds=test.offset))
+
+        class ShiftedDatetimeModule(object):
+            timedelta = datetime.timedelta
+            datetime = ShiftedDatetime
+
+        time.time = lambda: self.orig_time() + self.offset
+        sessions.datetime = ShiftedDatetimeModule
+
+    def tearDown(self):
+        time.time = self.orig_time
+        sessions.datetime = self.orig_datetime
+        test_util.AppEngineTestBase.tearDown(self)
+
+    def Advance(self, seconds):
+        self.offset += seconds
+
+
+class TokenRotationTest(ClockTestBase):
+
+    REQUESTS = 3
+
+    def tearDown(self):
+        os.environ.pop('HTTP_COOKIE', None)
+        ClockTestBase.tearDown(self)
+
+    def Request(self, sid, **kwargs):
+        """Opens the session as a request with the given token would."""
+        # the environment holds byte strings, as in production
+        os.environ['HTTP_COOKIE'] = str('%s=%s' % (
+            sessions.Session.COOKIE_NAME, sid))
+        return sessions.Session(session_token_ttl=1, **kwargs)
+
+    def CountRotationPuts(self, signed_tokens):
+        """Counts datastore puts over requests that each rotate the token."""
+        session = self.Request('', signed_tokens=signed_tokens)
+        session_key = session.session.session_key
+        sid = session.sid
+        counter = rpc_util.RpcCounter()
+        for i in range(self.REQUESTS):
+            self.Advance(2)
+            session = self.Request(sid, signed_tokens=signed_tokens)
+            self.assertEquals(session_key, session.session.session_key)
+            self.assertNotEquals(sid, session.sid)
+            sid = session.sid
+        return counter.Counts().get('datastore_v3.Put', 0)
+
+    def testWriteRate(self):
+        stored = self.CountRotationPuts(False)
+        signed = self.CountRotationPuts(True)
+        self.assertEquals(self.REQUESTS, stored)
+        self.assertEquals(0, signed)
+
+    def testForgedTokenRejected(self):
+        session = self.Request('', signed_tokens=True)
+        forged = session.sid[:-1] + (session.sid[-1] == '0' and '1' or '0')
+        other = self.Request(forged, signed_tokens=True)
+        self.assertNotEquals(
+            session.session.session_key, other.session.session_key)
+
+    def testNonFiniteKeyRejected(self):
+        for sid in ('nan_1_x', 'inf_1_x', '-inf_1_x'):
+            session = self.Request(sid, signed_tokens=True)
+            self.assertNotEquals(sid, session.sid)
+            session.sid = sid
+            self.assertEquals(None, session.parse_signed_sid())
+
+    def testStaleTokenRejected(self):
+        session = self.Request('', signed_tokens=True)
+        session.session.token_window += 3
+        session.session.put_memcache()
+        other = self.Request(session.sid, signed_tokens=True)
+        self.assertNotEquals(
+            session.session.session_key, other.session.session_key)
+
+    def testCycleKeyInvalidatesTokens(self):
+        session = self.Request('', signed_tokens=True)
+        old_sid = session.sid
+        new_sid = session.cycle_key()
+        self.assertEquals(session.session.session_key,
+                          self.Request(new_sid, signed_tokens=True)
+                          .session.session_key)
+        self.assertNotEquals(session.session.session_key,
+                             self.Request(old_sid, signed_tokens=True)
+                             .session.session_key)
+
+    def testStoredTokenCarriesOver(self):
+        session = self.Request('')
+        signed = self.Request(session.sid, signed_tokens=True)
+        self.assertEquals(
+            session.session.session_key, signed.session.session_key)
+        self.failUnless(signed.parse_signed_sid())
+
+
+class SignedCookieTest(ClockTestBase):
+
+    def tearDown(self):
+        os.environ.pop('HTTP_COOKIE', None)
+        sessions.SIGNED_COOKIE_KEY_VERSION = 1
+        ClockTestBase.tearDown(self)
+
+    def Request(self, cookies, **kwargs):
+        """Opens the session as a request sending the given cookies would."""
+        os.environ['HTTP_COOKIE'] = '; '.join(
+            ['%s=%s' % item for item in cookies.items()])
+        return sessions.Session(writer='signed_cookie', **kwargs)
+
+    def SignedCookie(self, session):
+        return {session.signed_cookie_name:
+                session.output_cookie[session.signed_cookie_name].value}
+
+    def testRoundTrip(self):
+        session = self.Request({})
+        session['user'] = {'username': 'fry', 'admin': False}
+        session['error'] = 'Incorrect password.'
+
+        counter = rpc_util.RpcCounter()
+        other = self.Request(self.SignedCookie(session))
+        self.assertEquals({'username': 'fry', 'admin': False}, other['user'])
+        self.assertEquals('Incorrect password.', other['error'])
+        self.failIf(hasattr(other, 'session'))
+        self.assertEquals(0, counter.Count())
+
+    def testTamperedCookieIgnored(self):
+        session = self.Request({})
+        session['user'] = {'username': 'fry', 'admin': False}
+        [(name, value)] = self.SignedCookie(session).items()
+        version, created, issued, payload, signature = value.split('.')
+        payload = payload[:-1] + (payload[-1] == 'A' and 'B' or 'A')
+        forged = self.Request(
+            {name: '.'.join([version, created, issued, payload, signature])})
+        self.failIf('user' in forged)
+
+    def testUnsignedCookieIgnored(self):
+        session = self.Request(
+            {'%s_data' % sessions.Session.COOKIE_NAME: '{"user":1}'})
+        self.failIf('user' in session)
+
+    def testUnitOfWork(self):
+        session = self.Request({}, unit_of_work=True)
+        session['user'] = 1
+        self.failIf(session.output_cookie.has_key(session.signed_cookie_name))
+        self.failUnless(session.commit())
+        self.assertEquals(1, self.Request(self.SignedCookie(session))['user'])
+
+    def testDelete(self):
+        session = self.Request({})
+        session['user'] = 1
+        session['error'] = 'Incorrect password.'
+        del session['error']
+        self.assertRaises(KeyError, session.__delitem__, 'error')
+
+        loaded = self.Request(self.SignedCookie(session))
+        self.assertEquals(1, loaded['user'])
+        self.failIf('error' in loaded)
+        loaded.clear()
+        self.failIf('user' in self.Request(self.SignedCookie(loaded)))
+
+    def testMaxAge(self):
+        session = self.Request({})
+        session['user'] = 1
+        cookie = self.SignedCookie(session)
+        created = cookie.values()[0].split('.')[1]
+
+        self.Advance(2)
+        # Re-signing pushes back the idle expiry, but keeps the creation time.
+        resigned = self.Request(cookie, last_activity_update=0)
+        self.assertEquals(1, resigned['user'])
+        resigned_cookie = self.SignedCookie(resigned)
+        self.assertNotEquals(cookie, resigned_cookie)
+        self.assertEquals(created, resigned_cookie.values()[0].split('.')[1])
+
+        self.failIf('user' in self.Request(resigned_cookie,
+                                           signed_cookie_max_age=1))
+
+    def testKeyRotation(self):
+        session = self.Request({})
+        session['user'] = 1
+        old_cookie = self.SignedCookie(session)
+
+        sessions.SIGNED_COOKIE_KEY_VERSION = 2
+        rotated = self.Request(old_cookie)
+        self.assertEquals(1, rotated['user'])
+        self.failUnless(
+            self.SignedCookie(rotated).values()[0].startswith('2.'))
+
+        sessions.SIGNED_COOKIE_KEY_VERSION = 3
+        self.failIf('user' in self.Request(old_cookie))
+
+    def testSizeGuard(self):
+        session = self.Request({}, signed_cookie_max_size=200)
+        session['small'] = 1
+        big = os.urandom(200).encode('hex')
+        session['big'] = big
+        self.assertEquals('datastore', session.writer)
+        self.assertEquals(
+            [u'big', u'small'],
+            sorted([d.keyname for d in
+                    sessions._AppEngineUtilities_SessionData.all()]))
+
+        other = self.Request(
+            {sessions.Session.COOKIE_NAME:
+             session.output_cookie[sessions.Session.COOKIE_NAME].value})
+        self.assertEquals(session.session.session_key,
+                          other.session.session_key)
+        self.assertEquals(big, other['big'])
+        self.assertEquals(1, other['small'])
+
+
+class CollectHeadersTest(test_util.AppEngineTestBase):
+
+    def setUp(self):
+        test_util.AppEngineTestBase.setUp(self)
+        os.environ.pop('HTTP_COOKIE', None)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def testHeadersSentOnce(self):
+        session = sessions.Session(writer='signed_cookie',
+                                   collect_headers=True)
+        session['user'] = 1
+        session['error'] = 'Invalid username.'
+        del session['error']
+        session.flash.msg = 'Saved.'
+        response = webapp.Response()
+        session.write_headers(response)
+
+        self.assertEquals('', sys.stdout.getvalue())
+        cookies = response.headers.get_all('Set-Cookie')
+        names = sorted([cookie.split('=')[0] for cookie in cookies])
+        self.assertEquals(len(set(names)), len(names))
+        self.failUnless(session.signed_cookie_name in names)
+        self.assertEquals('no-cache', response.headers['Pragma'])
+
+    def testPrintsByDefault(self):
+        session = sessions.Session(writer='signed_cookie')
+        session['user'] = 1
+        self.failUnless(session.signed_cookie_name in sys.stdout.getvalue())
+
+
+class SessionKeyTest(test_util.AppEngineTestBase):
+
+    COUNT = 10000
+
+    def testNoProbes(self):
+        counter = rpc_util.RpcCounter()
+        session_keys = set()
+        for i in range(self.COUNT):
+            session = sessions._AppEngineUtilities_Session()
+            session.put()
+            session_keys.add(session.session_key)
+        counts = counter.Counts()
+        self.assertEquals(self.COUNT, len(session_keys))
+        self.assertEquals(self.COUNT, counts['datastore_v3.Put'])
+        self.assertEquals(0, counts.get('datastore_v3.RunQuery', 0))
+        self.assertEquals(0, counts.get('memcache.Get', 0))
+        for session_key in list(session_keys)[:100]:
+            self.assertEquals(session_key, float(
+                sessions._session_key_string(session_key)))
+
+    def testNewSessionPutOnce(self):
+        os.environ.pop('HTTP_COOKIE', None)
+        counter = rpc_util.RpcCounter()
+        session = sessions.Session()
+        self.assertEquals(1, counter.Counts()['datastore_v3.Put'])
+        self.assertEquals(
+            session.session.session_key,
+            sessions._AppEngineUtilities_Session.all().get().session_key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,9 +9,12 @@ import unittest
 from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import datastore_file_stub
 from google.appengine.api import mail_stub
+from google.appengine.api.memcache import memcache_stub
 from google.appengine.api import urlfetch_stub
 from google.appengine.api import user_service_stub
 
+import member_cache
+
 APP_ID = u'freesideatlanta-members'
 AUTH_DOMAIN = 'gmail.com'
 LOGGED_IN_USER = 'test_user@example.com'
@@ -49,5 +52,10 @@ class AppEngineTestBase(unittest.TestCase):
         apiproxy_stub_map.apiproxy.RegisterStub(
             'mail', mail_stub.MailServiceStub())
 
+        # Use a fresh memcache stub, and drop any in-instance cached members.
+        apiproxy_stub_map.apiproxy.RegisterStub(
+            'memcache', memcache_stub.MemcacheServiceStub())
+        member_cache.Clear()
+
     def tearDown(self):
         self.__datastore_stub.Clear()
@@ -1,16 +1,21 @@
 import datetime
 
 
+ZERO = datetime.timedelta(0)
+HOUR = datetime.timedelta(hours=1)
+EST_OFFSET = datetime.timedelta(hours=-5)
+
+
 class UTC(datetime.tzinfo):
   """Plain old UTC time."""
   def utcoffset(self, dt):
-    return datetime.timedelta(0)
+    return ZERO
 
   def tzname(self, dt):
     return 'UTC'
 
   def dst(self, dt):
-    return datetime.timedelta(0)
+    return ZERO
 
 
 class Eastern(datetime.tzinfo):
@@ -18,25 +23,44 @@ class Eastern(datetime.tzinfo):
 
   This is necessary because data store only uses UTC.
   """
+
+  # Maps year to its (dst_start, dst_end) naive local datetimes.  Shared by
+  # all instances.
+  _transitions = {}
+
   def utcoffset(self, dt):
-    return datetime.timedelta(hours=-5) + self.dst(dt)
+    return EST_OFFSET + self.dst(dt)
 
   def _FirstSunday(self, dt):
     return dt + datetime.timedelta(days=(6-dt.weekday()))
 
-  def dst(self, dt):
-    # 2 am on the second Sunday in March
-    dst_start = self._FirstSunday(datetime.datetime(dt.year, 3, 8, 2)) 
-    # 1 am on the first Sunday in November
-    dst_end = self._FirstSunday(datetime.datetime(dt.year, 11, 1, 1)) 
+  def _Transitions(self, year):
+    """Gets the DST transitions for a year, computing them only once."""
+    try:
+      return self._transitions[year]
+    except KeyError:
+      transitions = (
+          # 2 am on the second Sunday in March
+          self._FirstSunday(datetime.datetime(year, 3, 8, 2)),
+          # 1 am on the first Sunday in November
+          self._FirstSunday(datetime.datetime(year, 11, 1, 1)))
+      self._transitions[year] = transitions
+      return transitions
 
+  def dst(self, dt):
+    dst_start, dst_end = self._Transitions(dt.year)
     if dst_start <= dt.replace(tzinfo=None) < dst_end:
-      return datetime.timedelta(hours=1)
+      return HOUR
     else:
-      return datetime.timedelta(hours=0)
+      return ZERO
 
   def tzname(self, dt):
-    if self.dst(dt) == datetime.timedelta(hour=0):
-      return "EST"
-    else:
+    if self.dst(dt):
       return "EDT"
+    else:
+      return "EST"
+
+
+# Shared instances; the classes hold no per-instance state.
+UTC_TZ = UTC()
+EASTERN_TZ = Eastern()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+"""Compares Eastern conversion throughput with and without cached transitions.
+
+Not part of the unit tests; run it directly.
+"""
+
+import datetime
+import time
+
+import timezones
+from timezones_test import UncachedEastern
+
+
+COUNT = 100000
+
+
+def Convert(tz, datetimes):
+    """Returns conversions per second of datetimes to tz."""
+    start = time.time()
+    for dt in datetimes:
+        dt.astimezone(tz)
+    return len(datetimes) / (time.time() - start)
+
+
+def main():
+    start = datetime.datetime(2009, 1, 1, tzinfo=timezones.UTC_TZ)
+    datetimes = [start + datetime.timedelta(minutes=37 * i)
+                 for i in xrange(COUNT)]
+    uncached = Convert(UncachedEastern(), datetimes)
+    cached = Convert(timezones.EASTERN_TZ, datetimes)
+    print ('%d conversions: %.0f/s uncached, %.0f/s cached (%.1fx)' %
+           (COUNT, uncached, cached, cached / uncached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""Unittest for timezones.py"""
+
+import datetime
+import unittest
+
+import timezones
+
+
+class UncachedEastern(timezones.Eastern):
+    """Eastern as it was before transitions were cached, for comparison."""
+
+    def dst(self, dt):
+        dst_start = self._FirstSunday(datetime.datetime(dt.year, 3, 8, 2))
+        dst_end = self._FirstSunday(datetime.datetime(dt.year, 11, 1, 1))
+        if dst_start <= dt.replace(tzinfo=None) < dst_end:
+            return datetime.timedelta(hours=1)
+        else:
+            return datetime.timedelta(hours=0)
+
+
+def ToEastern(*args):
+    utc = datetime.datetime(*args).replace(tzinfo=timezones.UTC_TZ)
+    return utc.astimezone(timezones.EASTERN_TZ)
+
+
+class EasternTest(unittest.TestCase):
+
+    def assertLocal(self, expected, tzname, local):
+        self.assertEquals(expected, local.replace(tzinfo=None))
+        self.assertEquals(tzname, local.tzname())
+
+    def testWinterAndSummer(self):
+        self.assertLocal(datetime.datetime(2010, 1, 15, 7), 'EST',
+                         ToEastern(2010, 1, 15, 12))
+        self.assertLocal(datetime.datetime(2010, 7, 4, 8), 'EDT',
+                         ToEastern(2010, 7, 4, 12))
+
+    def testDstStart(self):
+        # 2 am EST on March 14, 2010 became 3 am EDT.
+        self.assertLocal(datetime.datetime(2010, 3, 14, 1, 59), 'EST',
+                         ToEastern(2010, 3, 14, 6, 59))
+        self.assertLocal(datetime.datetime(2010, 3, 14, 3), 'EDT',
+                         ToEastern(2010, 3, 14, 7))
+
+    def testDstEnd(self):
+        # 2 am EDT on November 7, 2010 became 1 am EST.  Local times from 1
+        # to 2 am are ambiguous and always read as EST, so check just before.
+        self.assertLocal(datetime.datetime(2010, 11, 7, 0, 59), 'EDT',
+                         ToEastern(2010, 11, 7, 4, 59))
+        self.assertLocal(datetime.datetime(2010, 11, 7, 1), 'EST',
+                         ToEastern(2010, 11, 7, 6))
+
+    def testMatchesUncached(self):
+        uncached = UncachedEastern()
+        start = datetime.datetime(2009, 1, 1, tzinfo=timezones.UTC_TZ)
+        for hours in range(0, 24 * 365 * 3, 7):
+            dt = start + datetime.timedelta(hours=hours)
+            self.assertEquals(dt.astimezone(uncached).replace(tzinfo=None),
+                              dt.astimezone(timezones.EASTERN_TZ).replace(
+                                  tzinfo=None))
+
+
+if __name__ == '__main__':
+    unittest.main()